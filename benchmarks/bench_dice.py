@@ -0,0 +1,85 @@
+"""Benchmark the batched dice against scoring one mask at a time.
+
+Masks are generated in memory on the 2 mm template grid, so only the
+scoring is timed:
+- per mask, boolean masks with a dense dice;
+- per mask, packed masks (as kept by the packed mask cache) unpacked and
+  scored with a dense dice;
+- batched, packed masks with ``_batch_dice``.
+
+Usage:
+    python benchmarks/bench_dice.py --n-masks 2000 --resolution 2
+"""
+import argparse
+import time
+
+import numpy as np
+
+from giga_auto_qc import assessments
+from giga_auto_qc.cache import PackedMask
+
+import synthetic
+
+
+def dense_dice(mask: np.ndarray, reference: np.ndarray) -> float:
+    """Dice coefficient of two boolean arrays, one voxel at a time."""
+    intersection = np.count_nonzero(mask & reference)
+    total = np.count_nonzero(mask) + np.count_nonzero(reference)
+    return 2 * intersection / total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--n-masks", type=int, default=2000)
+    parser.add_argument("--resolution", type=float, default=2)
+    parser.add_argument(
+        "--block-size", type=int, default=assessments.DICE_BATCH_SIZE
+    )
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(0)
+    reference_img = synthetic.brain_mask(args.resolution, rng)
+    reference = np.asanyarray(reference_img.dataobj) != 0
+    # a few distinct masks, repeated; the scoring cost does not depend on
+    # the content
+    masks = [
+        np.asanyarray(synthetic.brain_mask(args.resolution, rng).dataobj) != 0
+        for _ in range(16)
+    ]
+    masks = [masks[i % len(masks)] for i in range(args.n_masks)]
+    packed_masks = [
+        PackedMask.pack(mask, reference_img.affine) for mask in masks
+    ]
+    packed_reference = PackedMask.pack(reference, reference_img.affine)
+    expected = [dense_dice(mask, reference) for mask in masks]
+    print(
+        f"{'packed masks':>18}: "
+        f"{np.mean([m.bits.nbytes for m in packed_masks]) / 1024:.1f} kB "
+        f"per mask, {reference.size / 8 / 1024:.1f} kB for the full grid"
+    )
+
+    for name, score in (
+        ("dense_dice", lambda: [dense_dice(m, reference) for m in masks]),
+        (
+            "unpack, dense_dice",
+            lambda: [dense_dice(m.unpack(), reference) for m in packed_masks],
+        ),
+        (
+            "_batch_dice",
+            lambda: assessments._batch_dice(
+                packed_masks, packed_reference, block_size=args.block_size
+            ).tolist(),
+        ),
+    ):
+        start = time.perf_counter()
+        dice = score()
+        elapsed = time.perf_counter() - start
+        print(
+            f"{name:>18}: {elapsed:.3f} s, "
+            f"{args.n_masks / elapsed:,.0f} masks/s"
+        )
+        assert dice == expected
+
+
+if __name__ == "__main__":
+    main()
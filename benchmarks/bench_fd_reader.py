@@ -0,0 +1,66 @@
+"""Benchmark the framewise displacement reader against pandas.
+
+Usage:
+    python benchmarks/bench_fd_reader.py --n-files 200 --n-columns 300
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from giga_auto_qc.assessments import _read_framewise_displacement
+
+
+def write_confounds(path: Path, n_volumes: int, n_columns: int, seed: int):
+    """Write a fMRIPrep-like confounds file."""
+    rng = np.random.default_rng(seed)
+    confounds = pd.DataFrame(
+        rng.random((n_volumes, n_columns)),
+        columns=[f"a_comp_cor_{i:02d}" for i in range(n_columns)],
+    )
+    confounds.insert(10, "framewise_displacement", rng.random(n_volumes))
+    confounds.loc[0, "framewise_displacement"] = np.nan
+    confounds.to_csv(path, sep="\t", index=False, na_rep="n/a")
+
+
+def read_with_pandas(confound_file: Path) -> np.ndarray:
+    """Previous implementation: parse the full table."""
+    return pd.read_csv(confound_file, sep="\t")[
+        "framewise_displacement"
+    ].to_numpy()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--n-files", type=int, default=200)
+    parser.add_argument("--n-volumes", type=int, default=500)
+    parser.add_argument("--n-columns", type=int, default=300)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        files = [
+            Path(tmp_dir) / f"sub-{i}_desc-confounds_timeseries.tsv"
+            for i in range(args.n_files)
+        ]
+        for i, confound_file in enumerate(files):
+            write_confounds(confound_file, args.n_volumes, args.n_columns, i)
+
+        for name, reader in (
+            ("pandas.read_csv", read_with_pandas),
+            ("_read_framewise_displacement", _read_framewise_displacement),
+        ):
+            start = time.perf_counter()
+            for confound_file in files:
+                reader(confound_file)
+            elapsed = time.perf_counter() - start
+            print(
+                f"{name:>30}: {elapsed:.3f} s, "
+                f"{args.n_files / elapsed:.1f} files/s"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Benchmark scoring masks from the packed mask store against reading the
+mask files.
+
+Masks are written as ``.nii.gz`` files on the 2 mm template grid, then
+scored against a reference mask with ``_map_dice``:
+- reading, decompressing and packing each file;
+- from a packed mask store filled by a first run, memory-mapping the
+  packed masks.
+
+Usage:
+    python benchmarks/bench_mask_store.py --n-masks 500 --resolution 2
+"""
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from giga_auto_qc import assessments
+from giga_auto_qc.cache import PackedMaskStore, ReferenceMaskCache
+
+import synthetic
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--n-masks", type=int, default=500)
+    parser.add_argument("--resolution", type=float, default=2)
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(0)
+    reference = synthetic.brain_mask(args.resolution, rng)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        mask_imgs = []
+        for i in range(args.n_masks):
+            mask_img = tmp_dir / f"sub-{i}_desc-brain_mask.nii.gz"
+            synthetic.brain_mask(args.resolution, rng).to_filename(mask_img)
+            mask_imgs.append(str(mask_img))
+        # fill the store, as a first run would
+        assessments._map_dice(
+            mask_imgs,
+            reference,
+            mask_store=PackedMaskStore(tmp_dir / "packed_masks"),
+        )
+
+        results = {}
+        for name, mask_store in (
+            ("mask files", None),
+            ("mask store", PackedMaskStore(tmp_dir / "packed_masks")),
+        ):
+            start = time.perf_counter()
+            results[name] = assessments._map_dice(
+                mask_imgs,
+                reference,
+                reference_cache=ReferenceMaskCache(),
+                mask_store=mask_store,
+            )
+            elapsed = time.perf_counter() - start
+            print(
+                f"{name:>10}: {elapsed:.3f} s, "
+                f"{args.n_masks / elapsed:,.0f} masks/s"
+            )
+        assert results["mask files"] == results["mask store"]
+
+
+if __name__ == "__main__":
+    main()
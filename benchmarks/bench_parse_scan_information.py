@@ -0,0 +1,115 @@
+"""Benchmark parsing the BIDS entities of the scan identifiers.
+
+Compares the previous implementation, a Python loop over the identifiers
+and ``str.split``, and a regular expression parser with
+``str.extractall``, with the vectorised parser on a large set of
+identifiers with a varying set of entities.
+
+Usage:
+    python benchmarks/bench_parse_scan_information.py --n-scans 1000000
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from giga_auto_qc import utils
+
+# entities of the previous implementation
+PREVIOUS_ENTITIES = {"sub": 0, "ses": 1, "task": 2, "acq": 3, "run": 4}
+
+
+def parse_with_split(metrics: pd.DataFrame) -> pd.DataFrame:
+    """Previous implementation: assumes every identifier has the same
+    entities."""
+    headers_members = set()
+    for id in metrics.index:
+        examplar = id.split("_")
+        new_headers = set([e.split("-")[0] for e in examplar])
+        headers_members.update(new_headers)
+    ordered_header = [None] * len(PREVIOUS_ENTITIES)
+    for header in headers_members:
+        ordered_header[PREVIOUS_ENTITIES[header]] = header
+    headers = [h for h in ordered_header if h is not None]
+
+    identifiers = pd.DataFrame(
+        metrics.index.tolist(), index=metrics.index, columns=["identifier"]
+    )
+    identifiers[headers] = identifiers["identifier"].str.split(
+        "_", expand=True
+    )
+    identifiers = identifiers.drop("identifier", axis=1)
+    for h in headers:
+        identifiers[h] = identifiers[h].str.replace(f"{h}-", "")
+    identifiers = identifiers.rename(columns={"sub": "participant_id"})
+    return pd.concat((identifiers, metrics), axis=1)
+
+
+def parse_with_extractall(metrics: pd.DataFrame) -> pd.DataFrame:
+    """Regular expression parser: one match per entity, unstacked to one
+    column per entity."""
+    fields = (
+        pd.Series(metrics.index.astype(str))
+        .str.extractall(r"(?:^|_)([^_-]+)-([^_]*)")
+        .droplevel("match")
+        .set_index(0, append=True)[1]
+    )
+    keys = sorted(
+        pd.unique(fields.index.get_level_values(1)),
+        key=lambda key: utils.BIDS_ENTITIES.get(key, np.inf),
+    )
+    identifiers = (
+        fields.unstack()
+        .reindex(index=range(len(metrics)), columns=keys)
+        .astype("category")
+        .set_axis(metrics.index)
+        .rename(columns={"sub": "participant_id"})
+    )
+    identifiers.columns.name = None
+    return pd.concat((identifiers, metrics), axis=1)
+
+
+def identifiers(n_scans: int, rng: np.random.Generator) -> pd.Index:
+    """Identifiers of the scans of a multi-session, multi-task dataset."""
+    tasks = np.array(["rest", "nback", "movie"])
+    sub = rng.integers(0, n_scans // 10 + 1, n_scans)
+    ses = rng.integers(1, 4, n_scans)
+    task = tasks[rng.integers(0, len(tasks), n_scans)]
+    run = rng.integers(1, 5, n_scans)
+    return pd.Index(
+        [
+            f"sub-{s:06d}_ses-{e}_task-{t}_run-{r}"
+            for s, e, t, r in zip(sub, ses, task, run)
+        ]
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--n-scans", type=int, default=1_000_000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    index = identifiers(args.n_scans, np.random.default_rng(args.seed))
+    metrics = pd.DataFrame({"mean_fd_raw": np.zeros(len(index))}, index=index)
+    results = {}
+    for name, parse in (
+        ("str.split", parse_with_split),
+        ("str.extractall", parse_with_extractall),
+        ("parse_scan_information", utils.parse_scan_information),
+    ):
+        start = time.perf_counter()
+        results[name] = parse(metrics.copy())
+        elapsed = time.perf_counter() - start
+        print(
+            f"{name:>30}: {elapsed:.3f} s, "
+            f"{args.n_scans / elapsed:,.0f} identifiers/s"
+        )
+    expected = results.pop("str.split").astype(str)
+    for parsed in results.values():
+        assert parsed.astype(str).equals(expected)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Benchmark prefetching the masks and confounds on a high-latency
+filesystem.
+
+The latency of a network filesystem is simulated by sleeping before each
+file read; the reads themselves (gzip decompression, parsing) are real.
+Compares the functional metrics throughput with a range of prefetch
+depths.
+
+Usage:
+    python benchmarks/bench_prefetch.py --n-subjects 20 --latency-ms 20 \
+        --depths 0 2 4 8 16
+"""
+import argparse
+import tempfile
+import time
+from functools import wraps
+from pathlib import Path
+
+import numpy as np
+
+from giga_auto_qc import assessments
+from giga_auto_qc.cache import ReferenceMaskCache
+from giga_auto_qc.file_index import FileIndex
+from giga_auto_qc.workflow import DEFAULT_QC_STANDARD
+
+import synthetic
+
+
+def with_latency(read, latency: float):
+    """Wait for the simulated filesystem before each read."""
+
+    @wraps(read)
+    def slow_read(path):
+        time.sleep(latency)
+        return read(path)
+
+    return slow_read
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    synthetic.add_arguments(parser)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument(
+        "--depths", type=int, nargs="+", default=[0, 2, 4, 8, 16]
+    )
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bids_dir = synthetic.from_arguments(Path(tmp_dir) / "fmriprep", args)
+        subjects = [p.name[4:] for p in sorted(bids_dir.glob("sub-*"))]
+        file_index = FileIndex.from_directory(bids_dir, subjects, verbose=0)
+        template = synthetic.brain_mask(1, np.random.default_rng(0))
+        reference_masks = {"anat": template, "func": template}
+        reference_cache = ReferenceMaskCache()
+
+        latency = args.latency_ms / 1000
+        assessments._load_mask = with_latency(assessments._load_mask, latency)
+        assessments._read_framewise_displacement = with_latency(
+            assessments._read_framewise_displacement, latency
+        )
+        expected = None
+        for depth in args.depths:
+            start = time.perf_counter()
+            n_scans = 0
+            for task in file_index.get_tasks():
+                metrics = assessments.calculate_functional_metrics(
+                    subjects,
+                    task,
+                    file_index,
+                    reference_masks,
+                    DEFAULT_QC_STANDARD,
+                    verbose=0,
+                    reference_cache=reference_cache,
+                    prefetch=depth,
+                )
+                n_scans += len(metrics)
+            elapsed = time.perf_counter() - start
+            if expected is None:
+                expected = metrics
+            assert metrics.equals(expected)
+            print(
+                f"prefetch {depth:>3}: {elapsed:7.3f} s, "
+                f"{n_scans / elapsed:7.1f} scans/s"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Benchmark the anatomical join of quality_accessments.
+
+Compares the vectorised join with the previous per-identifier loop.
+
+Usage:
+    python benchmarks/bench_quality_accessments.py --n-identifiers 100000
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from giga_auto_qc.assessments import quality_accessments
+from giga_auto_qc.workflow import DEFAULT_QC_STANDARD
+
+
+def loop_join(
+    functional_metrics: pd.DataFrame, anatomical_metrics: pd.DataFrame
+) -> pd.DataFrame:
+    """Previous implementation: two .loc lookups per identifier."""
+    pass_anat_qc = {}
+    for id in functional_metrics.index:
+        sub = id.split("sub-")[-1].split("_")[0]
+        pass_anat_qc[id] = {
+            "anatomical_dice": anatomical_metrics.loc[sub, "anatomical_dice"],
+            "pass_anat_qc": anatomical_metrics.loc[sub, "pass_qc"],
+        }
+    anat_qc = pd.DataFrame(pass_anat_qc).T
+    return pd.concat((functional_metrics, anat_qc), axis=1)
+
+
+def synthetic_metrics(n_identifiers: int, runs_per_subject: int = 4):
+    """Random functional and anatomical metrics."""
+    rng = np.random.default_rng(0)
+    n_subjects = max(1, n_identifiers // runs_per_subject)
+    subjects = [f"{i:06d}" for i in range(n_subjects)]
+    identifiers = [
+        f"sub-{subjects[i % n_subjects]}_task-rest_run-{i // n_subjects + 1}"
+        for i in range(n_identifiers)
+    ]
+    functional_metrics = pd.DataFrame(
+        {
+            "mean_fd_raw": rng.random(n_identifiers),
+            "mean_fd_scrubbed": rng.random(n_identifiers),
+            "proportion_kept": rng.random(n_identifiers),
+            "functional_dice": rng.random(n_identifiers),
+        },
+        index=identifiers,
+    )
+    anatomical_metrics = pd.DataFrame(
+        {"anatomical_dice": rng.random(n_subjects)}, index=subjects
+    )
+    anatomical_metrics["pass_qc"] = anatomical_metrics["anatomical_dice"] > 0.5
+    return functional_metrics, anatomical_metrics
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--n-identifiers", type=int, default=100_000)
+    args = parser.parse_args(argv)
+    functional_metrics, anatomical_metrics = synthetic_metrics(
+        args.n_identifiers
+    )
+
+    start = time.perf_counter()
+    loop_join(functional_metrics.copy(), anatomical_metrics)
+    print(f"          loop join: {time.perf_counter() - start:.3f} s")
+
+    start = time.perf_counter()
+    quality_accessments(
+        functional_metrics.copy(), anatomical_metrics, DEFAULT_QC_STANDARD
+    )
+    print(f"quality_accessments: {time.perf_counter() - start:.3f} s")
+
+
+if __name__ == "__main__":
+    main()
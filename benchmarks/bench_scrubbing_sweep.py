@@ -0,0 +1,69 @@
+"""Benchmark the scrubbing threshold sweep against the per-scan metrics.
+
+The framewise displacement series are generated in memory, so only the
+computation is timed: ``_motion_metrics`` for each scan and threshold,
+against ``FDArchive.sweep`` for all scans and thresholds at once.
+
+Usage:
+    python benchmarks/bench_scrubbing_sweep.py --n-scans 10000 \
+        --n-volumes 500 --thresholds 0.2 0.3 0.5
+"""
+import argparse
+import time
+import warnings
+
+import numpy as np
+
+from giga_auto_qc.assessments import _motion_metrics
+from giga_auto_qc.motion import FDArchive
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--n-scans", type=int, default=10000)
+    parser.add_argument("--n-volumes", type=int, default=500)
+    parser.add_argument(
+        "--thresholds", type=float, nargs="+", default=[0.2, 0.3, 0.5]
+    )
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(0)
+    archive = FDArchive()
+    for i in range(args.n_scans):
+        # runs of varying length, first volume missing as in fMRIPrep
+        n_volumes = rng.integers(args.n_volumes // 2, args.n_volumes + 1)
+        fd = rng.gamma(2, 0.08, n_volumes)
+        fd[0] = np.nan
+        archive.add(f"sub-{i:05d}_desc-confounds_timeseries.tsv", fd, (0, 0))
+
+    start = time.perf_counter()
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        expected = [
+            _motion_metrics(archive[identifier], threshold)
+            for identifier in archive.identifiers
+            for threshold in sorted(args.thresholds)
+        ]
+    elapsed = time.perf_counter() - start
+    n_items = args.n_scans * len(args.thresholds)
+    print(
+        f"{'_motion_metrics':>16}: {elapsed:.3f} s, "
+        f"{n_items / elapsed:,.0f} scan-thresholds/s"
+    )
+    start = time.perf_counter()
+    sweep = archive.sweep(args.thresholds)
+    elapsed = time.perf_counter() - start
+    print(
+        f"{'FDArchive.sweep':>16}: {elapsed:.3f} s, "
+        f"{n_items / elapsed:,.0f} scan-thresholds/s"
+    )
+    np.testing.assert_allclose(
+        sweep["proportion_kept"], [m["proportion_kept"] for m in expected]
+    )
+    np.testing.assert_allclose(
+        sweep["mean_fd_scrubbed"], [m["mean_fd_scrubbed"] for m in expected]
+    )
+
+
+if __name__ == "__main__":
+    main()
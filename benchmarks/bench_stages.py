@@ -0,0 +1,248 @@
+"""Time each stage of the workflow on a synthetic fMRIPrep derivative.
+
+Stages: layout indexing (pybids and fast indexers), get_reference_mask,
+calculate_anat_metrics, calculate_functional_metrics,
+quality_accessments and parse_scan_information. Each stage reports its
+wall time, throughput and peak RSS.
+
+Save the results with --output, and compare a later run against them
+with --baseline to catch regressions: the script exits with an error when
+a stage is slower than the baseline by more than --tolerance.
+
+Usage:
+    python benchmarks/bench_stages.py --n-subjects 50 --n-sessions 2 \
+        --tasks rest nback --func-resolution 2 3 --output baseline.json
+    python benchmarks/bench_stages.py --n-subjects 50 --n-sessions 2 \
+        --tasks rest nback --func-resolution 2 3 --baseline baseline.json
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import numpy as np
+import pandas as pd
+from bids import BIDSLayout
+
+from giga_auto_qc import assessments, utils
+from giga_auto_qc.cache import ReferenceMaskCache
+from giga_auto_qc.file_index import FileIndex
+from giga_auto_qc.profiling import peak_rss_mb, reset_peak_rss
+from giga_auto_qc.templates import TEMPLATE_MASK, template_cache_dir
+from giga_auto_qc.workflow import DEFAULT_QC_STANDARD
+
+import synthetic
+
+
+def run_stage(
+    results: List[dict], stage: str, function: Callable, unit: str
+) -> object:
+    """Time one stage; function returns its output and the number of
+    items processed."""
+    reset_peak_rss()
+    start = time.perf_counter()
+    output, n_items = function()
+    elapsed = time.perf_counter() - start
+    results.append(
+        {
+            "stage": stage,
+            "seconds": elapsed,
+            "items": n_items,
+            "throughput": n_items / elapsed if elapsed else float("inf"),
+            "unit": unit,
+            "peak_rss_mb": peak_rss_mb(),
+        }
+    )
+    print(
+        f"{stage:>40}: {elapsed:8.3f} s, "
+        f"{results[-1]['throughput']:10.1f} {unit}/s, "
+        f"peak RSS {results[-1]['peak_rss_mb']:8.1f} MB"
+    )
+    return output
+
+
+def benchmark(bids_dir: Path, args: argparse.Namespace) -> List[dict]:
+    """Run the stages of the workflow on a derivative."""
+    results = []
+    subjects = utils.get_subject_lists(None, bids_dir)
+
+    def index_pybids():
+        layout = BIDSLayout(
+            root=bids_dir,
+            database_path=bids_dir,
+            validate=False,
+            derivatives=True,
+            reset_database=True,
+        )
+        file_index = FileIndex.from_layout(layout, subjects, verbose=0)
+        return file_index, len(file_index)
+
+    def index_fast():
+        file_index = FileIndex.from_directory(bids_dir, subjects, verbose=0)
+        return file_index, len(file_index)
+
+    if not args.skip_pybids:
+        run_stage(results, "index (pybids)", index_pybids, "files")
+    file_index = run_stage(results, "index (fast)", index_fast, "files")
+    tasks = file_index.get_tasks()
+
+    reference_masks, _ = run_stage(
+        results,
+        f"get_reference_mask ({args.analysis_level})",
+        lambda: (
+            assessments.get_reference_mask(
+                args.analysis_level,
+                subjects,
+                tasks,
+                file_index,
+                verbose=0,
+                n_jobs=args.n_jobs,
+            ),
+            len(subjects),
+        ),
+        "subjects",
+    )
+    reference_cache = ReferenceMaskCache()
+    anatomical_metrics = run_stage(
+        results,
+        "calculate_anat_metrics",
+        lambda: (
+            assessments.calculate_anat_metrics(
+                subjects,
+                file_index,
+                reference_masks,
+                DEFAULT_QC_STANDARD,
+                verbose=0,
+                reference_cache=reference_cache,
+                n_jobs=args.n_jobs,
+            ),
+            len(subjects),
+        ),
+        "subjects",
+    )
+
+    def functional_metrics():
+        metrics = pd.concat(
+            [
+                assessments.calculate_functional_metrics(
+                    subjects,
+                    task,
+                    file_index,
+                    reference_masks,
+                    DEFAULT_QC_STANDARD,
+                    verbose=0,
+                    reference_cache=reference_cache,
+                    n_jobs=args.n_jobs,
+                )
+                for task in tasks
+            ]
+        )
+        return metrics, len(metrics)
+
+    metrics = run_stage(
+        results, "calculate_functional_metrics", functional_metrics, "scans"
+    )
+    metrics = run_stage(
+        results,
+        "quality_accessments",
+        lambda: (
+            assessments.quality_accessments(
+                metrics, anatomical_metrics, DEFAULT_QC_STANDARD
+            ),
+            len(metrics),
+        ),
+        "scans",
+    )
+    run_stage(
+        results,
+        "parse_scan_information",
+        lambda: (utils.parse_scan_information(metrics), len(metrics)),
+        "scans",
+    )
+    return results
+
+
+def compare(
+    results: List[dict], baseline: List[dict], tolerance: float
+) -> List[str]:
+    """Stages slower than the baseline by more than the tolerance."""
+    baseline_seconds: Dict[str, float] = {
+        r["stage"]: r["seconds"] for r in baseline
+    }
+    regressions = []
+    for result in results:
+        reference = baseline_seconds.get(result["stage"])
+        if reference and result["seconds"] > reference * tolerance:
+            regressions.append(
+                f"{result['stage']}: {result['seconds']:.3f} s, "
+                f"baseline {reference:.3f} s"
+            )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    synthetic.add_arguments(parser)
+    parser.add_argument(
+        "--analysis-level", choices=["participant", "group"], default="group"
+    )
+    parser.add_argument("--n-jobs", type=int, default=1)
+    parser.add_argument(
+        "--skip-pybids",
+        action="store_true",
+        help="Do not time the pybids indexer, slow on large datasets.",
+    )
+    parser.add_argument(
+        "--bids-dir",
+        type=Path,
+        help="Benchmark an existing derivative instead of generating one.",
+    )
+    parser.add_argument("--output", type=Path, help="Save results as json.")
+    parser.add_argument(
+        "--baseline", type=Path, help="Results of a previous run (json)."
+    )
+    parser.add_argument("--tolerance", type=float, default=1.5)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        # the template lives in the local template cache, no TemplateFlow
+        os.environ["GIGA_AUTO_QC_TEMPLATE_CACHE"] = str(tmp_dir / "templates")
+        template_cache_dir().mkdir()
+        synthetic.brain_mask(1, np.random.default_rng(0)).to_filename(
+            template_cache_dir() / TEMPLATE_MASK
+        )
+        bids_dir = args.bids_dir
+        if bids_dir is None:
+            start = time.perf_counter()
+            bids_dir = synthetic.from_arguments(tmp_dir / "fmriprep", args)
+            print(
+                f"Generated the derivative in "
+                f"{time.perf_counter() - start:.1f} s."
+            )
+        results = benchmark(bids_dir, args)
+
+    if args.n_jobs != 1:
+        print(
+            "Peak RSS of the worker processes: "
+            f"{peak_rss_mb(children=True):.1f} MB"
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            sys.exit("Slower than the baseline:\n" + "\n".join(regressions))
+        print("No regression against the baseline.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""Generate synthetic fMRIPrep derivatives for the benchmarks.
+
+The tree has the layout of fMRIPrep outputs in MNI152NLin2009cAsym space:
+one anatomical brain mask per subject, and one functional brain mask and
+confounds file per run. Masks are ellipsoids jittered per scan, so the
+dice coefficients vary like in real data.
+
+Usage:
+    python benchmarks/synthetic.py /tmp/fmriprep --n-subjects 100 \
+        --n-sessions 2 --tasks rest nback --n-runs 2 --func-resolution 2 3
+"""
+import argparse
+import json
+from pathlib import Path
+from typing import Sequence, Tuple
+
+import numpy as np
+import nibabel as nib
+
+from giga_auto_qc.templates import TEMPLATE
+
+# shape and origin of the 1 mm MNI152NLin2009cAsym grid
+TEMPLATE_SHAPE = (193, 229, 193)
+TEMPLATE_ORIGIN = (-96.0, -132.0, -78.0)
+
+
+def template_affine(resolution: float) -> np.ndarray:
+    """Affine of the template space at an isotropic resolution (mm)."""
+    affine = np.diag([resolution, resolution, resolution, 1.0])
+    affine[:3, 3] = TEMPLATE_ORIGIN
+    return affine
+
+
+def template_shape(resolution: float) -> Tuple[int, ...]:
+    """Shape of the template space at an isotropic resolution (mm)."""
+    shape = np.ceil(np.array(TEMPLATE_SHAPE) / resolution)
+    return tuple(int(s) for s in shape)
+
+
+def brain_mask(
+    resolution: float, rng: np.random.Generator, jitter: float = 0.02
+) -> nib.Nifti1Image:
+    """Ellipsoid brain mask in template space, with random jitter of the
+    radii."""
+    shape = template_shape(resolution)
+    affine = template_affine(resolution)
+    radii = np.array([70.0, 95.0, 70.0]) * (1 + rng.normal(0, jitter, 3))
+    centre = np.array([0.0, -18.0, 8.0])
+    # separable ellipsoid equation on the voxel coordinates of each axis
+    x, y, z = (
+        ((np.arange(n) * resolution + origin - c) / r) ** 2
+        for n, origin, c, r in zip(shape, affine[:3, 3], centre, radii)
+    )
+    inside = x[:, None, None] + y[None, :, None] + z[None, None, :] <= 1
+    return nib.Nifti1Image(inside.astype(np.uint8), affine, dtype=np.uint8)
+
+
+def write_confounds(
+    path: Path, n_volumes: int, n_columns: int, rng: np.random.Generator
+) -> None:
+    """Write a fMRIPrep-like confounds file; the first FD value is n/a."""
+    columns = [f"a_comp_cor_{i:02d}" for i in range(n_columns - 1)]
+    position = min(10, len(columns))
+    columns.insert(position, "framewise_displacement")
+    values = rng.random((n_volumes, n_columns))
+    values[:, position] *= 0.5
+    lines = ["\t".join(columns)]
+    for t, row in enumerate(values):
+        cells = [f"{v:.6f}" for v in row]
+        if t == 0:
+            cells[position] = "n/a"
+        lines.append("\t".join(cells))
+    path.write_text("\n".join(lines) + "\n")
+
+
+def create_derivative(
+    root: Path,
+    n_subjects: int = 10,
+    n_sessions: int = 1,
+    tasks: Sequence[str] = ("rest",),
+    n_runs: int = 2,
+    anat_resolution: float = 1,
+    func_resolutions: Sequence[float] = (2,),
+    n_volumes: int = 300,
+    n_columns: int = 200,
+    seed: int = 0,
+) -> Path:
+    """
+    Write a synthetic fMRIPrep derivative.
+
+    Parameters
+    ----------
+
+    root :
+        Directory of the derivative.
+
+    n_subjects :
+        Number of subjects.
+
+    n_sessions :
+        Number of sessions per subject. With one session, the files have
+        no session entity.
+
+    tasks :
+        Task names; each session has every task.
+
+    n_runs :
+        Number of runs per task.
+
+    anat_resolution :
+        Voxel size (mm) of the anatomical masks.
+
+    func_resolutions :
+        Voxel sizes (mm) of the functional masks, used in turn across
+        runs so a dataset can mix several grids.
+
+    n_volumes :
+        Number of volumes in the confounds files.
+
+    n_columns :
+        Number of columns in the confounds files.
+
+    seed :
+        Seed of the random generator.
+
+    Return
+    ------
+    pathlib.Path
+        Directory of the derivative.
+    """
+    rng = np.random.default_rng(seed)
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    with open(root / "dataset_description.json", "w") as f:
+        json.dump(
+            {
+                "Name": "synthetic",
+                "BIDSVersion": "1.4.0",
+                "DatasetType": "derivative",
+            },
+            f,
+        )
+    sessions = [f"ses-{i}" for i in range(1, n_sessions + 1)]
+    if n_sessions == 1:
+        sessions = [None]
+    scan = 0
+    for i in range(1, n_subjects + 1):
+        sub = f"sub-{i:04d}"
+        anat_dir = root / sub / "anat"
+        anat_dir.mkdir(parents=True, exist_ok=True)
+        brain_mask(anat_resolution, rng, jitter=0.005).to_filename(
+            anat_dir / f"{sub}_space-{TEMPLATE}_desc-brain_mask.nii.gz"
+        )
+        for ses in sessions:
+            func_dir = root / sub / (ses or "") / "func"
+            func_dir.mkdir(parents=True, exist_ok=True)
+            for task in tasks:
+                for run in range(1, n_runs + 1):
+                    prefix = "_".join(
+                        e
+                        for e in (sub, ses, f"task-{task}", f"run-{run}")
+                        if e
+                    )
+                    resolution = func_resolutions[scan % len(func_resolutions)]
+                    scan += 1
+                    brain_mask(resolution, rng).to_filename(
+                        func_dir
+                        / f"{prefix}_space-{TEMPLATE}_desc-brain_mask.nii.gz"
+                    )
+                    write_confounds(
+                        func_dir / f"{prefix}_desc-confounds_timeseries.tsv",
+                        n_volumes,
+                        n_columns,
+                        rng,
+                    )
+    return root
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """Options describing the synthetic derivative."""
+    parser.add_argument("--n-subjects", type=int, default=10)
+    parser.add_argument("--n-sessions", type=int, default=1)
+    parser.add_argument("--tasks", nargs="+", default=["rest"])
+    parser.add_argument("--n-runs", type=int, default=2)
+    parser.add_argument("--anat-resolution", type=float, default=1)
+    parser.add_argument(
+        "--func-resolution", type=float, nargs="+", default=[2]
+    )
+    parser.add_argument("--n-volumes", type=int, default=300)
+    parser.add_argument("--n-columns", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def from_arguments(root: Path, args: argparse.Namespace) -> Path:
+    """Write the synthetic derivative described by the options."""
+    return create_derivative(
+        root,
+        n_subjects=args.n_subjects,
+        n_sessions=args.n_sessions,
+        tasks=args.tasks,
+        n_runs=args.n_runs,
+        anat_resolution=args.anat_resolution,
+        func_resolutions=args.func_resolution,
+        n_volumes=args.n_volumes,
+        n_columns=args.n_columns,
+        seed=args.seed,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("root", type=Path)
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    from_arguments(args.root, args)
+
+
+if __name__ == "__main__":
+    main()
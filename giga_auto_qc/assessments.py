@@ -1,26 +1,72 @@
-from typing import Union, List, Tuple, Optional
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Iterable,
+    Iterator,
+    Union,
+    List,
+    Tuple,
+    Optional,
+)
 
 from pathlib import Path
 from tqdm import tqdm
 import numpy as np
 import pandas as pd
 
+import nibabel as nib
 from nibabel import Nifti1Image
 
-from nilearn.image import load_img, resample_to_img
-from nilearn.masking import intersect_masks, _load_mask_img
-
-from bids import BIDSLayout
-
-TEMPLATE = "MNI152NLin2009cAsym"
+from nilearn.image import (
+    largest_connected_component_img,
+    load_img,
+    new_img_like,
+)
+
+from giga_auto_qc.cache import (
+    PackedMask,
+    PackedMaskCache,
+    PackedMaskStore,
+    ReferenceMaskCache,
+    _overlap,
+    _resample_reference,
+)
+from giga_auto_qc.file_index import FileIndex, parse_bids_filename
+from giga_auto_qc.motion import FDArchive, fd_identifier
+from giga_auto_qc.profiling import StageProfiler
+from giga_auto_qc.store import MetricsStore
+from giga_auto_qc.templates import TEMPLATE, get_template_mask
+
+if TYPE_CHECKING:
+    from bids import BIDSLayout
+
+FD_MISSING_VALUES = {"", "n/a", "N/A", "NA"}
+
+# masks of a grid scored together by the batched dice
+DICE_BATCH_SIZE = 64
+# columns of the functional metrics
+FUNCTIONAL_METRICS = [
+    "mean_fd_raw",
+    "mean_fd_scrubbed",
+    "proportion_kept",
+    "functional_dice",
+]
 
 
 def get_reference_mask(
     analysis_level: str,
     subjects: List[str],
     task: List[str],
-    fmriprep_bids_layout: BIDSLayout,
+    fmriprep_bids_layout: Union["BIDSLayout", FileIndex],
     verbose: int = 1,
+    n_jobs: int = 1,
+    sessions: Optional[List[str]] = None,
+    mask_cache: Optional[PackedMaskCache] = None,
+    mask_store: Optional[PackedMaskStore] = None,
 ) -> Tuple[dict, Optional[dict]]:
     """
     Find the correct target mask for dice coefficient.
@@ -38,11 +84,25 @@ def get_reference_mask(
         Task name in a BIDS dataset.
 
     fmriprep_bids_layout :
-        BIDS layout of a fMRIPrep derivative.
+        BIDS layout or file index of a fMRIPrep derivative.
 
     verbose :
         Level of verbosity.
 
+    n_jobs :
+        Number of processes building the group mask. -1 uses all CPUs.
+
+    sessions :
+        Session labels to include. Default to all sessions.
+
+    mask_cache :
+        Keeps the functional masks read for the group mask, so the dice
+        stage does not read them again.
+
+    mask_store :
+        Packed masks saved on disk by previous runs. Stored masks are
+        memory-mapped instead of read, and the others are saved.
+
     Returns
     -------
 
@@ -55,11 +115,7 @@ def get_reference_mask(
         be included in the dictionary. If all scans have the same
         affine, return None.
     """
-    import templateflow
-
-    template_mask = templateflow.api.get(
-        [TEMPLATE], desc="brain", suffix="mask", resolution="01"
-    )
+    template_mask = get_template_mask()
     reference_masks = {"anat": template_mask}
     if verbose > 0:
         print("Retrieved anatomical reference mask")
@@ -77,6 +133,8 @@ def get_reference_mask(
             "extension": "nii.gz",
             "datatype": "func",
         }
+        if sessions:
+            func_filter["session"] = sessions
         func_masks = fmriprep_bids_layout.get(
             **func_filter, return_type="file"
         )
@@ -92,7 +150,13 @@ def get_reference_mask(
                 print(f"Remaining: {len(func_masks)} masks")
         else:
             weird_mask_identifiers_by_task = None
-        group_func_map = intersect_masks(func_masks, threshold=0.5)
+        group_func_map = _group_mask(
+            func_masks,
+            threshold=0.5,
+            n_jobs=n_jobs,
+            mask_cache=mask_cache,
+            mask_store=mask_store,
+        )
         reference_masks["func"] = group_func_map
     else:
         if verbose > 0:
@@ -102,6 +166,200 @@ def get_reference_mask(
     return reference_masks, weird_mask_identifiers_by_task
 
 
+def _group_mask(
+    mask_imgs: List[Union[Path, str]],
+    threshold: float = 0.5,
+    n_jobs: int = 1,
+    atol: float = 1e-4,
+    mask_cache: Optional[PackedMaskCache] = None,
+    mask_store: Optional[PackedMaskStore] = None,
+) -> Nifti1Image:
+    """Threshold-level intersection of masks, loading one mask at a time.
+
+    Gives the same result as
+    ``nilearn.masking.intersect_masks(mask_imgs, threshold)``, but only
+    keeps a per-voxel count of the masks in memory. With n_jobs > 1, the
+    masks are split in chunks counted in separate processes and the counts
+    are summed.
+
+    Parameters
+    ----------
+
+    mask_imgs :
+        Paths to 3D masks with the same shape and affine.
+
+    threshold :
+        Gives the level of the intersection, must be within [0, 1].
+
+    n_jobs :
+        Number of processes. -1 uses all CPUs.
+
+    atol :
+        Absolute tolerance for two affine matrices to be considered the same.
+
+    mask_cache :
+        Receives the masks read, packed, for reuse by later stages, up to
+        its memory budget.
+
+    mask_store :
+        Packed masks saved on disk by previous runs. Stored masks are
+        counted from the memory-mapped bits, one at a time, and are not
+        kept in mask_cache: each map holds a file descriptor, and the dice
+        stage maps them again. The others are read and saved as they are
+        read.
+
+    Returns
+    -------
+    nibabel.Nifti1Image
+        Intersection of all masks.
+    """
+    if len(mask_imgs) == 0:
+        raise ValueError("No mask provided for intersection")
+    if not 0 <= threshold <= 1:
+        raise ValueError("The threshold should be within [0, 1]")
+    threshold = min(threshold, 1 - 1.0e-7)
+    chunk_counts, read_imgs = [], []
+
+    def stored_masks():
+        for mask_img in mask_imgs:
+            packed_mask = mask_store.load(mask_img)
+            if packed_mask is None:
+                read_imgs.append(mask_img)
+            else:
+                yield packed_mask
+
+    if mask_store is not None:
+        count, ref_affine = _count_packed_masks(stored_masks(), atol)
+        if count is not None:
+            chunk_counts.append((count, ref_affine, []))
+    else:
+        read_imgs = mask_imgs
+    n_chunks = os.cpu_count() if n_jobs < 0 else n_jobs
+    chunks = [
+        chunk.tolist()
+        for chunk in np.array_split(
+            np.array(read_imgs, dtype=object), n_chunks
+        )
+        if len(chunk)
+    ]
+    # the memory budget of the cache is shared by the chunks, so at most
+    # the budget of packed masks is held at a time
+    pack_bytes = 0
+    if mask_cache is not None and chunks:
+        pack_bytes = mask_cache.available_bytes / len(chunks)
+    chunk_counts += _map_scans(
+        partial(
+            _count_masks,
+            atol=atol,
+            pack_bytes=pack_bytes,
+            mask_store=mask_store,
+        ),
+        chunks,
+        n_jobs,
+    )
+    if mask_cache is not None:
+        first = len(chunk_counts) - len(chunks)
+        for chunk, (_, _, packed_masks) in zip(chunks, chunk_counts[first:]):
+            for mask_img, packed_mask in zip(chunk, packed_masks):
+                mask_cache.add(mask_img, packed_mask)
+    count, ref_affine, _ = chunk_counts[0]
+    for chunk_count, affine, _ in chunk_counts[1:]:
+        if not np.allclose(affine, ref_affine, rtol=0, atol=atol):
+            raise ValueError("All masks should have the same affine")
+        if chunk_count.shape != count.shape:
+            raise ValueError("All masks should have the same shape")
+        count += chunk_count
+
+    group_mask = count > (threshold * len(mask_imgs))
+    group_mask_img = new_img_like(
+        load_img(mask_imgs[0]), group_mask.astype(np.int8), ref_affine
+    )
+    if np.any(group_mask):
+        group_mask_img = largest_connected_component_img(group_mask_img)
+    return group_mask_img
+
+
+def _count_masks(
+    mask_imgs: List[Union[Path, str]],
+    atol: float = 1e-4,
+    pack_bytes: float = 0,
+    mask_store: Optional[PackedMaskStore] = None,
+) -> Tuple[np.ndarray, np.ndarray, List[PackedMask]]:
+    """Per-voxel count of the masks covering each voxel.
+
+    Parameters
+    ----------
+
+    mask_imgs :
+        Paths to 3D masks with the same shape and affine.
+
+    atol :
+        Absolute tolerance for two affine matrices to be considered the same.
+
+    pack_bytes :
+        Also return the first masks, packed, up to this size in bytes.
+
+    mask_store :
+        Receives each mask, packed, as soon as it is read.
+
+    Returns
+    -------
+    numpy.ndarray
+        Number of masks including each voxel.
+
+    numpy.ndarray
+        Affine of the masks.
+
+    List of PackedMask
+        Packed masks of the first mask_imgs, in input order.
+    """
+    count, ref_affine, packed_masks = None, None, []
+    for path in mask_imgs:
+        mask_img = nib.load(path)
+        mask = np.asanyarray(mask_img.dataobj) != 0
+        if count is None:
+            count = np.zeros(mask.shape, dtype=np.uint32)
+            ref_affine = mask_img.affine
+        if not np.allclose(mask_img.affine, ref_affine, rtol=0, atol=atol):
+            raise ValueError("All masks should have the same affine")
+        if mask.shape != count.shape:
+            raise ValueError("All masks should have the same shape")
+        count += mask
+        if mask_store is None and pack_bytes <= 0:
+            continue
+        packed_mask = PackedMask.pack(mask, mask_img.affine)
+        if mask_store is not None:
+            mask_store.save(path, packed_mask)
+        # stop packing once the budget is full, the masks are returned in
+        # input order
+        if packed_mask.bits.nbytes <= pack_bytes:
+            packed_masks.append(packed_mask)
+            pack_bytes -= packed_mask.bits.nbytes
+        else:
+            pack_bytes = 0
+    return count, ref_affine, packed_masks
+
+
+def _count_packed_masks(
+    packed_masks: Iterable[PackedMask], atol: float = 1e-4
+) -> Tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+    """Per-voxel count of packed masks, and their affine, counting one mask
+    at a time. None when there is no mask."""
+    count, ref_affine = None, None
+    for packed_mask in packed_masks:
+        if count is None:
+            count = np.zeros(packed_mask.shape, dtype=np.uint32)
+            ref_affine = packed_mask.affine
+        if not np.allclose(packed_mask.affine, ref_affine, rtol=0, atol=atol):
+            raise ValueError("All masks should have the same affine")
+        if packed_mask.shape != count.shape:
+            raise ValueError("All masks should have the same shape")
+        # only the voxels in the bounding box are unpacked and counted
+        mask, voxel_box = packed_mask.unpack_box()
+        count[voxel_box] += mask
+    return count, ref_affine
+
+
 def _get_consistent_masks(
     mask_imgs: List[Union[Path, str, Nifti1Image]], exclude: List[int]
 ) -> Tuple[List[int], dict]:
@@ -144,11 +402,15 @@ def _get_consistent_masks(
 
 
 def _check_mask_affine(
-    mask_imgs: List[Union[Path, str, Nifti1Image]], verbose: int = 1
+    mask_imgs: List[Union[Path, str, Nifti1Image]],
+    verbose: int = 1,
+    atol: float = 1e-4,
 ) -> Union[list, None]:
     """Given a list of input mask images, show the most common affine matrix
     and subjects with different values.
 
+    Only the NIfTI headers are read, the voxel data are not loaded.
+
     Parameters
     ----------
     mask_imgs : :obj:`list` of Niimg-like objects
@@ -158,6 +420,9 @@ def _check_mask_affine(
     verbose :
         Level of verbosity.
 
+    atol :
+        Absolute tolerance for two affine matrices to be considered the same.
+
     Returns
     -------
 
@@ -169,11 +434,12 @@ def _check_mask_affine(
     header_info = {"affine": []}
     key_to_header = {}
     for this_mask in mask_imgs:
-        _, affine = _load_mask_img(this_mask, allow_empty=True)
-        affine_hashable = str(affine)
+        if not isinstance(this_mask, Nifti1Image):
+            this_mask = nib.load(this_mask)
+        affine_hashable = _affine_key(this_mask.affine, key_to_header, atol)
         header_info["affine"].append(affine_hashable)
         if affine_hashable not in key_to_header:
-            key_to_header[affine_hashable] = affine
+            key_to_header[affine_hashable] = this_mask.affine
 
     if isinstance(mask_imgs[0], Nifti1Image):
         mask_imgs = np.arange(len(mask_imgs))
@@ -213,13 +479,48 @@ def _check_mask_affine(
     return sorted(exclude)
 
 
+def _affine_key(affine: np.ndarray, known_affines: dict, atol: float) -> int:
+    """Key of the known affine matching the input within tolerance.
+
+    Parameters
+    ----------
+
+    affine :
+        Affine matrix to look up.
+
+    known_affines :
+        Affine matrices seen so far, indexed by their key.
+
+    atol :
+        Absolute tolerance for two affine matrices to be considered the same.
+
+    Returns
+    -------
+    int
+        Key of the matching affine, or a new key if none matches.
+    """
+    for key, known_affine in known_affines.items():
+        if np.allclose(affine, known_affine, rtol=0, atol=atol):
+            return key
+    return len(known_affines)
+
+
 def calculate_functional_metrics(
     subjects: List[str],
     task: List[str],
-    fmriprep_bids_layout: BIDSLayout,
+    fmriprep_bids_layout: Union["BIDSLayout", FileIndex],
     reference_masks: dict,
     qulaity_control_standards: dict,
     verbose: int = 1,
+    reference_cache: Optional[ReferenceMaskCache] = None,
+    n_jobs: int = 1,
+    metrics_store: Optional[MetricsStore] = None,
+    profiler: Optional[StageProfiler] = None,
+    prefetch: int = 0,
+    sessions: Optional[List[str]] = None,
+    mask_cache: Optional[PackedMaskCache] = None,
+    fd_archive: Optional[FDArchive] = None,
+    mask_store: Optional[PackedMaskStore] = None,
 ) -> pd.DataFrame:
     """
     Calculate functional scan quality metrics:
@@ -239,16 +540,59 @@ def calculate_functional_metrics(
         Task name in a BIDS dataset.
 
     fmriprep_bids_layout :
-        BIDS layout of a fMRIPrep derivative.
+        BIDS layout or file index of a fMRIPrep derivative.
 
     reference_masks :
         Reference brain masks for anatomical and functional scans.
 
+    reference_cache :
+        Cache of the reference masks resampled to the functional grids.
+
+    n_jobs :
+        Number of processes computing the metrics. -1 uses all CPUs.
+
+    metrics_store :
+        Dice computed in previous runs. Only new or modified masks are
+        processed. The motion metrics are reused through fd_archive.
+
+    profiler :
+        Records the time spent on framewise displacement and dice.
+
+    prefetch :
+        Number of files read ahead by a thread pool while the current
+        scans are scored. 0 reads the files one at a time.
+
+    sessions :
+        Session labels to include. Default to all sessions.
+
+    mask_cache :
+        Functional masks read by an earlier stage, scored without reading
+        the files again.
+
+    fd_archive :
+        Receives the framewise displacement series of the scans, e.g. to
+        sweep scrubbing thresholds later. The motion metrics are computed
+        from the series in the archive; the series of unchanged confounds
+        files are reused from the archive of a previous run, if any.
+
+    mask_store :
+        Packed masks saved on disk by previous runs. Stored masks are
+        memory-mapped instead of read, and the others are saved.
+
     Returns
     -------
     pandas.DataFrame
-        Functional scan quality metrics
+        Functional scan quality metrics. Empty, with the metric columns,
+        when there is no subject, e.g. for an empty shard.
     """
+    if not subjects:
+        return pd.DataFrame(columns=FUNCTIONAL_METRICS, dtype=float)
+    if reference_cache is None:
+        reference_cache = ReferenceMaskCache()
+    if profiler is None:
+        profiler = StageProfiler()
+    if fd_archive is None:
+        fd_archive = FDArchive()
     metrics = {}
 
     confounds_filter = {
@@ -257,31 +601,32 @@ def calculate_functional_metrics(
         "desc": "confounds",
         "extension": "tsv",
     }
+    if sessions:
+        confounds_filter["session"] = sessions
 
     confounds = fmriprep_bids_layout.get(
         **confounds_filter, return_type="file"
     )
     if verbose > 0:
         print("Calculate motion QC...")
-    for confound_file in tqdm(confounds):
-        # compute fds score
-        framewise_displacements = pd.read_csv(confound_file, sep="\t")[
-            "framewise_displacement"
-        ].to_numpy()
-        timeseries_length = len(framewise_displacements)
-        fds_mean_raw = np.nanmean(framewise_displacements)
-        kept_volumes = (
-            framewise_displacements < qulaity_control_standards["scrubbing_fd"]
+    scrubbing_fd = qulaity_control_standards["scrubbing_fd"]
+    with profiler.stage("fd", task=task) as record:
+        framewise_displacements = fd_archive.map(
+            confounds,
+            partial(
+                _map_scans,
+                None,
+                n_jobs=n_jobs,
+                load=_read_framewise_displacement,
+                prefetch=prefetch,
+            ),
         )
-        fds_mean_scrub = np.nanmean(framewise_displacements[kept_volumes])
-        proportion_kept = sum(kept_volumes) / timeseries_length
-        identifier = Path(confound_file).name.split("_desc-confounds")[0]
-
-        metrics[identifier] = {
-            "mean_fd_raw": fds_mean_raw,
-            "mean_fd_scrubbed": fds_mean_scrub,
-            "proportion_kept": proportion_kept,
-        }
+        motion_metrics = [
+            _motion_metrics(fd, scrubbing_fd) for fd in framewise_displacements
+        ]
+        record["items"] = len(confounds)
+    for confound_file, motion in zip(confounds, motion_metrics):
+        metrics[fd_identifier(confound_file)] = motion
 
     func_filter = {
         "subject": subjects,
@@ -292,50 +637,114 @@ def calculate_functional_metrics(
         "extension": "nii.gz",
         "datatype": "func",
     }
+    if sessions:
+        func_filter["session"] = sessions
     func_images = fmriprep_bids_layout.get(**func_filter, return_type="file")
     if verbose > 0:
         print("Calculate EPI mask dice...")
-    for func_file in tqdm(func_images):
+    with profiler.stage("dice", task=task) as record:
+        functional_dice = _stored_map(
+            metrics_store,
+            "dice",
+            reference_cache.reference_identity(reference_masks["func"]),
+            func_images,
+            partial(
+                _map_dice,
+                template_mask=reference_masks["func"],
+                reference_cache=reference_cache,
+                n_jobs=n_jobs,
+                prefetch=prefetch,
+                mask_cache=mask_cache,
+                mask_store=mask_store,
+            ),
+        )
+        record["items"] = len(func_images)
+    for func_file, dice in zip(func_images, functional_dice):
         identifier = Path(func_file).name.split(f"_space-{TEMPLATE}")[0]
-        functional_dice = _dice_coefficient(func_file, reference_masks["func"])
         if identifier in metrics:
-            metrics[identifier].update({"functional_dice": functional_dice})
+            metrics[identifier].update({"functional_dice": dice})
         else:
-            metrics[identifier] = {"functional_dice": functional_dice}
+            metrics[identifier] = {"functional_dice": dice}
     metrics = pd.DataFrame(metrics).T
     return metrics.sort_index()
 
 
 def calculate_anat_metrics(
     subjects: List[str],
-    fmriprep_bids_layout: BIDSLayout,
+    fmriprep_bids_layout: Union["BIDSLayout", FileIndex],
     reference_masks: dict,
     qulaity_control_standards: dict,
     verbose: int = 1,
+    reference_cache: Optional[ReferenceMaskCache] = None,
+    n_jobs: int = 1,
+    metrics_store: Optional[MetricsStore] = None,
+    prefetch: int = 0,
+    sessions: Optional[List[str]] = None,
+    mask_store: Optional[PackedMaskStore] = None,
 ) -> pd.DataFrame:
     """
     Calculate the anatomical dice score.
 
+    Each subject has a score for its subject level anatomical mask, or
+    its first mask in the selected sessions when fMRIPrep only produced
+    session specific masks. Session specific masks are also scored,
+    indexed by ``<subject>_ses-<session>``, so functional scans are
+    assessed against the anatomical mask of their own session when it
+    exists. A subject without any mask has no score and fails the quality
+    control.
+
     Parameters
     ----------
     subjects :
         Participant IDs in a BIDS dataset.
 
     fmriprep_bids_layout :
-        BIDS layout of a fMRIPrep derivative.
+        BIDS layout or file index of a fMRIPrep derivative.
 
     reference_masks :
         Reference brain masks for anatomical and functional scans.
 
+    reference_cache :
+        Cache of the reference masks resampled to the anatomical grids.
+
+    n_jobs :
+        Number of processes computing the metrics. -1 uses all CPUs.
+
+    metrics_store :
+        Metrics computed in previous runs. Only new or modified files are
+        processed.
+
+    prefetch :
+        Number of masks read ahead by a thread pool while the current
+        masks are scored. 0 reads the masks one at a time.
+
+    sessions :
+        Session labels of the session specific masks to include. Only the
+        masks of these sessions are read. Default to all sessions.
+
+    mask_store :
+        Packed masks saved on disk by previous runs. Stored masks are
+        memory-mapped instead of read, and the others are saved.
+
     Returns
     -------
     pandas.DataFrame
-        Anatomical scan dice score scan quality metrics.
+        Anatomical scan dice score scan quality metrics. Empty, with the
+        metric columns, when there is no subject, e.g. for an empty shard.
     """
+    if not subjects:
+        return pd.DataFrame(
+            {
+                "anatomical_dice": pd.Series(dtype=float),
+                "pass_qc": pd.Series(dtype=bool),
+            }
+        )
+    if reference_cache is None:
+        reference_cache = ReferenceMaskCache()
     if verbose > 0:
         print("Calculate the anatomical dice score.")
-    metrics = {}
-    for sub in tqdm(subjects):
+    anat_images = {}
+    for sub in subjects:
         anat_filter = {
             "subject": sub,
             "space": TEMPLATE,
@@ -344,14 +753,47 @@ def calculate_anat_metrics(
             "extension": "nii.gz",
             "datatype": "anat",
         }
+        if sessions:
+            # subject level masks have no session
+            anat_filter["session"] = [*sessions, None]
         anat_image = fmriprep_bids_layout.get(
             **anat_filter, return_type="file"
         )
-        # dice
-        anat_dice = _dice_coefficient(anat_image[0], reference_masks["anat"])
-        metrics[sub] = {
-            "anatomical_dice": anat_dice,
+        if not anat_image:
+            if verbose > 0:
+                print(f"No anatomical mask for sub-{sub}.")
+            anat_images[sub] = None
+            continue
+        by_session = {
+            parse_bids_filename(f).get("session"): f for f in anat_image
         }
+        anat_images[sub] = by_session.get(None, anat_image[0])
+        for ses, image in by_session.items():
+            if ses is not None:
+                anat_images[f"{sub}_ses-{ses}"] = image
+    # dice, once per file
+    unique_images = sorted(
+        {image for image in anat_images.values() if image is not None}
+    )
+    anat_dice = _stored_map(
+        metrics_store,
+        "dice",
+        reference_cache.reference_identity(reference_masks["anat"]),
+        unique_images,
+        partial(
+            _map_dice,
+            template_mask=reference_masks["anat"],
+            reference_cache=reference_cache,
+            n_jobs=n_jobs,
+            prefetch=prefetch,
+            mask_store=mask_store,
+        ),
+    )
+    dice_by_image = dict(zip(unique_images, anat_dice))
+    metrics = {
+        key: {"anatomical_dice": dice_by_image.get(image, np.nan)}
+        for key, image in anat_images.items()
+    }
     metrics = pd.DataFrame(metrics).T
     metrics["pass_qc"] = (
         metrics["anatomical_dice"]
@@ -360,6 +802,293 @@ def calculate_anat_metrics(
     return metrics.sort_index()
 
 
+def _motion_metrics(
+    framewise_displacements: np.ndarray, scrubbing_fd: float
+) -> dict:
+    """Framewise displacement metrics of one functional scan.
+
+    Parameters
+    ----------
+
+    framewise_displacements :
+        Framewise displacement per volume, read from the confounds file.
+
+    scrubbing_fd :
+        Framewise displacement threshold (mm) for scrubbing.
+
+    Returns
+    -------
+    dict
+        Mean framewise displacement before and after scrubbing, and the
+        proportion of volumes kept.
+    """
+    timeseries_length = len(framewise_displacements)
+    fds_mean_raw = np.nanmean(framewise_displacements)
+    kept_volumes = framewise_displacements < scrubbing_fd
+    fds_mean_scrub = np.nanmean(framewise_displacements[kept_volumes])
+    proportion_kept = sum(kept_volumes) / timeseries_length
+    return {
+        "mean_fd_raw": fds_mean_raw,
+        "mean_fd_scrubbed": fds_mean_scrub,
+        "proportion_kept": proportion_kept,
+    }
+
+
+def _read_framewise_displacement(
+    confound_file: Union[str, Path]
+) -> np.ndarray:
+    """Read the framewise displacement column of a fMRIPrep confounds file.
+
+    Only the header and the framewise displacement field of each row are
+    parsed, the other columns (CompCor, cosine, etc.) are skipped.
+
+    Parameters
+    ----------
+
+    confound_file :
+        Path to the fMRIPrep confounds file.
+
+    Returns
+    -------
+    numpy.ndarray
+        Framewise displacement per volume, with NaN for missing values.
+    """
+    with open(confound_file, "r") as f:
+        header = f.readline().rstrip("\r\n").split("\t")
+        if "framewise_displacement" not in header:
+            raise KeyError(
+                f"No framewise_displacement column in {confound_file}."
+            )
+        column = header.index("framewise_displacement")
+        values = [
+            line.split("\t", column + 1)[column].strip()
+            for line in f
+            if line.strip()
+        ]
+    return np.array(
+        [np.nan if v in FD_MISSING_VALUES else float(v) for v in values]
+    )
+
+
+def _stored_map(
+    metrics_store: Optional[MetricsStore],
+    kind: str,
+    parameters: str,
+    paths: List[Union[str, Path]],
+    compute: Callable[[list], list],
+) -> list:
+    """Compute a metric for each file, reusing the stored ones if any."""
+    if metrics_store is None:
+        return compute(paths)
+    return metrics_store.map(kind, parameters, paths, compute)
+
+
+def _map_dice(
+    processed_imgs: List[Union[str, Path]],
+    template_mask: Union[str, Path, Nifti1Image],
+    reference_cache: Optional[ReferenceMaskCache] = None,
+    n_jobs: int = 1,
+    prefetch: int = 0,
+    mask_cache: Optional[PackedMaskCache] = None,
+    mask_store: Optional[PackedMaskStore] = None,
+) -> list:
+    """Dice coefficient of each processed mask against the reference.
+
+    The masks are read and packed to one bit per voxel, in worker
+    processes when n_jobs > 1, and grouped by grid in the main process.
+    Each group is scored in batches of ``DICE_BATCH_SIZE`` masks against
+    the reference resampled and packed once for the grid, see
+    :func:`_batch_dice`.
+
+    Parameters
+    ----------
+
+    processed_imgs :
+        Paths to the processed structural or functional masks.
+
+    template_mask :
+        Path or nifti image object of the reference template.
+
+    reference_cache :
+        Cache of the reference template resampled to the processed grids.
+
+    n_jobs :
+        Number of processes. -1 uses all CPUs.
+
+    prefetch :
+        Number of masks read ahead by a thread pool. 0 reads the masks one
+        at a time.
+
+    mask_cache :
+        Masks read by an earlier stage. They are scored from memory; only
+        the other masks are read.
+
+    mask_store :
+        Packed masks saved on disk by previous runs. Stored masks are
+        memory-mapped instead of read, and the masks read are saved.
+
+    Returns
+    -------
+    list
+        Dice coefficient of each processed mask, in input order.
+    """
+    if reference_cache is None:
+        reference_cache = ReferenceMaskCache()
+    dice = np.empty(len(processed_imgs))
+    # packed reference and pending masks of each grid, by id of the
+    # resampled reference
+    references, batches = {}, {}
+
+    def score(grid):
+        positions, packed_masks = batches.pop(grid)
+        dice[positions] = _batch_dice(packed_masks, references[grid])
+
+    def add(position, packed_mask):
+        reference = reference_cache.get(
+            template_mask, packed_mask.affine, packed_mask.shape
+        )
+        grid = id(reference)
+        if grid not in references:
+            references[grid] = PackedMask.pack(reference, packed_mask.affine)
+        positions, packed_masks = batches.setdefault(grid, ([], []))
+        positions.append(position)
+        packed_masks.append(packed_mask)
+        if len(packed_masks) == DICE_BATCH_SIZE:
+            score(grid)
+
+    read_positions, read_imgs = [], []
+    for position, processed_img in enumerate(processed_imgs):
+        packed_mask = None
+        if mask_cache is not None:
+            packed_mask = mask_cache.get(processed_img)
+        if packed_mask is None and mask_store is not None:
+            packed_mask = mask_store.load(processed_img)
+        if packed_mask is None:
+            read_positions.append(position)
+            read_imgs.append(processed_img)
+        else:
+            add(position, packed_mask)
+    read_masks = _iter_scans(
+        _pack_mask, read_imgs, n_jobs, load=_read_mask, prefetch=prefetch
+    )
+    for position, processed_img, packed_mask in zip(
+        read_positions, read_imgs, read_masks
+    ):
+        if mask_store is not None:
+            mask_store.save(processed_img, packed_mask)
+        add(position, packed_mask)
+    for grid in list(batches):
+        score(grid)
+    return dice.tolist()
+
+
+def _read_mask(mask_img: Union[str, Path]) -> Tuple[np.ndarray, np.ndarray]:
+    """Boolean mask data and affine of a mask file."""
+    mask_img = nib.load(mask_img)
+    return _load_mask(mask_img), mask_img.affine
+
+
+def _pack_mask(loaded: Tuple[np.ndarray, np.ndarray]) -> PackedMask:
+    """Pack a mask read by :func:`_read_mask`."""
+    return PackedMask.pack(*loaded)
+
+
+def _map_scans(
+    function: Optional[Callable],
+    items: list,
+    n_jobs: int = 1,
+    load: Optional[Callable] = None,
+    prefetch: int = 0,
+) -> list:
+    """Apply a function to each scan, in a process pool when n_jobs > 1.
+
+    When a load function is given, the function is applied to the loaded
+    item. In a single process, up to ``prefetch`` items are loaded ahead in
+    a thread pool, so reading and decompressing the next files overlaps
+    with scoring the current one.
+
+    Parameters
+    ----------
+
+    function :
+        Function applied to each item. Must be picklable. When None, the
+        loaded items are returned.
+
+    items :
+        Inputs of the function, or of load when given.
+
+    n_jobs :
+        Number of processes. -1 uses all CPUs.
+
+    load :
+        Function reading each item, e.g. from a file path. Must be
+        picklable.
+
+    prefetch :
+        Number of items loaded ahead in a single process. 0 loads the
+        items one at a time.
+
+    Returns
+    -------
+    list
+        Outputs of the function, in input order.
+    """
+    return list(_iter_scans(function, items, n_jobs, load, prefetch))
+
+
+def _iter_scans(
+    function: Optional[Callable],
+    items: list,
+    n_jobs: int = 1,
+    load: Optional[Callable] = None,
+    prefetch: int = 0,
+) -> Iterator:
+    """Lazy version of :func:`_map_scans`: the outputs are yielded in input
+    order as they are computed, so the caller can consume them without
+    holding all of them in memory."""
+    if n_jobs < 0:
+        n_jobs = os.cpu_count()
+    if n_jobs == 1 or len(items) < 2:
+        loaded = items if load is None else _prefetch(load, items, prefetch)
+        loaded = tqdm(loaded, total=len(items))
+        yield from loaded if function is None else map(function, loaded)
+        return
+    if function is None:
+        function = load
+    elif load is not None:
+        function = partial(_load_and_apply, function, load)
+    chunksize = max(1, len(items) // (n_jobs * 4))
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        yield from tqdm(
+            executor.map(function, items, chunksize=chunksize),
+            total=len(items),
+        )
+
+
+def _load_and_apply(function: Callable, load: Callable, item):
+    """Apply a function to a loaded item, in a worker process."""
+    return function(load(item))
+
+
+def _prefetch(load: Callable, items: list, depth: int) -> Iterator:
+    """Load the items in order, with up to depth items loaded ahead.
+
+    The loads run in a thread pool and at most depth + 1 loaded items are
+    held at a time, which caps the memory used by the prefetched files.
+    """
+    if depth < 1:
+        yield from map(load, items)
+        return
+    with ThreadPoolExecutor(max_workers=depth) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(load, item))
+            if len(pending) > depth:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
 def quality_accessments(
     functional_metrics: pd.DataFrame,
     anatomical_metrics: pd.DataFrame,
@@ -377,7 +1106,8 @@ def quality_accessments(
         Functional scan metrics with fMRIPrep file identifier as index.
 
     anatomical_metrics:
-        Anatomical scan metrics with fMRIPrep file identifier as index.
+        Anatomical scan metrics indexed by subject, or by
+        ``<subject>_ses-<session>`` for session specific masks.
 
     Returns
     -------
@@ -398,15 +1128,27 @@ def quality_accessments(
     )
     functional_metrics["pass_func_qc"] = keep_fd * keep_proportion * keep_func
 
-    # get the anatomical pass / fail
-    pass_anat_qc = {}
-    for id in functional_metrics.index:
-        sub = id.split("sub-")[-1].split("_")[0]
-        pass_anat_qc[id] = {
-            "anatomical_dice": anatomical_metrics.loc[sub, "anatomical_dice"],
-            "pass_anat_qc": anatomical_metrics.loc[sub, "pass_qc"],
-        }
-    anat_qc = pd.DataFrame(pass_anat_qc).T
+    # get the anatomical pass / fail, from the session specific anatomical
+    # mask when there is one
+    subjects = functional_metrics.index.str.extract(
+        r"(?:^|_)sub-([^_]+)", expand=False
+    )
+    sessions = functional_metrics.index.str.extract(
+        r"(?:^|_)ses-([^_]+)", expand=False
+    )
+    session_keys = subjects + "_ses-" + sessions
+    anat_keys = session_keys.where(
+        session_keys.isin(anatomical_metrics.index), subjects
+    )
+    missing = ~anat_keys.isin(anatomical_metrics.index)
+    if missing.any():
+        raise KeyError(
+            "No anatomical metrics for the subjects of "
+            f"{functional_metrics.index[missing].tolist()}."
+        )
+    anat_qc = anatomical_metrics.loc[anat_keys, ["anatomical_dice", "pass_qc"]]
+    anat_qc = anat_qc.rename(columns={"pass_qc": "pass_anat_qc"})
+    anat_qc.index = functional_metrics.index
     metrics = pd.concat((functional_metrics, anat_qc), axis=1)
     metrics["pass_all_qc"] = metrics["pass_func_qc"] * metrics["pass_anat_qc"]
     print(
@@ -419,10 +1161,14 @@ def quality_accessments(
 def _dice_coefficient(
     processed_img: Union[str, Path, Nifti1Image],
     template_mask: Union[str, Path, Nifti1Image],
+    reference_cache: Optional[ReferenceMaskCache] = None,
 ) -> np.array:
     """
     Compute the Sørensen-dice coefficient between two n-d volumes.
 
+    Single mask version of :func:`_map_dice`: the masks are packed and
+    scored with :func:`_batch_dice`.
+
     Parameters
     ----------
 
@@ -432,24 +1178,136 @@ def _dice_coefficient(
     template_mask:
         Path or nifti image object of the reference template.
 
+    reference_cache:
+        Cache of the reference template resampled to the processed grids.
+        When None, the template is resampled for each call.
+
     Return
     ------
     numpy.array
         The dice coefficient.
     """
-    # make sure the inputs are 3d
-    processed_img = load_img(processed_img)
-    template_mask = load_img(template_mask)
-
-    # resample template to processed image
-    if (template_mask.affine != processed_img.affine).any():
-        template_mask = resample_to_img(
-            template_mask, processed_img, interpolation="nearest"
+    if not isinstance(processed_img, Nifti1Image):
+        processed_img = nib.load(processed_img)
+
+    # check space, resample template to processed image
+    if reference_cache is None:
+        template_mask = _resample_reference(
+            template_mask, processed_img.affine, processed_img.shape
         )
+    else:
+        template_mask = reference_cache.get(
+            template_mask, processed_img.affine, processed_img.shape
+        )
+    packed_mask = PackedMask.pack(
+        _load_mask(processed_img), processed_img.affine
+    )
+    reference = PackedMask.pack(template_mask, processed_img.affine)
+    return _batch_dice([packed_mask], reference)[0]
 
-    # check space, resample target to source space
-    processed_img = processed_img.get_fdata().astype(bool)
-    template_mask = template_mask.get_fdata().astype(bool)
-    intersection = np.sum(np.logical_and(processed_img, template_mask))
-    total_elements = np.sum(processed_img) + np.sum(template_mask)
-    return 2 * intersection / total_elements
+
+def _load_mask(mask_img: Union[str, Path, Nifti1Image]) -> np.ndarray:
+    """Boolean mask data, read in the stored dtype instead of float64.
+
+    Parameters
+    ----------
+
+    mask_img:
+        Path or nifti image object of a mask.
+
+    Return
+    ------
+    numpy.ndarray
+        Boolean mask.
+    """
+    if not isinstance(mask_img, Nifti1Image):
+        mask_img = nib.load(mask_img)
+    return np.asanyarray(mask_img.dataobj) != 0
+
+
+def _batch_dice(
+    packed_masks: List[PackedMask],
+    reference: PackedMask,
+    block_size: int = DICE_BATCH_SIZE,
+) -> np.ndarray:
+    """Sørensen-dice coefficient of packed masks against a packed reference.
+
+    The masks are cropped to the bounding box of the reference and
+    stacked, ``block_size`` at a time, in a matrix of 64-bit words, and
+    their intersections with the reference are counted with a population
+    count on the whole block. Only the bytes in the overlap of the boxes
+    are copied, and the mask cardinalities come from the packed masks, so
+    the voxels are never unpacked.
+
+    Parameters
+    ----------
+
+    packed_masks:
+        Processed masks, on the grid of the reference.
+
+    reference:
+        Reference mask.
+
+    block_size:
+        Number of masks per block.
+
+    Return
+    ------
+    numpy.ndarray
+        Dice coefficient of each mask.
+    """
+    reference_words = _bit_matrix([reference], reference)[0]
+    intersections = np.empty(len(packed_masks), dtype=np.int64)
+    for start in range(0, len(packed_masks), block_size):
+        stop = start + block_size
+        block = _bit_matrix(packed_masks[start:stop], reference)
+        block &= reference_words
+        intersections[start:stop] = _popcount(block).sum(axis=1)
+    counts = np.array([mask.count for mask in packed_masks], dtype=np.int64)
+    return 2 * intersections / (counts + reference.count)
+
+
+def _bit_matrix(
+    packed_masks: List[PackedMask], reference: PackedMask
+) -> np.ndarray:
+    """Stack the bits of packed masks in the bounding box of the reference
+    as rows of 64-bit words, padded with zeros."""
+    size = reference.bits.size
+    matrix = np.zeros((len(packed_masks), -(-size // 8) * 8), dtype=np.uint8)
+    for row, packed_mask in zip(matrix, packed_masks):
+        overlap = _overlap(packed_mask, reference)
+        if overlap is not None:
+            in_mask, in_reference = overlap
+            box = row[:size].reshape(reference.bits.shape)
+            box[in_reference] = packed_mask.bits[in_mask]
+    return matrix.view(np.uint64)
+
+
+_M1, _M2, _M4, _H01 = (
+    np.uint64(m)
+    for m in (
+        0x5555555555555555,
+        0x3333333333333333,
+        0x0F0F0F0F0F0F0F0F,
+        0x0101010101010101,
+    )
+)
+
+
+def _popcount(words: np.ndarray) -> np.ndarray:
+    """Number of bits set in each 64-bit word, computed in place."""
+    if hasattr(np, "bitwise_count"):  # numpy >= 2.0
+        return np.bitwise_count(words)
+    shifted = words >> np.uint64(1)
+    shifted &= _M1
+    words -= shifted
+    np.right_shift(words, np.uint64(2), out=shifted)
+    shifted &= _M2
+    words &= _M2
+    words += shifted
+    np.right_shift(words, np.uint64(4), out=shifted)
+    words += shifted
+    words &= _M4
+    words *= _H01
+    words >>= np.uint64(56)
+    return words
@@ -0,0 +1,470 @@
+import hashlib
+import os
+import tempfile
+from contextlib import contextmanager
+from typing import (
+    BinaryIO,
+    Dict,
+    Iterator,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+from pathlib import Path
+
+import numpy as np
+
+from nibabel import Nifti1Image
+from nilearn.image import load_img, resample_img
+
+from giga_auto_qc.store import _signature
+
+# bump when the layout of the packed masks changes, to ignore old files
+PACKED_MASK_VERSION = 1
+
+# number of bits set in each byte value
+_BYTE_COUNTS = np.unpackbits(
+    np.arange(256, dtype=np.uint8)[:, np.newaxis], axis=1
+).sum(axis=1)
+
+
+class PackedMask(NamedTuple):
+    """
+    A boolean mask packed to one bit per voxel, cropped to its bounding
+    box, with its grid.
+
+    Each line of voxels along the last axis is packed to whole bytes, so
+    the bits form an array with one byte per 8 voxels along the last axis.
+    Only the box of bytes holding voxels of the mask is kept, starting at
+    ``origin``: a brain mask takes about half the bytes of the full grid,
+    and two masks are intersected on the overlap of their boxes without
+    unpacking the voxels.
+    """
+
+    affine: np.ndarray
+    shape: Tuple[int, ...]
+    count: int
+    bits: np.ndarray
+    origin: Tuple[int, ...]
+
+    @classmethod
+    def pack(cls, mask: np.ndarray, affine: np.ndarray) -> "PackedMask":
+        """Pack a boolean mask."""
+        bits = np.packbits(mask, axis=-1)
+        box = []
+        for axis in range(bits.ndim):
+            other_axes = tuple(a for a in range(bits.ndim) if a != axis)
+            indices = np.flatnonzero(bits.any(axis=other_axes))
+            if not len(indices):
+                box = [slice(0, 0)] * bits.ndim
+                break
+            box.append(slice(indices[0], indices[-1] + 1))
+        return cls(
+            affine,
+            mask.shape,
+            int(np.count_nonzero(mask)),
+            np.ascontiguousarray(bits[tuple(box)]),
+            tuple(int(b.start) for b in box),
+        )
+
+    @property
+    def box(self) -> Tuple[slice, ...]:
+        """Position of the bits in the packed array of the full grid."""
+        return tuple(
+            slice(start, start + size)
+            for start, size in zip(self.origin, self.bits.shape)
+        )
+
+    def unpack(self) -> np.ndarray:
+        """Boolean mask."""
+        bits = np.zeros(
+            self.shape[:-1] + (-(-self.shape[-1] // 8),), dtype=np.uint8
+        )
+        bits[self.box] = self.bits
+        mask = np.unpackbits(bits, axis=-1, count=self.shape[-1])
+        return mask.view(bool)
+
+    def unpack_box(self) -> Tuple[np.ndarray, Tuple[slice, ...]]:
+        """Boolean mask in its bounding box, and the position of the box
+        in the grid."""
+        voxel_box = self.box[:-1] + (
+            slice(
+                8 * self.box[-1].start,
+                min(8 * self.box[-1].stop, self.shape[-1]),
+            ),
+        )
+        width = voxel_box[-1].stop - voxel_box[-1].start
+        mask = np.unpackbits(self.bits, axis=-1, count=max(width, 0))
+        return mask.view(bool), voxel_box
+
+    def intersection(self, other: "PackedMask") -> int:
+        """Number of voxels in both masks, on the same grid."""
+        overlap = _overlap(self, other)
+        if overlap is None:
+            return 0
+        words = self.bits[overlap[0]] & other.bits[overlap[1]]
+        return int(_BYTE_COUNTS[words].sum(dtype=np.int64))
+
+
+def _overlap(
+    mask: PackedMask, other: PackedMask
+) -> Optional[Tuple[Tuple[slice, ...], Tuple[slice, ...]]]:
+    """Overlap of the boxes of two packed masks, as slices of the bits of
+    each mask, or None if the boxes do not overlap."""
+    in_mask, in_other = [], []
+    for start, size, other_start, other_size in zip(
+        mask.origin, mask.bits.shape, other.origin, other.bits.shape
+    ):
+        first = max(start, other_start)
+        last = min(start + size, other_start + other_size)
+        if last <= first:
+            return None
+        in_mask.append(slice(first - start, last - start))
+        in_other.append(slice(first - other_start, last - other_start))
+    return tuple(in_mask), tuple(in_other)
+
+
+class PackedMaskCache:
+    """
+    Processed masks already read by an earlier stage, packed in memory.
+
+    The group mask pass reads every functional mask; keeping them packed
+    (one bit per voxel of the bounding box, about 60 kB for a 2 mm mask)
+    lets the dice stage score them without reading the files again.
+
+    Parameters
+    ----------
+
+    max_bytes :
+        Memory budget of the packed masks. Masks added beyond the budget
+        are not kept and are read from disk again. When None, all masks
+        are kept.
+    """
+
+    def __init__(self, max_bytes: Optional[int] = None) -> None:
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._masks: Dict[str, PackedMask] = {}
+
+    def __contains__(self, path: Union[str, Path]) -> bool:
+        return str(path) in self._masks
+
+    def add(self, path: Union[str, Path], mask: PackedMask) -> bool:
+        """Keep a packed mask, if it fits in the memory budget."""
+        if self.max_bytes is not None:
+            if self.nbytes + mask.bits.nbytes > self.max_bytes:
+                return False
+        self._masks[str(path)] = mask
+        self.nbytes += mask.bits.nbytes
+        return True
+
+    @property
+    def available_bytes(self) -> float:
+        """Memory left in the budget, in bytes."""
+        if self.max_bytes is None:
+            return float("inf")
+        return max(self.max_bytes - self.nbytes, 0)
+
+    def get(self, path: Union[str, Path]) -> Optional[PackedMask]:
+        """Packed mask of a file, or None if it was not kept."""
+        mask = self._masks.get(str(path))
+        if mask is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return mask
+
+    def report(self) -> str:
+        """Summary of the cache usage."""
+        return (
+            f"Packed mask cache: {len(self._masks)} masks "
+            f"({self.nbytes / 1024**2:.1f} MB), {self.hits} reused, "
+            f"{self.misses} read from disk."
+        )
+
+
+class PackedMaskStore:
+    """
+    Processed masks saved on disk, decompressed and packed, for the
+    following runs.
+
+    Each mask is saved as a ``.npy`` file holding one record: the affine,
+    shape and number of voxels of the mask, and its bits with the origin
+    of their bounding box. The file is
+    named after the path, size and modification time of the mask file,
+    so a modified mask is read again. Stored masks are memory-mapped:
+    loading one does not decompress or copy anything, the bits are only
+    paged in when scored. Each map holds a file descriptor until the mask
+    is released, so stored masks are not kept for the whole run.
+
+    Parameters
+    ----------
+
+    cache_dir :
+        Directory of the packed masks. Created if it does not exist.
+    """
+
+    def __init__(self, cache_dir: Path) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, path: Union[str, Path]) -> Optional[PackedMask]:
+        """Memory-mapped packed mask of an unchanged file, if stored."""
+        stored_file = self._stored_file(path)
+        if not stored_file.exists():
+            self.misses += 1
+            return None
+        record = np.load(stored_file, mmap_mode="r")
+        self.hits += 1
+        return PackedMask(
+            np.array(record["affine"]),
+            tuple(record["shape"].tolist()),
+            int(record["count"]),
+            record["bits"],
+            tuple(record["origin"].tolist()),
+        )
+
+    def save(self, path: Union[str, Path], mask: PackedMask) -> None:
+        """Save the packed mask of a file."""
+        record = np.zeros(
+            (),
+            dtype=[
+                ("affine", "<f8", (4, 4)),
+                ("shape", "<i8", (len(mask.shape),)),
+                ("count", "<i8"),
+                ("origin", "<i8", (len(mask.origin),)),
+                ("bits", "u1", mask.bits.shape),
+            ],
+        )
+        record["affine"] = mask.affine
+        record["shape"] = mask.shape
+        record["count"] = mask.count
+        record["origin"] = mask.origin
+        record["bits"] = mask.bits
+        with _atomic_write(self._stored_file(path)) as f:
+            np.save(f, record)
+
+    def report(self) -> str:
+        """Summary of the store usage."""
+        return (
+            f"Packed mask store: {self.hits} masks memory-mapped, "
+            f"{self.misses} read from the mask files."
+        )
+
+    def _stored_file(self, path: Union[str, Path]) -> Path:
+        """Location of the packed mask of the current version of a file."""
+        key = (PACKED_MASK_VERSION, str(path), *_signature(path))
+        return self.cache_dir / _cache_name(key)
+
+
+class ReferenceMaskCache:
+    """
+    Reference masks resampled to the grid of the processed scans.
+
+    Most scans in a dataset share a handful of grids, so the nearest
+    neighbour resampling of a reference mask is done once per grid.
+    The resampled masks are kept in memory and, when ``cache_dir`` is
+    supplied, saved to disk for the next run.
+
+    Parameters
+    ----------
+
+    cache_dir :
+        Directory to store the resampled masks. When None, the cache only
+        lives in memory.
+
+    extra_dirs :
+        Read-only directories of masks resampled beforehand, e.g. the
+        template mask at common resolutions in the template cache.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Optional[Path] = None,
+        extra_dirs: Sequence[Path] = (),
+    ) -> None:
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.extra_dirs = [Path(d) for d in extra_dirs]
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._masks = {}
+        self._identities = {}
+
+    def get(
+        self,
+        template_mask: Union[str, Path, Nifti1Image],
+        target_affine: np.ndarray,
+        target_shape: Tuple[int, ...],
+    ) -> np.ndarray:
+        """
+        Get the reference mask on the grid of a processed scan.
+
+        Parameters
+        ----------
+
+        template_mask :
+            Path or nifti image object of the reference template.
+
+        target_affine :
+            Affine of the processed scan.
+
+        target_shape :
+            Shape of the processed scan.
+
+        Return
+        ------
+        numpy.ndarray
+            Boolean reference mask on the target grid.
+        """
+        target_shape = tuple(int(s) for s in target_shape[:3])
+        key = (
+            self.reference_identity(template_mask),
+            np.asarray(target_affine, dtype=float).tobytes(),
+            target_shape,
+        )
+        if key in self._masks:
+            self.hits += 1
+            return self._masks[key]
+
+        cache_file = self._cache_file(key)
+        stored_file = self._find_stored(key)
+        if stored_file is not None:
+            mask = np.unpackbits(np.load(stored_file), count=np.prod(key[2]))
+            mask = mask.reshape(key[2]).astype(bool)
+            self.disk_hits += 1
+        else:
+            mask = _resample_reference(
+                template_mask, target_affine, target_shape
+            )
+            if cache_file is not None:
+                with _atomic_write(cache_file) as f:
+                    np.save(f, np.packbits(mask))
+            self.misses += 1
+        self._masks[key] = mask
+        return mask
+
+    def report(self) -> str:
+        """Summary of the cache usage."""
+        lookups = self.hits + self.disk_hits + self.misses
+        return (
+            f"Reference mask cache: {lookups} lookups, {self.hits} hits, "
+            f"{self.disk_hits} loaded from disk, {self.misses} misses."
+        )
+
+    def reference_identity(
+        self, template_mask: Union[str, Path, Nifti1Image]
+    ) -> str:
+        """Stable identifier of a reference mask across runs."""
+        if not isinstance(template_mask, Nifti1Image):
+            return reference_identity(template_mask)
+        if id(template_mask) not in self._identities:
+            self._identities[id(template_mask)] = (
+                template_mask,
+                reference_identity(template_mask),
+            )
+        return self._identities[id(template_mask)][1]
+
+    def _cache_file(self, key: tuple) -> Optional[Path]:
+        """Location of a resampled mask on disk."""
+        if self.cache_dir is None:
+            return None
+        return self.cache_dir / _cache_name(key)
+
+    def _find_stored(self, key: tuple) -> Optional[Path]:
+        """Resampled mask saved on disk, if any."""
+        directories = [self.cache_dir] if self.cache_dir else []
+        for directory in directories + self.extra_dirs:
+            if (directory / _cache_name(key)).exists():
+                return directory / _cache_name(key)
+        return None
+
+
+@contextmanager
+def _atomic_write(path: Path) -> Iterator[BinaryIO]:
+    """Write a file through a temporary file in the same directory, moved
+    in place once complete, so concurrent runs (e.g. shards) never read a
+    partial file and an interrupted write leaves no file behind."""
+    path = Path(path)
+    with tempfile.NamedTemporaryFile(
+        dir=path.parent, suffix=".tmp", delete=False
+    ) as f:
+        try:
+            yield f
+        except BaseException:
+            f.close()
+            os.unlink(f.name)
+            raise
+    os.replace(f.name, path)
+
+
+def _cache_name(key: tuple) -> str:
+    """File name of a resampled mask on disk."""
+    return f"{hashlib.sha1(repr(key).encode()).hexdigest()}.npy"
+
+
+def reference_identity(template_mask: Union[str, Path, Nifti1Image]) -> str:
+    """
+    Stable identifier of a reference mask across runs.
+
+    Parameters
+    ----------
+
+    template_mask :
+        Path or nifti image object of the reference template.
+
+    Return
+    ------
+    str
+        Path and modification time of a file, or checksum of the content
+        of an image built in memory (e.g. group masks).
+    """
+    if not isinstance(template_mask, Nifti1Image):
+        path = Path(template_mask).resolve()
+        return f"{path}:{path.stat().st_mtime_ns}"
+    checksum = hashlib.sha1(template_mask.affine.tobytes())
+    checksum.update(np.asanyarray(template_mask.dataobj).tobytes())
+    return checksum.hexdigest()
+
+
+def _resample_reference(
+    template_mask: Union[str, Path, Nifti1Image],
+    target_affine: np.ndarray,
+    target_shape: Tuple[int, ...],
+) -> np.ndarray:
+    """Resample the reference mask to a target grid with nearest neighbour.
+
+    Parameters
+    ----------
+
+    template_mask :
+        Path or nifti image object of the reference template.
+
+    target_affine :
+        Affine of the processed scan.
+
+    target_shape :
+        Shape of the processed scan.
+
+    Return
+    ------
+    numpy.ndarray
+        Boolean reference mask on the target grid.
+    """
+    template_mask = load_img(template_mask)
+    if (template_mask.affine != target_affine).any():
+        template_mask = resample_img(
+            template_mask,
+            target_affine=target_affine,
+            target_shape=target_shape[:3],
+            interpolation="nearest",
+        )
+    return np.asanyarray(template_mask.dataobj) != 0
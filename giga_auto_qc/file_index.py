@@ -0,0 +1,284 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import TYPE_CHECKING, Dict, List, Optional, Union
+from pathlib import Path
+
+if TYPE_CHECKING:
+    from bids import BIDSLayout
+
+# BIDS filename key to pybids entity name
+ENTITY_NAMES = {
+    "sub": "subject",
+    "ses": "session",
+    "task": "task",
+    "acq": "acquisition",
+    "ce": "ceagent",
+    "rec": "reconstruction",
+    "dir": "direction",
+    "run": "run",
+    "echo": "echo",
+    "part": "part",
+    "space": "space",
+    "cohort": "cohort",
+    "res": "res",
+    "den": "den",
+    "label": "label",
+    "desc": "desc",
+}
+DATATYPES = {"anat", "func", "fmap", "dwi", "perf"}
+# files used for quality control
+INDEXED_DESC = {"brain", "confounds"}
+INDEXED_EXTENSIONS = {"nii.gz", "tsv"}
+
+
+class FileIndex:
+    """
+    In-memory index of the fMRIPrep outputs used for quality control.
+
+    The index is queried with the same keyword filters as
+    :meth:`bids.BIDSLayout.get`, so it can stand in for the layout in
+    :mod:`giga_auto_qc.assessments`. Files are grouped by subject, so a
+    query for one subject does not scan the whole dataset.
+
+    Parameters
+    ----------
+
+    files :
+        Paths to the indexed files.
+    """
+
+    def __init__(self, files: List[Union[str, Path]]) -> None:
+        self._files_by_subject: Dict[str, List[dict]] = {}
+        for path in sorted(str(f) for f in files):
+            entities = parse_bids_filename(path)
+            subject = entities.get("subject")
+            self._files_by_subject.setdefault(subject, []).append(entities)
+
+    def __len__(self) -> int:
+        return sum(len(f) for f in self._files_by_subject.values())
+
+    @classmethod
+    def from_layout(
+        cls,
+        fmriprep_bids_layout: "BIDSLayout",
+        subjects: List[str],
+        verbose: int = 1,
+        sessions: Optional[List[str]] = None,
+    ) -> "FileIndex":
+        """
+        Index the brain masks and confounds of the subjects with a single
+        query to the layout.
+
+        Parameters
+        ----------
+
+        fmriprep_bids_layout :
+            BIDS layout of a fMRIPrep derivative.
+
+        subjects :
+            Participant IDs in a BIDS dataset.
+
+        sessions :
+            Session labels to index, along with the files without session.
+            Default to all sessions.
+
+        verbose :
+            Level of verbosity.
+
+        Returns
+        -------
+        FileIndex
+            Brain masks and confounds of the subjects.
+        """
+        start = time.perf_counter()
+        files = fmriprep_bids_layout.get(
+            subject=subjects,
+            desc=list(INDEXED_DESC),
+            extension=list(INDEXED_EXTENSIONS),
+            return_type="file",
+        )
+        if sessions:
+            files = [
+                f
+                for f in files
+                if parse_bids_filename(f).get("session") in [None, *sessions]
+            ]
+        file_index = cls(files)
+        if verbose > 0:
+            print(
+                f"Indexed {len(file_index)} files in "
+                f"{time.perf_counter() - start:.2f} s."
+            )
+        return file_index
+
+    @classmethod
+    def from_directory(
+        cls,
+        bids_dir: Path,
+        subjects: List[str],
+        n_threads: Optional[int] = None,
+        verbose: int = 1,
+        sessions: Optional[List[str]] = None,
+    ) -> "FileIndex":
+        """
+        Index the brain masks and confounds of the subjects by walking the
+        derivative directory, without pybids.
+
+        Parameters
+        ----------
+
+        bids_dir :
+            The fMRIPrep derivative output.
+
+        subjects :
+            Participant IDs in a BIDS dataset.
+
+        n_threads :
+            Number of threads walking the subject directories. Default to
+            the :class:`concurrent.futures.ThreadPoolExecutor` default.
+
+        verbose :
+            Level of verbosity.
+
+        sessions :
+            Session labels to index, along with the files without session.
+            The directories of the other sessions are not walked. Default
+            to all sessions.
+
+        Returns
+        -------
+        FileIndex
+            Brain masks and confounds of the subjects.
+        """
+        start = time.perf_counter()
+        scan_files = partial(_scan_files, sessions=sessions)
+        subject_dirs = [Path(bids_dir) / f"sub-{sub}" for sub in subjects]
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            files = [
+                path
+                for subject_files in executor.map(scan_files, subject_dirs)
+                for path in subject_files
+            ]
+        file_index = cls(files)
+        if verbose > 0:
+            print(
+                f"Indexed {len(file_index)} files in "
+                f"{time.perf_counter() - start:.2f} s."
+            )
+        return file_index
+
+    def get(self, return_type: str = "file", **filters) -> List[str]:
+        """
+        Files matching the BIDS entities.
+
+        Parameters
+        ----------
+
+        return_type : {"file"}
+            Only file paths are supported.
+
+        filters :
+            Entity name and value, or list of values, to match.
+
+        Returns
+        -------
+        List of str
+            Paths to the matching files.
+        """
+        if return_type != "file":
+            raise ValueError("FileIndex only returns file paths.")
+        filters = {
+            entity: {_normalise(entity, v) for v in _as_list(value)}
+            for entity, value in filters.items()
+        }
+        subjects = filters.pop("subject", self._files_by_subject.keys())
+        return sorted(
+            entities["path"]
+            for subject in subjects
+            for entities in self._files_by_subject.get(subject, [])
+            if all(
+                entities.get(entity) in values
+                for entity, values in filters.items()
+            )
+        )
+
+    def get_tasks(self) -> List[str]:
+        """Task names in the index."""
+        return sorted(
+            {
+                entities["task"]
+                for files in self._files_by_subject.values()
+                for entities in files
+                if "task" in entities
+            }
+        )
+
+
+def parse_bids_filename(path: Union[str, Path]) -> dict:
+    """
+    Parse BIDS entities from a file path.
+
+    Parameters
+    ----------
+
+    path :
+        Path to a BIDS file.
+
+    Returns
+    -------
+    dict
+        pybids entity names and values, with the file path, suffix,
+        extension and datatype.
+    """
+    path = Path(path)
+    stem, _, extension = path.name.partition(".")
+    *pairs, suffix = stem.split("_")
+    entities = {"path": str(path), "suffix": suffix, "extension": extension}
+    for pair in pairs:
+        key, _, value = pair.partition("-")
+        entities[ENTITY_NAMES.get(key, key)] = value
+    if path.parent.name in DATATYPES:
+        entities["datatype"] = path.parent.name
+    return entities
+
+
+def _scan_files(
+    directory: Path, sessions: Optional[List[str]] = None
+) -> List[str]:
+    """Brain masks and confounds under a directory, with os.scandir.
+    Session directories not in sessions are skipped."""
+    files = []
+    if not directory.is_dir():
+        return files
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                if (
+                    sessions
+                    and entry.name.startswith("ses-")
+                    and entry.name[4:] not in sessions
+                ):
+                    continue
+                files += _scan_files(Path(entry.path), sessions)
+                continue
+            stem, _, extension = entry.name.partition(".")
+            if extension in INDEXED_EXTENSIONS and any(
+                f"_desc-{desc}_" in f"{stem}_" for desc in INDEXED_DESC
+            ):
+                files.append(entry.path)
+    return files
+
+
+def _as_list(value) -> list:
+    if isinstance(value, (list, tuple, set)):
+        return list(value)
+    return [value]
+
+
+def _normalise(entity: str, value: Optional[str]) -> Optional[str]:
+    """Match the pybids conventions for the filter values."""
+    if entity == "extension" and value is not None:
+        return value.lstrip(".")
+    return value
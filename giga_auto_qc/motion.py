@@ -0,0 +1,275 @@
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from giga_auto_qc.store import _signature
+
+
+class FDArchive:
+    """
+    Framewise displacement series of many functional runs.
+
+    The series are saved in one ``.npz`` file as a ragged array: the
+    values of all runs end to end, and the offset of each run. The path,
+    size and modification time of the confounds file of each run are kept
+    as well, so that a later run only reads the new or modified files.
+
+    Parameters
+    ----------
+
+    reuse :
+        Archive of a previous run. Series of unchanged confounds files are
+        taken from it instead of reading the files.
+    """
+
+    def __init__(self, reuse: Optional["FDArchive"] = None) -> None:
+        self.reuse = reuse
+        self.hits = 0
+        self.misses = 0
+        # identifier -> (path, signature, framewise displacement)
+        self._series: Dict[str, Tuple[str, Tuple[int, int], np.ndarray]] = {}
+
+    def __len__(self) -> int:
+        return len(self._series)
+
+    def __contains__(self, identifier: str) -> bool:
+        return identifier in self._series
+
+    def __getitem__(self, identifier: str) -> np.ndarray:
+        return self._series[identifier][2]
+
+    @property
+    def identifiers(self) -> List[str]:
+        """Identifiers of the runs, in order of addition."""
+        return list(self._series)
+
+    def add(
+        self,
+        confound_file: Union[str, Path],
+        framewise_displacement: np.ndarray,
+        signature: Optional[Tuple[int, int]] = None,
+    ) -> None:
+        """Keep the framewise displacement series of a confounds file."""
+        if signature is None:
+            signature = _signature(confound_file)
+        self._series[fd_identifier(confound_file)] = (
+            str(confound_file),
+            tuple(signature),
+            np.asarray(framewise_displacement, dtype=float),
+        )
+
+    def map(
+        self,
+        confound_files: List[Union[str, Path]],
+        read: Callable[[list], list],
+    ) -> List[np.ndarray]:
+        """
+        Framewise displacement series of confounds files, reading only the
+        files not found unchanged in the archive to reuse.
+
+        Parameters
+        ----------
+
+        confound_files :
+            Paths to fMRIPrep confounds files.
+
+        read :
+            Reads the framewise displacement of a list of files, in input
+            order.
+
+        Return
+        ------
+        list of numpy.ndarray
+            Framewise displacement series, in input order.
+        """
+        stored = {f: self._reusable(f) for f in confound_files}
+        missing = [f for f in confound_files if stored[f] is None]
+        self.hits += len(confound_files) - len(missing)
+        self.misses += len(missing)
+        read_series = dict(zip(missing, read(missing))) if missing else {}
+        # keep the input order in the archive
+        for confound_file in confound_files:
+            if stored[confound_file] is None:
+                self.add(confound_file, read_series[confound_file])
+            else:
+                _, signature, series = stored[confound_file]
+                self.add(confound_file, series, signature)
+        return [self[fd_identifier(f)] for f in confound_files]
+
+    def update(self, other: "FDArchive") -> None:
+        """Add the series of another archive, e.g. of a shard."""
+        self._series.update(other._series)
+
+    def sweep(
+        self, thresholds: Sequence[float], block_size: int = 1024
+    ) -> pd.DataFrame:
+        """
+        Scrubbing metrics of every run for a range of thresholds.
+
+        The series of ``block_size`` runs at a time are padded in a matrix,
+        and sorted along with the thresholds in one stable sort per row:
+        the position of a threshold in the sorted row gives the number of
+        volumes below it, and the cumulative sum of the sorted values their
+        sum. Missing values are never kept, as in the single threshold
+        metrics.
+
+        Parameters
+        ----------
+
+        thresholds :
+            Framewise displacement thresholds (mm) for scrubbing.
+
+        block_size :
+            Number of runs per block.
+
+        Returns
+        -------
+        pandas.DataFrame
+            One row per run and threshold, with the identifier as index:
+            scrubbing_fd, mean_fd_scrubbed and proportion_kept.
+        """
+        thresholds = np.unique(np.asarray(thresholds, dtype=float))
+        values, offsets = self._ragged()
+        lengths = np.diff(offsets)
+        kept = np.zeros((len(lengths), len(thresholds)), dtype=np.int64)
+        kept_sum = np.zeros(kept.shape)
+        for start in range(0, len(lengths), block_size):
+            stop = min(start + block_size, len(lengths))
+            first, last = offsets[start], offsets[stop]
+            kept[start:stop], kept_sum[start:stop] = _sweep_block(
+                values[first:last], lengths[start:stop], thresholds
+            )
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean_fd_scrubbed = kept_sum / kept
+            proportion_kept = kept / lengths[:, np.newaxis]
+        sweep = pd.DataFrame(
+            {
+                "scrubbing_fd": np.tile(thresholds, len(lengths)),
+                "mean_fd_scrubbed": mean_fd_scrubbed.ravel(),
+                "proportion_kept": proportion_kept.ravel(),
+            },
+            index=np.repeat(self.identifiers, len(thresholds)),
+        )
+        sweep.index.name = "identifier"
+        return sweep
+
+    def save(self, path: Union[str, Path]) -> None:
+        """Save the archive as one ``.npz`` file."""
+        values, offsets = self._ragged()
+        paths = [stored[0] for stored in self._series.values()]
+        signatures = [stored[1] for stored in self._series.values()]
+        np.savez(
+            path,
+            values=values,
+            offsets=offsets,
+            identifiers=np.array(self.identifiers, dtype=str),
+            paths=np.array(paths, dtype=str),
+            signatures=np.array(signatures, dtype=np.int64).reshape(-1, 2),
+        )
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "FDArchive":
+        """Read an archive saved by :meth:`save`."""
+        archive = cls()
+        with np.load(path) as stored:
+            values, offsets = stored["values"], stored["offsets"]
+            for identifier, path, signature, start, stop in zip(
+                stored["identifiers"].tolist(),
+                stored["paths"].tolist(),
+                stored["signatures"].tolist(),
+                offsets[:-1],
+                offsets[1:],
+            ):
+                archive._series[identifier] = (
+                    path,
+                    tuple(signature),
+                    values[start:stop],
+                )
+        return archive
+
+    def report(self) -> str:
+        """Summary of the archive usage."""
+        return (
+            f"Framewise displacement archive: {len(self)} runs, "
+            f"{self.hits} reused, {self.misses} read."
+        )
+
+    def _reusable(
+        self, confound_file: Union[str, Path]
+    ) -> Optional[Tuple[str, Tuple[int, int], np.ndarray]]:
+        """Stored series of an unchanged confounds file, if any."""
+        if self.reuse is None:
+            return None
+        stored = self.reuse._series.get(fd_identifier(confound_file))
+        if stored is None or stored[0] != str(confound_file):
+            return None
+        if stored[1] != _signature(confound_file):
+            return None
+        return stored
+
+    def _ragged(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Values of all series end to end, and the offset of each."""
+        series = [stored[2] for stored in self._series.values()]
+        offsets = np.zeros(len(series) + 1, dtype=np.int64)
+        np.cumsum([len(s) for s in series], out=offsets[1:])
+        values = np.concatenate(series) if series else np.zeros(0)
+        return values, offsets
+
+
+def fd_identifier(confound_file: Union[str, Path]) -> str:
+    """Identifier of the run of a fMRIPrep confounds file."""
+    return Path(confound_file).name.split("_desc-confounds")[0]
+
+
+def _sweep_block(
+    values: np.ndarray, lengths: np.ndarray, thresholds: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Number and sum of the values below each threshold, for the runs of a
+    block.
+
+    Parameters
+    ----------
+
+    values :
+        Framewise displacement of the runs, end to end.
+
+    lengths :
+        Number of volumes of each run.
+
+    thresholds :
+        Sorted, unique thresholds.
+
+    Returns
+    -------
+    numpy.ndarray
+        Number of volumes kept, per run and threshold.
+
+    numpy.ndarray
+        Sum of the framewise displacement of the volumes kept.
+    """
+    n_thresholds = len(thresholds)
+    width = lengths.max() if len(lengths) else 0
+    # thresholds first, so that a threshold sorts before the values equal
+    # to it; missing values and padding sort last and are never kept
+    matrix = np.full((len(lengths), n_thresholds + width), np.inf)
+    matrix[:, :n_thresholds] = thresholds
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    columns = np.arange(len(values)) - np.repeat(
+        np.cumsum(lengths) - lengths, lengths
+    )
+    matrix[rows, n_thresholds + columns] = np.where(
+        np.isnan(values), np.inf, values
+    )
+    order = np.argsort(matrix, axis=1, kind="stable")
+    is_threshold = order < n_thresholds
+    positions = np.nonzero(is_threshold)[1].reshape(-1, n_thresholds)
+    kept = positions - np.arange(n_thresholds)
+    sorted_values = np.take_along_axis(matrix, order, axis=1)
+    sorted_values = sorted_values[~is_threshold].reshape(len(lengths), width)
+    # the padding is never summed: at most the finite values are kept
+    sorted_values[np.isinf(sorted_values)] = 0
+    cumulative = np.zeros((len(lengths), width + 1))
+    np.cumsum(sorted_values, axis=1, out=cumulative[:, 1:])
+    return kept, np.take_along_axis(cumulative, kept, axis=1)
@@ -0,0 +1,157 @@
+import cProfile
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Union
+from pathlib import Path
+
+
+class StageProfiler:
+    """
+    Wall time, CPU time, peak memory and item counts of the workflow
+    stages.
+
+    Each stage is timed with :meth:`stage`, and the records are saved as
+    json with :meth:`write`. CPU time includes the worker processes that
+    finished during the stage. Peak RSS is reset at the start of each
+    stage where the platform allows it (Linux), otherwise it is the peak
+    since the start of the process. The peak RSS of the worker processes
+    cannot be reset: it is the largest worker that ended during the run,
+    saved once for the whole run.
+    """
+
+    def __init__(self) -> None:
+        self.stages: List[dict] = []
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str, **labels) -> Iterator[dict]:
+        """
+        Time a stage of the workflow.
+
+        Parameters
+        ----------
+
+        name :
+            Name of the stage.
+
+        labels :
+            Extra fields of the record, e.g. the task name.
+
+        Yields
+        ------
+        dict
+            Record of the stage. Set ``record["items"]`` to the number of
+            items processed.
+        """
+        record = {"stage": name, **labels, "items": None}
+        reset_peak_rss()
+        start_wall = time.perf_counter()
+        start_cpu = _cpu_time()
+        try:
+            yield record
+        finally:
+            record["wall_seconds"] = time.perf_counter() - start_wall
+            record["cpu_seconds"] = _cpu_time() - start_cpu
+            record["peak_rss_mb"] = peak_rss_mb()
+            self.stages.append(record)
+
+    def write(self, path: Union[str, Path]) -> None:
+        """Save the stage records and the run-wide worker peak as json."""
+        with open(path, "w") as f:
+            json.dump(
+                {
+                    "wall_seconds": time.perf_counter() - self._start,
+                    "peak_rss_workers_mb": peak_rss_mb(children=True),
+                    "stages": self.stages,
+                },
+                f,
+                indent=2,
+            )
+
+    def report(self) -> str:
+        """Summary of the time spent in each stage."""
+        lines = ["Stage profile:"]
+        for record in self.stages:
+            labels = "".join(
+                f" {key}-{value}"
+                for key, value in record.items()
+                if key not in _RECORD_FIELDS
+            )
+            line = (
+                f"  {record['stage']}{labels}: "
+                f"{record['wall_seconds']:.2f} s wall, "
+                f"{record['cpu_seconds']:.2f} s CPU, "
+                f"peak RSS {record['peak_rss_mb']:.0f} MB"
+            )
+            if record["items"] is not None:
+                line += f", {record['items']} items"
+            lines.append(line)
+        return "\n".join(lines)
+
+
+_RECORD_FIELDS = {
+    "stage",
+    "items",
+    "wall_seconds",
+    "cpu_seconds",
+    "peak_rss_mb",
+}
+
+
+@contextmanager
+def profile_calls(path: Union[str, Path]) -> Iterator[None]:
+    """Profile the function calls with cProfile and dump the statistics,
+    to read with :mod:`pstats` or snakeviz."""
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(str(path))
+
+
+def reset_peak_rss() -> bool:
+    """Reset the peak resident set size of the process (Linux only)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def peak_rss_mb(children: bool = False) -> float:
+    """
+    Peak resident set size, in MB.
+
+    Parameters
+    ----------
+
+    children :
+        Peak of the terminated child processes (e.g. the workers of
+        ``--n-jobs``) instead of the current process.
+    """
+    if not children:
+        try:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            pass
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    peak = resource.getrusage(who).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return peak / 1024**2 if sys.platform == "darwin" else peak / 1024
+
+
+def _cpu_time() -> float:
+    """CPU time of the process and its terminated children."""
+    times = os.times()
+    return sum(times[:4])
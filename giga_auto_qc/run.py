@@ -1,7 +1,7 @@
 import argparse
 from pathlib import Path
+from typing import Tuple
 
-from giga_auto_qc.workflow import workflow
 from giga_auto_qc import __version__
 
 
@@ -29,8 +29,11 @@ def main(argv=None):
     )
     parser.add_argument(
         "analysis_level",
-        help="Level of the analysis that will be performed.",
-        choices=["participant", "group"],
+        help="Level of the analysis that will be performed. 'mask' only "
+        "builds the group functional mask, saved in output_dir for the "
+        "sharded runs. 'merge' combines the metrics of sharded runs in "
+        "output_dir and writes the reports.",
+        choices=["participant", "group", "mask", "merge"],
     )
     parser.add_argument(
         "-v", "--version", action="version", version=__version__
@@ -44,6 +47,15 @@ def main(argv=None):
         "with a space separated list.",
         nargs="+",
     )
+    parser.add_argument(
+        "--shard",
+        help="Only compute the metrics of one shard of the subjects, given "
+        "as i/N (1 <= i <= N), e.g. the SLURM array task index and count. "
+        "The metrics are written under <output_dir>/shards and combined "
+        "with the 'merge' analysis level. The shards use the group mask "
+        "built beforehand with the 'mask' analysis level.",
+        type=_shard,
+    )
     parser.add_argument(
         "--session",
         help="The label(s) of the sessions that should be analyzed. The "
@@ -65,13 +77,98 @@ def main(argv=None):
         "is supplied, we will filter with the default parameters. It should "
         "include the following fields: mean_fd (default=0.55), scrubbing_fd "
         "(default=0.2), proportion_kept (default=0.5), anatomical_dice "
-        "(default=0.99), functional_dice (default=0.89)",
+        "(default=0.99), functional_dice (default=0.89). With several "
+        "files, the reports of each file are written in "
+        "<output_dir>/<file name>.",
+        nargs="+",
+    )
+    parser.add_argument(
+        "--from-metrics",
+        help="Write the reports from the metrics saved by a previous run in "
+        "output_dir, without reading the dataset: apply new quality control "
+        "parameters in seconds. The scrubbing metrics are recomputed from "
+        "<output_dir>/fd_archive.npz.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--scrubbing-sweep",
+        help="Also compute mean_fd_scrubbed and proportion_kept of every "
+        "scan for each of these scrubbing thresholds (mm), e.g. 0.2 0.3 "
+        "0.5, in scrubbing_sweep.<format>. The framewise displacement of "
+        "every scan is read once and saved in <output_dir>/fd_archive.npz.",
+        type=float,
+        nargs="+",
+        metavar="SCRUBBING_FD",
     )
     parser.add_argument(
         "--reindex-bids",
         help="Reindex BIDS data set, even if layout has already been created.",
         action="store_true",
     )
+    parser.add_argument(
+        "--indexer",
+        help="How to find the fMRIPrep outputs. 'pybids' indexes the "
+        "dataset with a BIDS layout; 'fast' walks the subject directories "
+        "and parses the file names, without pybids. Default to pybids.",
+        choices=["pybids", "fast"],
+        default="pybids",
+    )
+    parser.add_argument(
+        "--output-format",
+        help="File format of the reports. Each task has a report, and "
+        "all-tasks_report combines the reports of all tasks. 'parquet' and "
+        "'feather' keep the data types and need pyarrow "
+        "(pip install giga_auto_qc[columnar]). Default to tsv.",
+        choices=["tsv", "parquet", "feather"],
+        default="tsv",
+    )
+    parser.add_argument(
+        "--reference-cache",
+        help="Save the reference masks resampled to the grid of each scan "
+        "under <output_dir>/cache/reference_masks, and reuse them in the "
+        "following runs.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--metrics-store",
+        help="Keep the dice of each mask in "
+        "<output_dir>/cache/metrics.sqlite. The following runs only compute "
+        "metrics for new or modified files and regenerate the reports. The "
+        "framewise displacement is reused from <output_dir>/fd_archive.npz, "
+        "saved by every run.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--mask-store",
+        help="Save the processed masks, decompressed and packed to one bit "
+        "per voxel, under <output_dir>/cache/packed_masks. The following "
+        "runs memory-map the masks of unchanged files instead of reading "
+        "the .nii.gz files.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--n-jobs",
+        help="Number of processes computing the quality metrics. -1 uses "
+        "all CPUs. Default to 1.",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--prefetch",
+        help="Number of masks and confounds files read ahead by a thread "
+        "pool while the current scans are scored, e.g. on a network "
+        "filesystem. Applies when --n-jobs is 1. Default to 0, read the "
+        "files one at a time.",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--profile",
+        help="Profile the function calls with cProfile and save the "
+        "statistics to <output_dir>/qc_profile.prof. The time and memory "
+        "used by each stage are always saved to <output_dir>/qc_profile.json.",
+        action="store_true",
+    )
     parser.add_argument(
         "--verbose",
         help="Verbrosity. 0 for minimal, 1 for more details. Default to 1.",
@@ -80,4 +177,28 @@ def main(argv=None):
     )
     args = parser.parse_args(argv)
 
-    workflow(args)
+    # deferred so --help, --version and argument errors return quickly
+    from giga_auto_qc.workflow import workflow
+
+    if args.profile:
+        from giga_auto_qc.profiling import profile_calls
+
+        with profile_calls(args.output_dir / "qc_profile.prof"):
+            workflow(args)
+    else:
+        workflow(args)
+
+
+def _shard(value: str) -> Tuple[int, int]:
+    """Parse a shard given as i/N."""
+    try:
+        shard, n_shards = (int(v) for v in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f"Shard should be given as i/N, got {value}."
+        )
+    if not 1 <= shard <= n_shards:
+        raise argparse.ArgumentTypeError(
+            f"Shard index should be between 1 and N, got {value}."
+        )
+    return shard, n_shards
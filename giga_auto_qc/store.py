@@ -0,0 +1,157 @@
+import json
+import os
+import sqlite3
+from typing import Callable, Dict, List, Union
+from pathlib import Path
+
+# bump when the way a metric is computed changes, to invalidate old records
+METRICS_VERSION = 1
+
+
+class MetricsStore:
+    """
+    Persistent per-scan metrics, keyed by the file and the parameters used
+    to compute them.
+
+    A record is reused only if the file has the same size and modification
+    time, and the metric was computed with the same parameters (scrubbing
+    threshold, reference mask) and version of the metric.
+
+    Parameters
+    ----------
+
+    database :
+        Path to the SQLite database. Created if it does not exist.
+    """
+
+    def __init__(self, database: Path) -> None:
+        self.database = Path(database)
+        self.database.parent.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._connection = sqlite3.connect(self.database, timeout=60)
+        with self._connection as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS metrics ("
+                "path TEXT, size INTEGER, mtime INTEGER, kind TEXT, "
+                "parameters TEXT, value TEXT, "
+                "PRIMARY KEY (path, kind, parameters))"
+            )
+
+    def get(
+        self, kind: str, parameters: str, paths: List[Union[str, Path]]
+    ) -> Dict[str, object]:
+        """
+        Look up the stored metrics of unchanged files.
+
+        Parameters
+        ----------
+
+        kind :
+            Name of the metric.
+
+        parameters :
+            Parameters used to compute the metric.
+
+        paths :
+            Files to look up.
+
+        Return
+        ------
+        dict
+            Stored metric by path, for the files found in the store.
+        """
+        parameters = f"{parameters}:v{METRICS_VERSION}"
+        signatures = {str(path): _signature(path) for path in paths}
+        stored = {}
+        with self._connection as connection:
+            for path, size, mtime, value in connection.execute(
+                "SELECT path, size, mtime, value FROM metrics "
+                "WHERE kind = ? AND parameters = ?",
+                (kind, parameters),
+            ):
+                if signatures.get(path) == (size, mtime):
+                    stored[path] = json.loads(value)
+        self.hits += len(stored)
+        self.misses += len(signatures) - len(stored)
+        return stored
+
+    def set(
+        self, kind: str, parameters: str, values: Dict[str, object]
+    ) -> None:
+        """
+        Save metrics of files.
+
+        Parameters
+        ----------
+
+        kind :
+            Name of the metric.
+
+        parameters :
+            Parameters used to compute the metric.
+
+        values :
+            Metric by path.
+        """
+        parameters = f"{parameters}:v{METRICS_VERSION}"
+        records = [
+            (str(path), *_signature(path), kind, parameters, json.dumps(value))
+            for path, value in values.items()
+        ]
+        with self._connection as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?, ?, ?)",
+                records,
+            )
+
+    def map(
+        self,
+        kind: str,
+        parameters: str,
+        paths: List[Union[str, Path]],
+        compute: Callable[[list], list],
+    ) -> list:
+        """
+        Metrics of files, computing only the new or modified ones.
+
+        Parameters
+        ----------
+
+        kind :
+            Name of the metric.
+
+        parameters :
+            Parameters used to compute the metric.
+
+        paths :
+            Files to get the metric for.
+
+        compute :
+            Computes the metric for a list of files, in input order.
+
+        Return
+        ------
+        list
+            Metric of each file, in input order.
+        """
+        stored = self.get(kind, parameters, paths)
+        missing = [path for path in paths if str(path) not in stored]
+        if missing:
+            computed = dict(zip(map(str, missing), compute(missing)))
+            self.set(kind, parameters, computed)
+            stored.update(computed)
+        return [stored[str(path)] for path in paths]
+
+    def report(self) -> str:
+        """Summary of the store usage."""
+        return (
+            f"Metrics store: {self.hits} scans reused, "
+            f"{self.misses} scans computed."
+        )
+
+
+def _signature(path: Union[str, Path]) -> tuple:
+    """Size and modification time of a file."""
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
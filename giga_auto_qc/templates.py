@@ -0,0 +1,128 @@
+import os
+import shutil
+from typing import Sequence, Tuple
+from pathlib import Path
+
+import numpy as np
+import nibabel as nib
+
+from giga_auto_qc.cache import ReferenceMaskCache, _atomic_write
+
+TEMPLATE = "MNI152NLin2009cAsym"
+TEMPLATE_MASK = f"tpl-{TEMPLATE}_res-01_desc-brain_mask.nii.gz"
+# common fMRIPrep output resolutions (mm) resampled when building the cache
+RESAMPLED_RESOLUTIONS = (2, 3)
+
+
+def template_cache_dir() -> Path:
+    """
+    Directory of the local template cache.
+
+    Set with the environment variable ``GIGA_AUTO_QC_TEMPLATE_CACHE``,
+    default to ``~/.cache/giga_auto_qc/templates``.
+    """
+    cache_dir = os.environ.get("GIGA_AUTO_QC_TEMPLATE_CACHE")
+    if cache_dir:
+        return Path(cache_dir)
+    return Path.home() / ".cache" / "giga_auto_qc" / "templates"
+
+
+def get_template_mask() -> Path:
+    """
+    Path to the 1 mm MNI152NLin2009cAsym brain mask.
+
+    The mask is read from the local template cache. TemplateFlow is only
+    imported to build the cache when it does not exist yet; if the cache
+    directory is not writable, the TemplateFlow file is used directly.
+
+    Return
+    ------
+    pathlib.Path
+        Path to the template brain mask.
+    """
+    template_mask = template_cache_dir() / TEMPLATE_MASK
+    if template_mask.exists():
+        return template_mask
+    try:
+        return build_template_cache()
+    except OSError:
+        return _fetch_template()
+
+
+def build_template_cache(
+    resolutions: Sequence[int] = RESAMPLED_RESOLUTIONS,
+) -> Path:
+    """
+    Copy the template brain mask from TemplateFlow to the local cache and
+    resample it to common fMRIPrep resolutions.
+
+    Run once where TemplateFlow has network access (e.g. when building a
+    container), so the compute nodes do not need TemplateFlow. The files
+    are written to temporary files first and moved in place, so
+    concurrent jobs never read a partial file.
+
+    Parameters
+    ----------
+
+    resolutions :
+        Isotropic voxel sizes (mm) of the grids to resample the mask to.
+
+    Return
+    ------
+    pathlib.Path
+        Path to the cached template brain mask.
+    """
+    cache_dir = template_cache_dir()
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    template_mask = cache_dir / TEMPLATE_MASK
+    # jobs starting together on a cold cache only see a complete template
+    with open(_fetch_template(), "rb") as source:
+        with _atomic_write(template_mask) as f:
+            shutil.copyfileobj(source, f)
+
+    reference_cache = ReferenceMaskCache(cache_dir=resampled_dir())
+    for resolution in resolutions:
+        reference_cache.get(template_mask, *template_grid(resolution))
+    return template_mask
+
+
+def resampled_dir() -> Path:
+    """Directory of the template mask resampled to common resolutions."""
+    return template_cache_dir() / "resampled"
+
+
+def template_grid(resolution: int) -> Tuple[np.ndarray, Tuple[int, ...]]:
+    """
+    Affine and shape of the template space at an isotropic resolution,
+    covering the same field of view as the 1 mm template.
+
+    Parameters
+    ----------
+
+    resolution :
+        Isotropic voxel size (mm).
+
+    Return
+    ------
+    numpy.ndarray
+        Affine of the grid.
+
+    tuple
+        Shape of the grid.
+    """
+    template_mask = nib.load(template_cache_dir() / TEMPLATE_MASK)
+    affine = template_mask.affine.copy()
+    affine[:3, :3] *= resolution
+    shape = np.ceil(np.array(template_mask.shape[:3]) / resolution)
+    return affine, tuple(int(s) for s in shape)
+
+
+def _fetch_template() -> Path:
+    """Get the template brain mask from TemplateFlow."""
+    import templateflow.api
+
+    return Path(
+        templateflow.api.get(
+            [TEMPLATE], desc="brain", suffix="mask", resolution="01"
+        )
+    )
@@ -0,0 +1,78 @@
+import json
+
+import numpy as np
+import nibabel as nib
+import pytest
+
+TEMPLATE = "MNI152NLin2009cAsym"
+
+
+def create_fmriprep_derivative(
+    root,
+    n_subjects=4,
+    tasks=("rest",),
+    n_runs=2,
+    sessions=(),
+    session_anat=False,
+):
+    """Write a small fMRIPrep-like derivative with brain masks and
+    confounds. With session_anat, each session has its own anatomical
+    mask instead of a subject level one."""
+    rng = np.random.default_rng(42)
+    root.mkdir(parents=True, exist_ok=True)
+    with open(root / "dataset_description.json", "w") as f:
+        json.dump(
+            {
+                "Name": "synthetic",
+                "BIDSVersion": "1.4.0",
+                "DatasetType": "derivative",
+            },
+            f,
+        )
+    anat_affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    func_affine = np.diag([4.0, 4.0, 4.0, 1.0])
+    for i in range(1, n_subjects + 1):
+        sub = f"sub-{i}"
+        anat_sessions = sessions if session_anat else [None]
+        for j, ses in enumerate(anat_sessions):
+            anat_dir = root / sub / (f"ses-{ses}" if ses else "") / "anat"
+            anat_dir.mkdir(parents=True)
+            prefix = f"{sub}_ses-{ses}" if ses else sub
+            anat = np.zeros((20, 24, 20), dtype=np.uint8)
+            anat[3:17, 3 + (i + j) % 2 : 21, 3:17] = 1
+            nib.Nifti1Image(anat, anat_affine).to_filename(
+                anat_dir / f"{prefix}_space-{TEMPLATE}_desc-brain_mask.nii.gz"
+            )
+        for ses in sessions or [None]:
+            func_dir = root / sub / (f"ses-{ses}" if ses else "") / "func"
+            func_dir.mkdir(parents=True)
+            for task in tasks:
+                for run in range(1, n_runs + 1):
+                    prefix = f"{sub}_task-{task}_run-{run}"
+                    if ses:
+                        prefix = f"{sub}_ses-{ses}_task-{task}_run-{run}"
+                    func = np.zeros((10, 12, 10), dtype=np.uint8)
+                    func[2:8, 2 + (i + run) % 3 : 10, 2:8] = 1
+                    nib.Nifti1Image(func, func_affine).to_filename(
+                        func_dir
+                        / f"{prefix}_space-{TEMPLATE}_desc-brain_mask.nii.gz"
+                    )
+                    fd = rng.random(30) * 0.5
+                    confounds = ["csf\tframewise_displacement", "0.1\tn/a"]
+                    confounds += [f"0.1\t{v:.4f}" for v in fd[1:]]
+                    with open(
+                        func_dir / f"{prefix}_desc-confounds_timeseries.tsv",
+                        "w",
+                    ) as f:
+                        f.write("\n".join(confounds) + "\n")
+    return root
+
+
+@pytest.fixture
+def fmriprep_derivative(tmp_path):
+    """Synthetic fMRIPrep derivative and its reference template mask."""
+    template = np.zeros((40, 48, 40), dtype=np.uint8)
+    template[6:34, 6:42, 6:34] = 1
+    template_mask = nib.Nifti1Image(template, np.eye(4))
+    bids_dir = create_fmriprep_derivative(tmp_path / "fmriprep")
+    return bids_dir, template_mask
@@ -1,12 +1,19 @@
+import os
+import shutil
+
 import numpy as np
 import pandas as pd
 from nibabel import Nifti1Image
 from giga_auto_qc import assessments
+from giga_auto_qc.cache import PackedMask, PackedMaskCache, PackedMaskStore
+from giga_auto_qc.file_index import FileIndex
 from bids import BIDSLayout
 from pkg_resources import resource_filename
 import pytest
 import templateflow
 
+from giga_auto_qc.tests.conftest import create_fmriprep_derivative
+
 
 def test_quality_accessments():
     functional_metrics = pd.DataFrame(
@@ -32,6 +39,49 @@ def test_quality_accessments():
     assert metrics["pass_all_qc"].astype(int).sum() == 1
 
 
+def test_quality_accessments_anatomical_join():
+    """Each scan gets the anatomical metrics of its subject."""
+    functional_metrics = pd.DataFrame(
+        {
+            "mean_fd_raw": [0.2, 0.2, 0.2],
+            "proportion_kept": [0.9, 0.9, 0.9],
+            "functional_dice": [0.9, 0.9, 0.9],
+        },
+        index=[
+            "sub-001_task-rest_run-1",
+            "sub-002_ses-1_task-rest",
+            "sub-001_task-rest_run-2",
+        ],
+    )
+    anatomical_metrics = pd.DataFrame(
+        {"anatomical_dice": [0.99, 0.5], "pass_qc": [True, False]},
+        index=["001", "002"],
+    )
+    qc = {
+        "mean_fd": 0.55,
+        "proportion_kept": 0.5,
+        "functional_dice": 0.87,
+    }
+    metrics = assessments.quality_accessments(
+        functional_metrics.copy(), anatomical_metrics, qc
+    )
+    assert metrics["anatomical_dice"].tolist() == [0.99, 0.5, 0.99]
+    assert metrics["pass_all_qc"].tolist() == [True, False, True]
+
+    with pytest.raises(KeyError, match="sub-002"):
+        assessments.quality_accessments(
+            functional_metrics.copy(), anatomical_metrics.iloc[:1], qc
+        )
+
+    # session specific anatomical masks take precedence
+    anatomical_metrics.loc["002_ses-1"] = [0.98, True]
+    metrics = assessments.quality_accessments(
+        functional_metrics.copy(), anatomical_metrics, qc
+    )
+    assert metrics["anatomical_dice"].tolist() == [0.99, 0.98, 0.99]
+    assert metrics["pass_all_qc"].tolist() == [True, True, True]
+
+
 def test_dice_coefficient():
     """Check the dice coefficient is calculated correctly."""
     # test image of (5, 5, 6)
@@ -59,6 +109,44 @@ def test_dice_coefficient():
     )
 
 
+def _dense_dice(mask, reference):
+    """Dice coefficient of two boolean arrays."""
+    intersection = np.count_nonzero(mask & reference)
+    return 2 * intersection / (mask.sum() + reference.sum())
+
+
+def _blob(rng, shape):
+    """Random mask in a random bounding box."""
+    mask = np.zeros(shape, dtype=bool)
+    box = tuple(
+        slice(*sorted(rng.choice(size + 1, 2, replace=False)))
+        for size in shape
+    )
+    mask[box] = rng.random(mask[box].shape) > 0.3
+    return mask
+
+
+def test_batch_dice():
+    """Batched dice over packed masks matches the dice of each mask."""
+    rng = np.random.default_rng(0)
+    shape = (5, 7, 19)  # not a multiple of 8 voxels along a line
+    reference = _blob(rng, shape)
+    masks = [_blob(rng, shape) for _ in range(20)]
+    masks.append(np.zeros(shape, dtype=bool))
+    masks.append(reference)
+    packed_masks = [PackedMask.pack(mask, np.eye(4)) for mask in masks]
+    packed_reference = PackedMask.pack(reference, np.eye(4))
+    dice = assessments._batch_dice(
+        packed_masks, packed_reference, block_size=4
+    )
+    expected = [_dense_dice(mask, reference) for mask in masks]
+    assert dice.tolist() == expected
+    assert dice[-1] == 1
+    assert [m.intersection(packed_reference) for m in packed_masks] == [
+        np.count_nonzero(mask & reference) for mask in masks
+    ]
+
+
 def test_check_mask_affine():
     """Check odd affine detection."""
 
@@ -128,3 +216,338 @@ def test_calculate_anat_metrics():
     )
 
     assert df.shape == (2, 2)
+
+
+def test_parallel_metrics_match_serial(fmriprep_derivative):
+    """Process pool returns the same metrics as the serial loop."""
+    bids_dir, template_mask = fmriprep_derivative
+    fmriprep_bids_layout = BIDSLayout(
+        root=bids_dir,
+        database_path=bids_dir,
+        validate=False,
+        derivatives=True,
+        reset_database=True,
+    )
+    reference_masks = {"anat": template_mask, "func": template_mask}
+    qc = {"scrubbing_fd": 0.2, "anatomical_dice": 0.97}
+    subjects = ["1", "2", "3", "4"]
+
+    serial = assessments.calculate_functional_metrics(
+        subjects, "rest", fmriprep_bids_layout, reference_masks, qc
+    )
+    parallel = assessments.calculate_functional_metrics(
+        subjects, "rest", fmriprep_bids_layout, reference_masks, qc, n_jobs=2
+    )
+    assert serial.shape == (8, 4)
+    pd.testing.assert_frame_equal(serial, parallel)
+    prefetched = assessments.calculate_functional_metrics(
+        subjects, "rest", fmriprep_bids_layout, reference_masks, qc, prefetch=3
+    )
+    pd.testing.assert_frame_equal(serial, prefetched)
+
+    serial = assessments.calculate_anat_metrics(
+        subjects, fmriprep_bids_layout, reference_masks, qc
+    )
+    parallel = assessments.calculate_anat_metrics(
+        subjects, fmriprep_bids_layout, reference_masks, qc, n_jobs=2
+    )
+    pd.testing.assert_frame_equal(serial, parallel)
+
+
+@pytest.mark.parametrize("session_anat", [False, True])
+def test_session_filter(tmp_path, session_anat):
+    """Only the selected sessions are assessed."""
+    bids_dir = create_fmriprep_derivative(
+        tmp_path / "fmriprep",
+        n_subjects=2,
+        sessions=("1", "2"),
+        session_anat=session_anat,
+    )
+    template = np.zeros((40, 48, 40), dtype=np.uint8)
+    template[6:34, 6:42, 6:34] = 1
+    template_mask = Nifti1Image(template, np.eye(4))
+    reference_masks = {"anat": template_mask, "func": template_mask}
+    qc = {
+        "mean_fd": 0.55,
+        "scrubbing_fd": 0.2,
+        "proportion_kept": 0.5,
+        "functional_dice": 0.89,
+        "anatomical_dice": 0.97,
+    }
+    fmriprep_bids_layout = BIDSLayout(
+        root=bids_dir,
+        database_path=bids_dir,
+        validate=False,
+        derivatives=True,
+        reset_database=True,
+    )
+    functional_metrics = assessments.calculate_functional_metrics(
+        ["1", "2"],
+        "rest",
+        fmriprep_bids_layout,
+        reference_masks,
+        qc,
+        sessions=["2"],
+    )
+    assert len(functional_metrics) == 4
+    assert functional_metrics.index.str.contains("_ses-2_").all()
+
+    anatomical_metrics = assessments.calculate_anat_metrics(
+        ["1", "2"], fmriprep_bids_layout, reference_masks, qc, sessions=["2"]
+    )
+    if session_anat:
+        assert anatomical_metrics.index.tolist() == [
+            "1",
+            "1_ses-2",
+            "2",
+            "2_ses-2",
+        ]
+        # the subject falls back to its first selected session, the mask
+        # of session 1 is not read
+        assert (
+            anatomical_metrics.loc["1", "anatomical_dice"]
+            == anatomical_metrics.loc["1_ses-2", "anatomical_dice"]
+        )
+    else:
+        assert anatomical_metrics.index.tolist() == ["1", "2"]
+    metrics = assessments.quality_accessments(
+        functional_metrics, anatomical_metrics, qc
+    )
+    expected = "1_ses-2" if session_anat else "1"
+    assert (
+        metrics.loc["sub-1_ses-2_task-rest_run-1", "anatomical_dice"]
+        == anatomical_metrics.loc[expected, "anatomical_dice"]
+    )
+
+    if session_anat:
+        # a subject without a mask in the selected sessions fails
+        shutil.rmtree(bids_dir / "sub-2" / "ses-2")
+        file_index = FileIndex.from_directory(
+            bids_dir, ["1", "2"], verbose=0, sessions=["2"]
+        )
+        anatomical_metrics = assessments.calculate_anat_metrics(
+            ["1", "2"], file_index, reference_masks, qc, sessions=["2"]
+        )
+        assert anatomical_metrics.index.tolist() == ["1", "1_ses-2", "2"]
+        assert np.isnan(anatomical_metrics.loc["2", "anatomical_dice"])
+        assert not anatomical_metrics.loc["2", "pass_qc"]
+
+
+def test_prefetch():
+    """Items are loaded in order, at most depth items ahead."""
+    loaded = []
+
+    def load(item):
+        loaded.append(item)
+        return item * 2
+
+    results = []
+    for value in assessments._prefetch(load, list(range(20)), 4):
+        # the thread pool never runs more than depth + 1 items ahead
+        assert len(loaded) <= len(results) + 5
+        results.append(value)
+    assert results == [i * 2 for i in range(20)]
+    assert list(assessments._prefetch(load, [1, 2], 0)) == [2, 4]
+
+
+def test_check_mask_affine_from_headers(tmp_path):
+    """Read affine from file headers and tolerate rounding noise."""
+    processed_vol = np.zeros([5, 5, 6])
+    processed_vol[2:4, 2:4, 2:4] += 1
+    affines = [np.eye(4), np.eye(4), np.eye(4), np.eye(4)]
+    affines[1][0, 3] += 1e-6  # rounding noise from the resampling
+    affines[3][2, 2] = 1.5
+    mask_imgs = []
+    for i, affine in enumerate(affines):
+        mask_img = tmp_path / f"sub-{i}_task-rest_desc-brain_mask.nii.gz"
+        Nifti1Image(processed_vol, affine).to_filename(mask_img)
+        mask_imgs.append(str(mask_img))
+    exclude = assessments._check_mask_affine(mask_imgs, verbose=2)
+    assert exclude == [3]
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_group_mask_matches_intersect_masks(tmp_path, n_jobs):
+    """Streaming group mask is identical to nilearn intersect_masks."""
+    from nilearn.masking import intersect_masks
+
+    rng = np.random.default_rng(0)
+    mask_imgs = []
+    for i in range(7):
+        mask = np.zeros([10, 10, 12], dtype=np.uint8)
+        mask[2:8, 2:8, 2:10] = rng.random([6, 6, 8]) > 0.3
+        mask[0, 0, 0] = 1  # isolated voxel outside the largest component
+        mask_img = tmp_path / f"sub-{i}_task-rest_desc-brain_mask.nii.gz"
+        Nifti1Image(mask, np.eye(4)).to_filename(mask_img)
+        mask_imgs.append(str(mask_img))
+
+    expected = intersect_masks(mask_imgs, threshold=0.5)
+    mask_cache = PackedMaskCache()
+    group_mask = assessments._group_mask(
+        mask_imgs, 0.5, n_jobs=n_jobs, mask_cache=mask_cache
+    )
+    np.testing.assert_array_equal(group_mask.affine, expected.affine)
+    np.testing.assert_array_equal(group_mask.get_fdata(), expected.get_fdata())
+    # every mask is kept, packed
+    for mask_img in mask_imgs:
+        np.testing.assert_array_equal(
+            mask_cache.get(mask_img).unpack(), assessments._load_mask(mask_img)
+        )
+
+    # with a memory budget, the chunks stop packing once their share is full
+    mask_size = mask_cache.nbytes // len(mask_imgs)
+    mask_cache = PackedMaskCache(max_bytes=4 * mask_size)
+    store = PackedMaskStore(tmp_path / "packed_masks")
+    group_mask = assessments._group_mask(
+        mask_imgs,
+        0.5,
+        n_jobs=n_jobs,
+        mask_cache=mask_cache,
+        mask_store=store,
+    )
+    np.testing.assert_array_equal(group_mask.get_fdata(), expected.get_fdata())
+    assert 0 < mask_cache.nbytes <= mask_cache.max_bytes
+    # every mask is saved in the store, as it is read
+    assert all(store.load(mask_img) is not None for mask_img in mask_imgs)
+
+
+def test_group_mask_and_dice_from_mask_store(tmp_path, monkeypatch):
+    """A second run scores the masks saved by the first without reading
+    them, with the same results."""
+    rng = np.random.default_rng(0)
+    mask_imgs = []
+    for i in range(5):
+        mask = np.zeros([10, 10, 12], dtype=np.uint8)
+        mask[2:8, 2:8, 2:10] = rng.random([6, 6, 8]) > 0.3
+        mask_img = tmp_path / f"sub-{i}_task-rest_desc-brain_mask.nii.gz"
+        Nifti1Image(mask, np.eye(4)).to_filename(mask_img)
+        mask_imgs.append(str(mask_img))
+    expected = assessments._group_mask(mask_imgs)
+    expected_dice = assessments._map_dice(mask_imgs, expected)
+
+    store = PackedMaskStore(tmp_path / "packed_masks")
+    assessments._group_mask(mask_imgs, mask_store=store)
+    assert store.misses == 5
+
+    def no_read(*args, **kwargs):
+        raise AssertionError("mask read from disk")
+
+    monkeypatch.setattr(assessments, "_read_mask", no_read)
+    monkeypatch.setattr(assessments, "_count_masks", no_read)
+    store = PackedMaskStore(tmp_path / "packed_masks")
+    group_mask = assessments._group_mask(mask_imgs, mask_store=store)
+    np.testing.assert_array_equal(group_mask.get_fdata(), expected.get_fdata())
+    dice = assessments._map_dice(mask_imgs, group_mask, mask_store=store)
+    assert dice == expected_dice
+    assert store.hits == 10 and store.misses == 0
+
+
+@pytest.mark.skipif(
+    not os.path.isdir("/proc/self/fd"), reason="needs /proc/self/fd"
+)
+def test_mask_store_file_descriptors(tmp_path):
+    """Stored masks are not all kept open: a repeat run holds more stored
+    masks than the limit of open files."""
+    import resource
+
+    n_masks = 300
+    mask_imgs = []
+    for i in range(n_masks):
+        mask = np.zeros([4, 4, 8], dtype=np.uint8)
+        mask[1:3, 1:3, i % 8] = 1
+        mask_img = tmp_path / f"sub-{i}_task-rest_desc-brain_mask.nii.gz"
+        Nifti1Image(mask, np.eye(4)).to_filename(mask_img)
+        mask_imgs.append(str(mask_img))
+    store = PackedMaskStore(tmp_path / "packed_masks")
+    expected = assessments._group_mask(mask_imgs, mask_store=store)
+    expected_dice = assessments._map_dice(mask_imgs, expected)
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    n_open = len(os.listdir("/proc/self/fd"))
+    resource.setrlimit(resource.RLIMIT_NOFILE, (n_open + 100, hard))
+    try:
+        mask_cache = PackedMaskCache()
+        store = PackedMaskStore(tmp_path / "packed_masks")
+        group_mask = assessments._group_mask(
+            mask_imgs, mask_cache=mask_cache, mask_store=store
+        )
+        dice = assessments._map_dice(
+            mask_imgs, group_mask, mask_cache=mask_cache, mask_store=store
+        )
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+    np.testing.assert_array_equal(group_mask.get_fdata(), expected.get_fdata())
+    assert dice == expected_dice
+    assert store.hits == 2 * n_masks
+    assert mask_cache.nbytes == 0
+
+
+def test_dice_from_group_mask_pass(fmriprep_derivative, monkeypatch):
+    """Masks read for the group mask are scored without reading them."""
+    bids_dir, template_mask = fmriprep_derivative
+    fmriprep_bids_layout = BIDSLayout(
+        root=bids_dir,
+        database_path=bids_dir,
+        validate=False,
+        derivatives=True,
+        reset_database=True,
+    )
+    monkeypatch.setattr(
+        assessments, "get_template_mask", lambda: template_mask
+    )
+    subjects = ["1", "2", "3", "4"]
+    qc = {"scrubbing_fd": 0.2}
+    mask_cache = PackedMaskCache()
+    reference_masks, _ = assessments.get_reference_mask(
+        "group",
+        subjects,
+        ["rest"],
+        fmriprep_bids_layout,
+        mask_cache=mask_cache,
+    )
+    expected = assessments.calculate_functional_metrics(
+        subjects, "rest", fmriprep_bids_layout, reference_masks, qc
+    )
+
+    def no_read(*args, **kwargs):
+        raise AssertionError("mask read from disk")
+
+    monkeypatch.setattr(assessments, "_load_mask", no_read)
+    monkeypatch.setattr(assessments.nib, "load", no_read)
+    metrics = assessments.calculate_functional_metrics(
+        subjects,
+        "rest",
+        fmriprep_bids_layout,
+        reference_masks,
+        qc,
+        mask_cache=mask_cache,
+    )
+    pd.testing.assert_frame_equal(metrics, expected)
+    assert mask_cache.hits == 8 and mask_cache.misses == 0
+
+
+def test_read_framewise_displacement(tmp_path):
+    """Only the framewise displacement column is parsed."""
+    confound_file = tmp_path / "sub-1_task-rest_desc-confounds_timeseries.tsv"
+    confounds = pd.DataFrame(
+        {
+            "csf": [1.0, 2.0, 3.0, 4.0],
+            "framewise_displacement": [np.nan, 0.1, 0.25, 0.05],
+            "a_comp_cor_00": [0.5, 0.5, 0.5, 0.5],
+        }
+    )
+    confounds.to_csv(confound_file, sep="\t", index=False, na_rep="n/a")
+    fd = assessments._read_framewise_displacement(confound_file)
+    expected = pd.read_csv(confound_file, sep="\t")["framewise_displacement"]
+    np.testing.assert_array_equal(fd, expected.to_numpy())
+
+    # framewise displacement as the last column
+    confounds[["csf", "framewise_displacement"]].to_csv(
+        confound_file, sep="\t", index=False, na_rep="n/a"
+    )
+    fd = assessments._read_framewise_displacement(confound_file)
+    np.testing.assert_array_equal(fd, expected.to_numpy())
+
+    confounds[["csf"]].to_csv(confound_file, sep="\t", index=False)
+    with pytest.raises(KeyError, match="framewise_displacement"):
+        assessments._read_framewise_displacement(confound_file)
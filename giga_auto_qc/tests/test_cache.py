@@ -0,0 +1,122 @@
+import os
+
+import numpy as np
+import pytest
+from nibabel import Nifti1Image
+from giga_auto_qc import assessments
+from giga_auto_qc.cache import (
+    PackedMask,
+    PackedMaskCache,
+    PackedMaskStore,
+    ReferenceMaskCache,
+    _atomic_write,
+)
+
+
+def _masks():
+    template_vol = np.zeros([10, 10, 12])
+    template_vol[2:8, 2:8, 2:10] = 1
+    template = Nifti1Image(template_vol, np.eye(4))
+    processed_vol = np.zeros([5, 5, 6])
+    processed_vol[1:4, 1:4, 1:5] = 1
+    processed = Nifti1Image(processed_vol, np.eye(4) * [2, 2, 2, 1])
+    return template, processed
+
+
+def test_reference_mask_cache():
+    """Resample once per grid and match the uncached dice."""
+    template, processed = _masks()
+    cache = ReferenceMaskCache()
+    expected = assessments._dice_coefficient(processed, template)
+    for _ in range(3):
+        dice = assessments._dice_coefficient(processed, template, cache)
+        assert dice == expected
+    assert cache.misses == 1
+    assert cache.hits == 2
+
+    # the same grid with different content is a different reference
+    other_template = Nifti1Image(np.ones([10, 10, 12]), np.eye(4))
+    assessments._dice_coefficient(processed, other_template, cache)
+    assert cache.misses == 2
+
+
+def test_reference_mask_cache_on_disk(tmp_path):
+    """Reuse the resampled masks saved by a previous run."""
+    template, processed = _masks()
+    template.to_filename(tmp_path / "template.nii.gz")
+    template = tmp_path / "template.nii.gz"
+    cache_dir = tmp_path / "cache"
+
+    cache = ReferenceMaskCache(cache_dir=cache_dir)
+    expected = cache.get(template, processed.affine, processed.shape)
+    assert len(list(cache_dir.glob("*.npy"))) == 1
+    assert not list(cache_dir.glob("*.tmp"))
+
+    new_cache = ReferenceMaskCache(cache_dir=cache_dir)
+    mask = new_cache.get(template, processed.affine, processed.shape)
+    assert new_cache.disk_hits == 1
+    assert new_cache.misses == 0
+    np.testing.assert_array_equal(mask, expected)
+    assert "1 loaded from disk" in new_cache.report()
+
+
+def test_packed_mask_cache():
+    rng = np.random.default_rng(0)
+    mask = np.zeros((5, 7, 19), dtype=bool)
+    mask[1:3, 2:5, 9:12] = rng.random((2, 3, 3)) > 0.3
+    packed = PackedMask.pack(mask, np.eye(4))
+    np.testing.assert_array_equal(packed.unpack(), mask)
+    assert packed.count == mask.sum()
+    # cropped to the bounding box, one byte per 8 voxels of a line
+    assert packed.origin == (1, 2, 1) and packed.bits.shape == (2, 3, 1)
+    box, voxel_box = packed.unpack_box()
+    np.testing.assert_array_equal(box, mask[voxel_box])
+    assert packed.intersection(packed) == packed.count
+    empty = PackedMask.pack(np.zeros((5, 7, 19), dtype=bool), np.eye(4))
+    assert empty.bits.size == 0 and not empty.unpack().any()
+    assert packed.intersection(empty) == 0
+
+    cache = PackedMaskCache(max_bytes=10)
+    assert cache.add("a.nii.gz", packed)
+    assert not cache.add("b.nii.gz", packed)  # over the memory budget
+    assert "a.nii.gz" in cache and "b.nii.gz" not in cache
+    assert cache.get("b.nii.gz") is None
+    assert cache.get("a.nii.gz") is packed
+    assert cache.hits == 1 and cache.misses == 1
+
+
+def test_packed_mask_store(tmp_path):
+    """Masks are memory-mapped from disk until the mask file changes."""
+    rng = np.random.default_rng(0)
+    mask = rng.random((5, 7, 3)) > 0.5
+    affine = np.diag([2.0, 2.0, 2.0, 1.0])
+    mask_img = tmp_path / "sub-1_desc-brain_mask.nii.gz"
+    Nifti1Image(mask.astype(np.uint8), affine).to_filename(mask_img)
+
+    store = PackedMaskStore(tmp_path / "packed_masks")
+    assert store.load(mask_img) is None
+    store.save(mask_img, PackedMask.pack(mask, affine))
+
+    stored = PackedMaskStore(tmp_path / "packed_masks").load(mask_img)
+    assert isinstance(stored.bits, np.memmap)
+    assert stored.shape == (5, 7, 3) and stored.count == mask.sum()
+    np.testing.assert_array_equal(stored.affine, affine)
+    np.testing.assert_array_equal(stored.unpack(), mask)
+
+    stat = os.stat(mask_img)
+    os.utime(mask_img, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert store.load(mask_img) is None
+    assert store.hits == 0 and store.misses == 2
+
+
+def test_atomic_write(tmp_path):
+    """An interrupted write leaves neither the file nor a temporary file."""
+    with pytest.raises(KeyboardInterrupt):
+        with _atomic_write(tmp_path / "mask.npy") as f:
+            f.write(b"partial")
+            raise KeyboardInterrupt
+    assert not list(tmp_path.iterdir())
+    with _atomic_write(tmp_path / "mask.npy") as f:
+        np.save(f, np.arange(3))
+    np.testing.assert_array_equal(np.load(tmp_path / "mask.npy"), np.arange(3))
+    assert [p.name for p in tmp_path.iterdir()] == ["mask.npy"]
@@ -1,3 +1,6 @@
+import subprocess
+import sys
+
 from pkg_resources import resource_filename
 
 from giga_auto_qc.run import main
@@ -58,3 +61,52 @@ def test_smoke_group(tmp_path, capsys):
     )
     captured = capsys.readouterr()
     assert "Create dataset level functional brain mask" in captured.out
+
+
+def test_shard_argument(capsys):
+    with pytest.raises(SystemExit):
+        main(["bids_dir", "output_dir", "participant", "--shard", "4/3"])
+    captured = capsys.readouterr()
+    assert "Shard index should be between 1 and N" in captured.err
+
+
+def test_import_time():
+    """The command line entry point does not load the analysis stack."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import giga_auto_qc.run"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    # lines of "import time: self [us] | cumulative | module"
+    imports = {}
+    for line in result.stderr.splitlines()[1:]:
+        _, cumulative, module = line.split("|")
+        imports[module.strip()] = int(cumulative)
+    for heavy in ("bids", "nibabel", "nilearn", "numpy", "pandas", "tqdm"):
+        assert heavy not in imports
+    assert imports["giga_auto_qc.run"] < 500_000
+
+
+@pytest.mark.smoke
+def test_smoke_shard_merge(tmp_path):
+    """Sharded runs merged give the same reports as a single run."""
+    bids_dir = resource_filename(
+        "giga_auto_qc",
+        "data/test_data/ds000017-fmriprep22.0.1-downsampled-nosurface",
+    )
+    main([str(bids_dir), str(tmp_path / "full"), "group"])
+    for shard in ("1/2", "2/2"):
+        main(
+            [
+                str(bids_dir),
+                str(tmp_path / "shards"),
+                "group",
+                "--shard",
+                shard,
+            ]
+        )
+    main([str(bids_dir), str(tmp_path / "shards"), "merge"])
+    for report in (tmp_path / "full").glob("task-*_report.tsv"):
+        merged = tmp_path / "shards" / report.name
+        assert merged.read_text() == report.read_text()
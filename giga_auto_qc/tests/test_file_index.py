@@ -0,0 +1,104 @@
+import pandas as pd
+from bids import BIDSLayout
+from giga_auto_qc import assessments
+from giga_auto_qc.file_index import FileIndex, parse_bids_filename
+from giga_auto_qc.tests.conftest import create_fmriprep_derivative
+
+
+def test_parse_bids_filename():
+    entities = parse_bids_filename(
+        "/data/sub-01/ses-1/func/sub-01_ses-1_task-rest_acq-mb_run-2_"
+        "space-MNI152NLin2009cAsym_desc-brain_mask.nii.gz"
+    )
+    assert entities["subject"] == "01"
+    assert entities["session"] == "1"
+    assert entities["acquisition"] == "mb"
+    assert entities["run"] == "2"
+    assert entities["desc"] == "brain"
+    assert entities["suffix"] == "mask"
+    assert entities["extension"] == "nii.gz"
+    assert entities["datatype"] == "func"
+
+
+def test_file_index_matches_layout(fmriprep_derivative):
+    """Queries to the index return the same files as the layout."""
+    bids_dir, template_mask = fmriprep_derivative
+    fmriprep_bids_layout = BIDSLayout(
+        root=bids_dir,
+        database_path=bids_dir,
+        validate=False,
+        derivatives=True,
+        reset_database=True,
+    )
+    subjects = ["1", "2", "3"]
+    file_index = FileIndex.from_layout(fmriprep_bids_layout, subjects)
+    assert file_index.get_tasks() == ["rest"]
+    for query in (
+        {
+            "subject": subjects,
+            "task": "rest",
+            "desc": "confounds",
+            "extension": "tsv",
+        },
+        {
+            "subject": "2",
+            "space": "MNI152NLin2009cAsym",
+            "desc": ["brain"],
+            "suffix": ["mask"],
+            "extension": ".nii.gz",
+            "datatype": "anat",
+        },
+    ):
+        expected = fmriprep_bids_layout.get(**query, return_type="file")
+        assert file_index.get(**query, return_type="file") == expected
+
+    reference_masks = {"anat": template_mask, "func": template_mask}
+    qc = {"scrubbing_fd": 0.2}
+    pd.testing.assert_frame_equal(
+        assessments.calculate_functional_metrics(
+            subjects, "rest", file_index, reference_masks, qc
+        ),
+        assessments.calculate_functional_metrics(
+            subjects, "rest", fmriprep_bids_layout, reference_masks, qc
+        ),
+    )
+
+
+def test_file_index_from_directory(fmriprep_derivative):
+    """Walking the directory finds the same files as pybids."""
+    bids_dir, _ = fmriprep_derivative
+    fmriprep_bids_layout = BIDSLayout(
+        root=bids_dir,
+        database_path=bids_dir,
+        validate=False,
+        derivatives=True,
+        reset_database=True,
+    )
+    subjects = ["1", "2", "4"]
+    from_layout = FileIndex.from_layout(fmriprep_bids_layout, subjects)
+    from_directory = FileIndex.from_directory(bids_dir, subjects)
+    assert len(from_directory) == len(from_layout) == 15
+    assert from_directory.get() == from_layout.get()
+    assert from_directory.get_tasks() == ["rest"]
+
+
+def test_file_index_sessions(tmp_path):
+    """Only the selected session directories are indexed."""
+    bids_dir = create_fmriprep_derivative(
+        tmp_path / "fmriprep", n_subjects=2, sessions=("1", "2")
+    )
+    file_index = FileIndex.from_directory(bids_dir, ["1", "2"], sessions=["2"])
+    files = file_index.get()
+    assert len(files) == 2 + 2 * 2 * 2
+    assert not any("ses-1" in f for f in files)
+    fmriprep_bids_layout = BIDSLayout(
+        root=bids_dir,
+        database_path=bids_dir,
+        validate=False,
+        derivatives=True,
+        reset_database=True,
+    )
+    from_layout = FileIndex.from_layout(
+        fmriprep_bids_layout, ["1", "2"], sessions=["2"]
+    )
+    assert from_layout.get() == files
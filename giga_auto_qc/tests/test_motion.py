@@ -0,0 +1,77 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from giga_auto_qc import assessments
+from giga_auto_qc.motion import FDArchive
+
+
+def _write_confounds(path, framewise_displacement):
+    pd.DataFrame(
+        {
+            "csf": np.ones(len(framewise_displacement)),
+            "framewise_displacement": framewise_displacement,
+        }
+    ).to_csv(path, sep="\t", index=False, na_rep="n/a")
+
+
+def test_fd_archive(tmp_path):
+    """Series are saved in one file and only modified files are read."""
+    rng = np.random.default_rng(0)
+    files = []
+    for i, n_volumes in enumerate([5, 12, 1]):
+        path = tmp_path / f"sub-{i}_task-rest_desc-confounds_timeseries.tsv"
+        fd = rng.random(n_volumes)
+        fd[0] = np.nan
+        _write_confounds(path, fd)
+        files.append(path)
+    read = []
+
+    def read_files(paths):
+        read.extend(paths)
+        return [assessments._read_framewise_displacement(p) for p in paths]
+
+    archive = FDArchive()
+    series = archive.map(files, read_files)
+    assert read == files and len(archive) == 3
+    archive.save(tmp_path / "fd_archive.npz")
+
+    # modified file in a later run
+    read.clear()
+    _write_confounds(files[1], np.arange(4.0))
+    stat = os.stat(files[1])
+    os.utime(files[1], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    archive = FDArchive(reuse=FDArchive.load(tmp_path / "fd_archive.npz"))
+    reused = archive.map(files, read_files)
+    assert read == [files[1]]
+    assert archive.hits == 2 and archive.misses == 1
+    np.testing.assert_array_equal(reused[0], series[0])
+    np.testing.assert_array_equal(reused[1], np.arange(4.0))
+    assert archive.identifiers == [
+        "sub-0_task-rest",
+        "sub-1_task-rest",
+        "sub-2_task-rest",
+    ]
+
+
+@pytest.mark.filterwarnings("ignore:Mean of empty slice")
+@pytest.mark.parametrize("block_size", [2, 1024])
+def test_sweep_matches_motion_metrics(block_size):
+    """Scrubbing metrics of the sweep match the single threshold ones."""
+    rng = np.random.default_rng(0)
+    archive = FDArchive()
+    for i, n_volumes in enumerate([50, 3, 20, 1, 35]):
+        fd = np.round(rng.random(n_volumes) * 0.6, 2)
+        fd[0] = np.nan
+        archive.add(f"sub-{i}_desc-confounds_timeseries.tsv", fd, (0, 0))
+    thresholds = [0.5, 0.2, 0.3, 0.0]
+    sweep = archive.sweep(thresholds, block_size=block_size)
+    assert len(sweep) == len(archive) * len(thresholds)
+    for identifier, threshold, scrubbed, kept in sweep.itertuples():
+        expected = assessments._motion_metrics(archive[identifier], threshold)
+        np.testing.assert_allclose(
+            [scrubbed, kept],
+            [expected["mean_fd_scrubbed"], expected["proportion_kept"]],
+            rtol=1e-12,
+        )
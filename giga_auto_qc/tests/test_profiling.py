@@ -0,0 +1,51 @@
+import json
+
+from bids import BIDSLayout
+from giga_auto_qc import assessments
+from giga_auto_qc.profiling import StageProfiler
+
+
+def test_stage_profiler(tmp_path):
+    profiler = StageProfiler()
+    with profiler.stage("indexing") as record:
+        record["items"] = 3
+    with profiler.stage("fd", task="rest"):
+        sum(range(10**5))
+    profiler.write(tmp_path / "qc_profile.json")
+    with open(tmp_path / "qc_profile.json") as f:
+        profile = json.load(f)
+    assert profile["peak_rss_workers_mb"] >= 0
+    assert [s["stage"] for s in profile["stages"]] == ["indexing", "fd"]
+    assert profile["stages"][0]["items"] == 3
+    assert profile["stages"][1]["task"] == "rest"
+    for stage in profile["stages"]:
+        assert stage["wall_seconds"] >= 0
+        assert stage["cpu_seconds"] >= 0
+        assert stage["peak_rss_mb"] > 0
+        assert "peak_rss_workers_mb" not in stage
+    assert "fd task-rest" in profiler.report()
+
+
+def test_functional_metrics_stages(fmriprep_derivative):
+    """Framewise displacement and dice are recorded as separate stages."""
+    bids_dir, template_mask = fmriprep_derivative
+    fmriprep_bids_layout = BIDSLayout(
+        root=bids_dir,
+        database_path=bids_dir,
+        validate=False,
+        derivatives=True,
+        reset_database=True,
+    )
+    profiler = StageProfiler()
+    assessments.calculate_functional_metrics(
+        ["1", "2"],
+        "rest",
+        fmriprep_bids_layout,
+        {"anat": template_mask, "func": template_mask},
+        {"scrubbing_fd": 0.2},
+        profiler=profiler,
+    )
+    assert [(s["stage"], s["items"]) for s in profiler.stages] == [
+        ("fd", 4),
+        ("dice", 4),
+    ]
@@ -0,0 +1,82 @@
+import os
+
+import pandas as pd
+from bids import BIDSLayout
+from giga_auto_qc import assessments
+from giga_auto_qc.motion import FDArchive
+from giga_auto_qc.store import MetricsStore
+
+
+def test_metrics_store(tmp_path):
+    """Only new or modified files are computed."""
+    files = []
+    for i in range(3):
+        path = tmp_path / f"sub-{i}.tsv"
+        path.write_text(str(i))
+        files.append(path)
+    computed = []
+
+    def compute(paths):
+        computed.extend(paths)
+        return [{"value": int(p.read_text())} for p in paths]
+
+    store = MetricsStore(tmp_path / "cache" / "metrics.sqlite")
+    values = store.map("test", "a=1", files, compute)
+    assert values == [{"value": 0}, {"value": 1}, {"value": 2}]
+    assert len(computed) == 3
+
+    # new session, one modified file
+    computed.clear()
+    files[1].write_text("10")
+    stat = os.stat(files[1])
+    os.utime(files[1], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    store = MetricsStore(tmp_path / "cache" / "metrics.sqlite")
+    values = store.map("test", "a=1", files, compute)
+    assert values == [{"value": 0}, {"value": 10}, {"value": 2}]
+    assert computed == [files[1]]
+    assert store.hits == 2 and store.misses == 1
+
+    # different parameters are computed again
+    computed.clear()
+    store.map("test", "a=2", files, compute)
+    assert len(computed) == 3
+
+
+def test_functional_metrics_from_store(fmriprep_derivative, tmp_path):
+    """Metrics reused from the store are the same as the computed ones."""
+    bids_dir, template_mask = fmriprep_derivative
+    fmriprep_bids_layout = BIDSLayout(
+        root=bids_dir,
+        database_path=bids_dir,
+        validate=False,
+        derivatives=True,
+        reset_database=True,
+    )
+    reference_masks = {"anat": template_mask, "func": template_mask}
+    qc = {"scrubbing_fd": 0.2}
+    subjects = ["1", "2", "3", "4"]
+    store = MetricsStore(tmp_path / "metrics.sqlite")
+    fd_archive = FDArchive()
+    computed = assessments.calculate_functional_metrics(
+        subjects,
+        "rest",
+        fmriprep_bids_layout,
+        reference_masks,
+        qc,
+        metrics_store=store,
+        fd_archive=fd_archive,
+    )
+    # the dice is stored, the framewise displacement is archived
+    assert store.misses == 8 and fd_archive.misses == 8
+    fd_archive = FDArchive(reuse=fd_archive)
+    stored = assessments.calculate_functional_metrics(
+        subjects,
+        "rest",
+        fmriprep_bids_layout,
+        reference_masks,
+        qc,
+        metrics_store=store,
+        fd_archive=fd_archive,
+    )
+    assert store.hits == 8 and fd_archive.hits == 8
+    pd.testing.assert_frame_equal(computed, stored)
@@ -0,0 +1,38 @@
+import sys
+
+import numpy as np
+from nibabel import Nifti1Image
+from giga_auto_qc import templates
+from giga_auto_qc.cache import ReferenceMaskCache
+
+
+def test_template_cache(tmp_path, monkeypatch):
+    """The cached template and its resampled masks are used offline."""
+    data = np.zeros((9, 11, 9), dtype=np.int8)
+    data[2:7, 2:9, 2:7] = 1
+    source = tmp_path / "templateflow" / templates.TEMPLATE_MASK
+    source.parent.mkdir()
+    Nifti1Image(data, np.eye(4)).to_filename(source)
+    monkeypatch.setenv("GIGA_AUTO_QC_TEMPLATE_CACHE", str(tmp_path / "tpl"))
+    monkeypatch.setattr(templates, "_fetch_template", lambda: source)
+
+    template_mask = templates.get_template_mask()
+    assert template_mask == tmp_path / "tpl" / templates.TEMPLATE_MASK
+    assert len(list(templates.resampled_dir().glob("*.npy"))) == 2
+    assert not list((tmp_path / "tpl").rglob("*.tmp"))
+    assert templates.template_grid(2)[1] == (5, 6, 5)
+
+    # templateflow is not imported once the cache exists
+    monkeypatch.setitem(sys.modules, "templateflow", None)
+    monkeypatch.setattr(templates, "_fetch_template", None)
+    assert templates.get_template_mask() == template_mask
+
+    reference_cache = ReferenceMaskCache(
+        extra_dirs=[templates.resampled_dir()]
+    )
+    for resolution in templates.RESAMPLED_RESOLUTIONS:
+        reference_cache.get(
+            template_mask, *templates.template_grid(resolution)
+        )
+    assert reference_cache.disk_hits == 2
+    assert reference_cache.misses == 0
@@ -3,6 +3,7 @@ import pandas as pd
 import numpy as np
 from bids.tests import get_test_data_path
 from giga_auto_qc import utils
+import pytest
 
 
 def test_get_subject_lists():
@@ -18,6 +19,11 @@ def test_get_subject_lists():
     assert subjects[0] == "01"
 
 
+def test_get_session_lists():
+    assert utils.get_session_lists(None) is None
+    assert utils.get_session_lists(["ses-1", "2"]) == ["1", "2"]
+
+
 def test_parse_scan_information():
     bids_specifier_index = [
         "sub-test_ses-baseline_task-rest_run-001",
@@ -58,3 +64,44 @@ def test_parse_scan_information():
     )
     parsed = utils.parse_scan_information(metrics=metrics)
     assert list(parsed.columns[:4]) == ["participant_id", "task", "acq", "run"]
+    assert pd.isna(parsed.loc["sub-test_task-finger", "acq"])
+    assert parsed.loc["sub-test_task-rest_acq-2_run-001", "acq"] == "2"
+    assert parsed.loc["sub-test_task-rest_run-002", "run"] == "002"
+
+
+def test_parse_scan_information_entities():
+    bids_specifier_index = [
+        "sub-01_task-rest_dir-PA_echo-1",
+        "sub-02_ses-1_task-rest_rec-norm_run-1",
+        "sub-03_task-rest_custom-x-y_run-2",
+        "sub-04_task-rest_bold",
+    ]
+    metrics = pd.DataFrame(
+        np.random.random((4, 2)), index=bids_specifier_index
+    )
+    parsed = utils.parse_scan_information(metrics=metrics)
+    assert parsed.index.name == "identifier"
+    assert list(parsed.columns[:-2]) == [
+        "participant_id",
+        "ses",
+        "task",
+        "rec",
+        "dir",
+        "run",
+        "echo",
+        "custom",
+    ]
+    assert parsed["participant_id"].tolist() == ["01", "02", "03", "04"]
+    assert parsed.loc["sub-01_task-rest_dir-PA_echo-1", "dir"] == "PA"
+    assert parsed.loc["sub-03_task-rest_custom-x-y_run-2", "custom"] == "x-y"
+    assert parsed["run"].isna().tolist() == [True, False, False, True]
+    assert isinstance(parsed["task"].dtype, pd.CategoricalDtype)
+
+
+def test_get_shard():
+    subjects = [f"{i:02d}" for i in range(10, 0, -1)]
+    shards = [utils.get_shard(subjects, i, 3) for i in range(1, 4)]
+    assert shards[0] == ["01", "04", "07", "10"]
+    assert sorted(sum(shards, [])) == sorted(subjects)
+    with pytest.raises(ValueError):
+        utils.get_shard(subjects, 4, 3)
@@ -0,0 +1,202 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+from nibabel import Nifti1Image
+from giga_auto_qc import templates, utils
+from giga_auto_qc.cache import reference_identity
+from giga_auto_qc.motion import FDArchive
+from giga_auto_qc.workflow import (
+    DEFAULT_QC_STANDARD,
+    combine_reports,
+    load_group_mask,
+    load_quality_control_parameters,
+    reports_from_metrics,
+    save_group_mask,
+    write_report,
+)
+
+
+def _task_report(task):
+    identifiers = [
+        f"sub-{sub}_ses-{ses}_task-{task}_run-1"
+        for sub in ("01", "02")
+        for ses in ("a", "b")
+    ]
+    metrics = pd.DataFrame(
+        {
+            "mean_fd_raw": [0.1, 0.2, 0.3, 0.4],
+            "pass_func_qc": [True, False, True, True],
+            "different_func_affine": [False] * 4,
+        },
+        index=identifiers,
+    )
+    return utils.parse_scan_information(metrics)
+
+
+@pytest.mark.parametrize("output_format", ["parquet", "feather"])
+def test_write_columnar_report(tmp_path, output_format):
+    """Columnar reports keep booleans and store entities as categoricals."""
+    report = _task_report("rest")
+    path = tmp_path / f"task-rest_report.{output_format}"
+    write_report(report, path)
+    if output_format == "parquet":
+        written = pd.read_parquet(path)
+    else:
+        written = pd.read_feather(path).set_index("identifier")
+    assert written.index.tolist() == report.index.tolist()
+    assert written["pass_func_qc"].dtype == bool
+    assert written["participant_id"].dtype == "category"
+    assert written["ses"].tolist() == ["a", "b", "a", "b"]
+    pd.testing.assert_series_equal(
+        written["mean_fd_raw"], report["mean_fd_raw"]
+    )
+
+
+def test_combine_reports(tmp_path):
+    reports = {"rest": _task_report("rest"), "nback": _task_report("nback")}
+    combined = combine_reports(reports)
+    assert len(combined) == 8
+    assert combined.index.is_monotonic_increasing
+    assert set(combined["task"]) == {"rest", "nback"}
+
+    write_report(combined, tmp_path / "all-tasks_report.tsv")
+    written = pd.read_csv(
+        tmp_path / "all-tasks_report.tsv", sep="\t", index_col="identifier"
+    )
+    assert written.index.tolist() == combined.index.tolist()
+
+    with pytest.raises(ValueError, match="Unknown report format"):
+        write_report(combined, tmp_path / "report.csv")
+
+
+def test_load_quality_control_parameters(tmp_path):
+    assert load_quality_control_parameters() == {
+        "default": DEFAULT_QC_STANDARD
+    }
+    strict = dict(DEFAULT_QC_STANDARD, mean_fd=0.3)
+    (tmp_path / "strict.json").write_text(json.dumps(strict))
+    parameter_sets = load_quality_control_parameters(
+        [tmp_path / "strict.json"]
+    )
+    assert parameter_sets == {"strict": strict}
+
+    (tmp_path / "other").mkdir()
+    (tmp_path / "other" / "strict.json").write_text(json.dumps(strict))
+    with pytest.raises(ValueError, match="different names"):
+        load_quality_control_parameters(
+            [tmp_path / "strict.json", tmp_path / "other" / "strict.json"]
+        )
+    (tmp_path / "bad.json").write_text(json.dumps({"mean_fd": 0.3}))
+    with pytest.raises(ValueError, match="should contain"):
+        load_quality_control_parameters([tmp_path / "bad.json"])
+
+
+def test_reports_from_metrics(tmp_path):
+    """New parameters are applied to the saved metrics, and the scrubbing
+    metrics are recomputed from the framewise displacement archive."""
+    metrics_dir = tmp_path / "metrics"
+    metrics_dir.mkdir()
+    pd.DataFrame(
+        {"anatomical_dice": [0.995, 0.98], "pass_qc": [True, False]},
+        index=pd.Index(["01", "02"], name="participant_id"),
+    ).to_csv(metrics_dir / "desc-anat_metrics.tsv", sep="\t")
+    fd_archive = FDArchive()
+    fd = np.array([np.nan, 0.1, 0.25, 0.4, 0.15])
+    for sub in ("01", "02"):
+        fd_archive.add(f"sub-{sub}_task-rest_desc-confounds.tsv", fd, (0, 0))
+    fd_archive.save(tmp_path / "fd_archive.npz")
+    identifiers = ["sub-01_task-rest", "sub-02_task-rest"]
+    pd.DataFrame(
+        {
+            "mean_fd_raw": [0.225] * 2,
+            "mean_fd_scrubbed": [0.125] * 2,
+            "proportion_kept": [0.4] * 2,
+            "functional_dice": [1.0, 1.0],
+            "different_func_affine": [False] * 2,
+        },
+        index=pd.Index(identifiers, name="identifier"),
+    ).to_csv(metrics_dir / "task-rest_desc-raw_metrics.tsv", sep="\t")
+
+    parameter_sets = {
+        "default": DEFAULT_QC_STANDARD,
+        "lenient": dict(
+            DEFAULT_QC_STANDARD, scrubbing_fd=0.3, anatomical_dice=0.97
+        ),
+    }
+    reports_from_metrics(tmp_path, parameter_sets, verbose=0)
+    default = pd.read_csv(
+        tmp_path / "default" / "task-rest_report.tsv",
+        sep="\t",
+        index_col="identifier",
+    )
+    lenient = pd.read_csv(
+        tmp_path / "lenient" / "task-rest_report.tsv",
+        sep="\t",
+        index_col="identifier",
+    )
+    assert default["proportion_kept"].tolist() == [0.4, 0.4]
+    assert default["pass_all_qc"].tolist() == [False, False]
+    assert lenient["proportion_kept"].tolist() == [0.6, 0.6]
+    assert lenient["mean_fd_scrubbed"].tolist() == pytest.approx([0.5 / 3] * 2)
+    assert lenient["pass_anat_qc"].tolist() == [True, True]
+    assert lenient["pass_all_qc"].tolist() == [True, True]
+    assert (tmp_path / "lenient" / "all-tasks_report.tsv").exists()
+
+
+def test_group_mask_for_shards(tmp_path, monkeypatch):
+    """The group mask is reused for the same selection only, with the same
+    identity as the mask it was saved from."""
+    monkeypatch.setattr(templates, "get_template_mask", lambda: "tpl.nii.gz")
+    data = np.zeros((6, 7, 5), dtype=np.uint8)
+    data[1:5, 2:6, 1:4] = 1
+    group_mask = Nifti1Image(data, np.diag([2.0, 2.0, 2.0, 1.0]))
+    selection = {"subjects": ["1", "2"], "tasks": ["rest"], "sessions": None}
+    assert load_group_mask(tmp_path, selection) is None
+
+    odd_affine = {"rest": ["sub-2_task-rest_run-2"]}
+    save_group_mask(tmp_path, selection, group_mask, odd_affine)
+    reference_masks, weird = load_group_mask(tmp_path, selection)
+    assert reference_masks["anat"] == "tpl.nii.gz"
+    assert weird == odd_affine
+    assert reference_identity(reference_masks["func"]) == reference_identity(
+        group_mask
+    )
+    assert load_group_mask(tmp_path, dict(selection, tasks=["nback"])) is None
+
+
+def test_empty_shard(fmriprep_derivative, tmp_path, monkeypatch):
+    """A shard without subjects writes empty metrics, and the shards merge
+    to the reports of a single run."""
+    from giga_auto_qc import assessments
+    from giga_auto_qc.run import main
+
+    bids_dir, template_mask = fmriprep_derivative
+    monkeypatch.setattr(templates, "get_template_mask", lambda: template_mask)
+    monkeypatch.setattr(
+        assessments, "get_template_mask", lambda: template_mask
+    )
+    args = [str(bids_dir), "--participant_label", "1", "2", "--indexer"]
+    args += ["fast", "--verbose", "0"]
+    main([*args[:1], str(tmp_path / "full"), "group", *args[1:]])
+    for shard in ("1/3", "2/3", "3/3"):
+        main(
+            [
+                *args[:1],
+                str(tmp_path / "shards"),
+                "group",
+                *args[1:],
+                "--shard",
+                shard,
+            ]
+        )
+    shards_dir = tmp_path / "shards" / "shards"
+    empty = pd.read_csv(
+        shards_dir / "shard-3of3_task-rest_desc-raw_metrics.tsv", sep="\t"
+    )
+    assert empty.empty and "functional_dice" in empty.columns
+    main([*args[:1], str(tmp_path / "shards"), "merge", *args[1:]])
+    for report in (tmp_path / "full").glob("task-*_report.tsv"):
+        merged = tmp_path / "shards" / report.name
+        assert merged.read_text() == report.read_text()
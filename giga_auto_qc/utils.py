@@ -1,16 +1,50 @@
-from typing import List
+from typing import List, Tuple
 from pathlib import Path
+import numpy as np
 import pandas as pd
 
+# BIDS entities in the order of the specification (v1.9)
 BIDS_ENTITIES = {
-    "sub": 0,
-    "ses": 1,
-    "task": 2,
-    "acq": 3,
-    "run": 4,
+    entity: order
+    for order, entity in enumerate(
+        [
+            "sub",
+            "ses",
+            "sample",
+            "task",
+            "tracksys",
+            "acq",
+            "ce",
+            "trc",
+            "stain",
+            "rec",
+            "dir",
+            "run",
+            "mod",
+            "echo",
+            "flip",
+            "inv",
+            "mt",
+            "part",
+            "proc",
+            "hemi",
+            "space",
+            "split",
+            "recording",
+            "chunk",
+            "seg",
+            "res",
+            "den",
+            "label",
+            "desc",
+        ]
+    )
 }
 
 
+_SEPARATOR, _NEWLINE, _DASH = (ord(c) for c in "_\n-")
+
+
 def get_subject_lists(
     participant_label: List[str] = None, bids_dir: Path = None
 ) -> List[str]:
@@ -52,10 +86,68 @@ def get_subject_lists(
     ]
 
 
+def get_session_lists(session_label: List[str] = None) -> List[str]:
+    """
+    Parse session list from user options.
+
+    Parameters
+    ----------
+
+    session_label :
+
+        A list of BIDS competible session identifiers.
+        If the prefix `ses-` is present, it will be removed.
+
+    Return
+    ------
+
+    List or None
+        BIDS session identifier without `ses-` prefix. None when no session
+        is selected, meaning all sessions.
+    """
+    if not session_label:
+        return None
+    return [ses_id.replace("ses-", "") for ses_id in session_label]
+
+
+def get_shard(subjects: List[str], shard: int, n_shards: int) -> List[str]:
+    """
+    Deterministic subset of subjects processed by one shard.
+
+    Subjects are sorted and dealt to the shards in turn, so every subject
+    belongs to exactly one shard and the shards have similar sizes.
+
+    Parameters
+    ----------
+
+    subjects :
+        BIDS subject identifiers.
+
+    shard :
+        Index of the shard, from 1 to n_shards.
+
+    n_shards :
+        Total number of shards.
+
+    Return
+    ------
+
+    List
+        BIDS subject identifiers of the shard.
+    """
+    if not 1 <= shard <= n_shards:
+        raise ValueError(
+            f"Shard index should be between 1 and {n_shards}, got {shard}."
+        )
+    first = shard - 1
+    return sorted(subjects)[first::n_shards]
+
+
 def parse_scan_information(metrics: pd.DataFrame) -> pd.DataFrame:
     """
-    Parse the identifier into BIDS entities: subject, session, task, run.
-    If session and run are not present, the information will not be parsed.
+    Parse the identifier into BIDS entities: subject, session, task, run,
+    and any other entity present. An entity missing from some identifiers
+    is empty for those scans.
 
     Parameters
     ----------
@@ -66,30 +158,121 @@ def parse_scan_information(metrics: pd.DataFrame) -> pd.DataFrame:
     Returns
     -------
     pandas.DataFrame
-        Quality assessment with BIDS entity separated.
+        Quality assessment with BIDS entity separated, as categoricals, in
+        the order of the BIDS specification. Entities not in the
+        specification follow, in order of appearance.
     """
     metrics.index.name = "identifier"
-
-    # get all unique entities
-    headers_members = set()
-    for id in metrics.index:
-        examplar = id.split("_")
-        new_headers = set([e.split("-")[0] for e in examplar])
-        headers_members.update(new_headers)
-    ordered_header = [None] * len(BIDS_ENTITIES)
-    for header in headers_members:
-        ordered_header[BIDS_ENTITIES[header]] = header
-    headers = [h for h in ordered_header if h is not None]  # remove none
-
-    identifiers = pd.DataFrame(
-        metrics.index.tolist(), index=metrics.index, columns=["identifier"]
-    )
-    identifiers[headers] = identifiers["identifier"].str.split(
-        "_", expand=True
-    )
-    identifiers = identifiers.drop("identifier", axis=1)
-    for h in headers:
-        identifiers[h] = identifiers[h].str.replace(f"{h}-", "")
+    identifiers = parse_entities(metrics.index)
     identifiers = identifiers.rename(columns={"sub": "participant_id"})
     metrics = pd.concat((identifiers, metrics), axis=1)
     return metrics
+
+
+def parse_entities(identifiers: pd.Index) -> pd.DataFrame:
+    """
+    Split BIDS identifiers into one column per entity.
+
+    All identifiers are parsed at once as a byte buffer: each
+    ``key-value`` field is located from the positions of the separators,
+    and the keys and values are factorised with numpy and pandas, so no
+    Python code runs per identifier. It is about 5 times faster than a
+    loop over the identifiers and 15 times faster than ``str.extractall``
+    on 1M identifiers, see ``benchmarks/bench_parse_scan_information.py``.
+
+    Parameters
+    ----------
+
+    identifiers:
+        BIDS identifiers, e.g. ``sub-01_ses-1_task-rest_run-1``.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Categorical value of each entity, with the identifiers as index.
+    """
+    columns = {}
+    if len(identifiers):
+        text = "\n".join(identifiers.astype(str)) + "\n"
+        buffer = np.frombuffer(text.encode(), dtype=np.uint8)
+        # separators and dashes, in order of position
+        events = np.flatnonzero(
+            (buffer == _SEPARATOR) | (buffer == _NEWLINE) | (buffer == _DASH)
+        )
+        kinds = buffer[events]
+        is_end = kinds != _DASH
+        ends = events[is_end]
+        starts = np.r_[0, ends[:-1] + 1]
+        rows = np.r_[0, np.cumsum(kinds[is_end][:-1] == _NEWLINE)]
+        # the event after the end of a field is the first dash of the next
+        # field, if it has one; fields without a dash are skipped
+        first = np.r_[0, np.flatnonzero(is_end)[:-1] + 1]
+        keep = kinds[first] == _DASH
+        starts, ends, rows = starts[keep], ends[keep], rows[keep]
+        dashes = events[first[keep]]
+        key_codes, keys = _factorize_spans(buffer, starts, dashes - starts)
+        value_codes, values = _factorize_spans(
+            buffer, dashes + 1, ends - dashes - 1
+        )
+        # group the fields by key, keeping the row order; a stable sort of
+        # small integers is a radix sort
+        fields = np.argsort(
+            key_codes.astype(np.min_scalar_type(len(keys))), kind="stable"
+        )
+        bounds = np.r_[0, np.cumsum(np.bincount(key_codes))]
+        order = np.argsort(
+            [BIDS_ENTITIES.get(k, np.inf) for k in keys], kind="stable"
+        )
+        for code in order:
+            lower, upper = bounds[code], bounds[code + 1]
+            in_field = fields[lower:upper]
+            entity_codes, uniques = pd.factorize(value_codes[in_field])
+            codes = np.full(len(identifiers), -1, dtype=np.int64)
+            codes[rows[in_field]] = entity_codes
+            columns[keys[code]] = pd.Categorical.from_codes(
+                codes, values[uniques]
+            )
+    return pd.DataFrame(columns, index=identifiers)
+
+
+def _factorize_spans(
+    buffer: np.ndarray, starts: np.ndarray, lengths: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Factorise byte spans of a buffer, eight bytes at a time.
+
+    Returns the code of each span and the decoded unique spans, in order
+    of first appearance.
+    """
+    # 8-byte words starting at every byte of the buffer: a view with a
+    # stride of one byte, so word i holds bytes i to i + 7, without a copy
+    padded = np.r_[buffer, np.zeros(8, dtype=np.uint8)]
+    words = np.ndarray(
+        (len(buffer),), dtype="<u8", buffer=padded, strides=(1,)
+    )
+    masks = np.array([(1 << (8 * n)) - 1 for n in range(9)], dtype=np.uint64)
+    codes = np.zeros(len(starts), dtype=np.intp)
+    max_length = lengths.max() if len(lengths) else 0
+    for offset in range(0, max_length, 8):
+        remaining = np.clip(lengths - offset, 0, 8)
+        chunk = words[np.minimum(starts + offset, len(buffer) - 1)]
+        chunk &= masks[remaining]
+        chunk_codes, chunk_uniques = pd.factorize(chunk)
+        # spans longer than 8 bytes: combine with the codes of the
+        # previous words, and renumber the pairs
+        if offset:
+            chunk_codes += codes * len(chunk_uniques)
+            chunk_codes, _ = pd.factorize(chunk_codes)
+        codes = chunk_codes
+    n_codes = codes.max() + 1 if len(codes) else 0
+    first = np.zeros(n_codes, dtype=np.intp)
+    first[codes[::-1]] = np.arange(len(codes))[::-1]
+    # copy the unique spans, one per line, and decode them at once
+    lengths = lengths[first] + 1
+    offsets = np.cumsum(lengths) - lengths
+    positions = np.arange(lengths.sum()) + np.repeat(
+        starts[first] - offsets, lengths
+    )
+    text = buffer[np.minimum(positions, len(buffer) - 1)]
+    text[offsets + lengths - 1] = _NEWLINE
+    uniques = np.array(text.tobytes().decode().split("\n")[:-1], dtype=object)
+    return codes, uniques
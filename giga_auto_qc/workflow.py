@@ -1,7 +1,24 @@
+import gzip
 import json
-from bids import BIDSLayout
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
-from giga_auto_qc import assessments, utils
+import nibabel as nib
+import numpy as np
+import pandas as pd
+from nibabel import Nifti1Image
+
+from giga_auto_qc import assessments, templates, utils
+from giga_auto_qc.cache import (
+    PackedMaskCache,
+    PackedMaskStore,
+    ReferenceMaskCache,
+    _atomic_write,
+)
+from giga_auto_qc.file_index import FileIndex
+from giga_auto_qc.motion import FDArchive
+from giga_auto_qc.profiling import StageProfiler
+from giga_auto_qc.store import MetricsStore
 
 
 DEFAULT_QC_STANDARD = {
@@ -11,6 +28,14 @@ DEFAULT_QC_STANDARD = {
     "anatomical_dice": 0.97,
     "functional_dice": 0.89,
 }
+# columnar formats need pyarrow, installed with giga_auto_qc[columnar]
+REPORT_FORMATS = ("tsv", "parquet", "feather")
+# memory budget of the functional masks kept from the group mask pass
+MASK_CACHE_BYTES = 2 * 1024**3
+# group functional mask saved for the shards, and the selection it was
+# built from with the scans of a different affine
+GROUP_MASK = "group_mask.nii.gz"
+GROUP_MASK_SIDECAR = "group_mask.json"
 
 
 def workflow(args):
@@ -20,72 +45,203 @@ def workflow(args):
     output_dir = args.output_dir
     analysis_level = args.analysis_level
     participant_label = args.participant_label
-    quality_control_parameters = args.quality_control_parameters
+    # the metrics of a previous run are reused without reading the dataset
+    from_metrics = analysis_level == "merge" or args.from_metrics
 
-    if not bids_dir.is_dir():
+    if not from_metrics and not bids_dir.is_dir():
         raise FileNotFoundError(
             "fMRIPrep directory does not exist: " f"{str(bids_dir)}"
         )
 
-    if not quality_control_parameters:
-        quality_control_parameters = DEFAULT_QC_STANDARD
-    else:
-        with open(quality_control_parameters, "r") as f:
-            quality_control_parameters = json.load(f)
-    print(f"Quality control parameters: {quality_control_parameters}")
+    parameter_sets = load_quality_control_parameters(
+        args.quality_control_parameters
+    )
+    for name, parameters in parameter_sets.items():
+        print(f"Quality control parameters {name}: {parameters}")
 
-    if set(quality_control_parameters.keys()) != set(
-        DEFAULT_QC_STANDARD.keys()
-    ):
-        raise ValueError(
-            "The supplied quality control parameter file "
-            f"{args.quality_control_parameters} should contain the following"
-            f"fields: {DEFAULT_QC_STANDARD.keys()}; the supplied file contains"
-            f" {quality_control_parameters.keys()}."
-        )
+    output_format = args.output_format
+    if output_format != "tsv":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError(
+                f"Writing {output_format} reports requires pyarrow. Install "
+                "it with: pip install giga_auto_qc[columnar]"
+            )
 
-    fmriprep_bids_layout = BIDSLayout(
-        root=bids_dir,
-        database_path=bids_dir,
-        validate=False,
-        derivatives=True,
-        reset_database=args.reindex_bids,
-    )
     # check output path
     output_dir.mkdir(parents=True, exist_ok=True)
 
+    if from_metrics:
+        reports_from_metrics(
+            output_dir,
+            parameter_sets,
+            args.verbose,
+            output_format,
+            args.scrubbing_sweep,
+            shards=analysis_level == "merge",
+        )
+        return
+    # the motion metrics are computed with the first parameters, and
+    # recomputed from the framewise displacement archive for the others
+    quality_control_parameters = next(iter(parameter_sets.values()))
+
+    reference_cache = ReferenceMaskCache(
+        cache_dir=output_dir / "cache" / "reference_masks"
+        if args.reference_cache
+        else None,
+        extra_dirs=[templates.resampled_dir()],
+    )
+
+    metrics_store = (
+        MetricsStore(output_dir / "cache" / "metrics.sqlite")
+        if args.metrics_store
+        else None
+    )
+    mask_store = (
+        PackedMaskStore(output_dir / "cache" / "packed_masks")
+        if args.mask_store
+        else None
+    )
+    # framewise displacement of the last run, reused with the metrics store
+    fd_archive_file = output_dir / "fd_archive.npz"
+    fd_archive = FDArchive(
+        reuse=FDArchive.load(fd_archive_file)
+        if args.metrics_store and fd_archive_file.exists()
+        else None
+    )
+
     # get subject list
     subjects = utils.get_subject_lists(participant_label, bids_dir)
+    sessions = utils.get_session_lists(args.session)
+    # the group mask is built from all subjects, the metrics on the shard
+    shard_subjects = (
+        utils.get_shard(subjects, *args.shard) if args.shard else subjects
+    )
+    if args.shard:
+        print(
+            f"Shard {args.shard[0]} of {args.shard[1]}: "
+            f"{len(shard_subjects)} out of {len(subjects)} subjects."
+        )
+    profiler = StageProfiler()
+    # the group mask of a shard reads the masks of all subjects, only keep
+    # them when they are all scored
+    mask_cache = None if args.shard else PackedMaskCache(MASK_CACHE_BYTES)
+    # query all the files needed once
+    with profiler.stage("indexing") as record:
+        if args.indexer == "fast":
+            file_index = FileIndex.from_directory(
+                bids_dir, subjects, verbose=args.verbose, sessions=sessions
+            )
+        else:
+            from bids import BIDSLayout
+
+            fmriprep_bids_layout = BIDSLayout(
+                root=bids_dir,
+                database_path=bids_dir,
+                validate=False,
+                derivatives=True,
+                reset_database=args.reindex_bids,
+            )
+            file_index = FileIndex.from_layout(
+                fmriprep_bids_layout, subjects, args.verbose, sessions
+            )
+        record["items"] = len(file_index)
     # infer task for bids search
-    tasks = args.task if args.task else fmriprep_bids_layout.get_tasks()
+    tasks = args.task if args.task else file_index.get_tasks()
 
-    (
-        reference_masks,
-        weird_func_mask_identifiers,
-    ) = assessments.get_reference_mask(
-        analysis_level, subjects, tasks, fmriprep_bids_layout, args.verbose
-    )
+    selection = {
+        "subjects": sorted(subjects),
+        "tasks": sorted(tasks),
+        "sessions": sorted(sessions) if sessions else None,
+    }
+    with profiler.stage("reference_mask") as record:
+        # shards reuse the group mask built once for all of them
+        stored = load_group_mask(output_dir, selection) if args.shard else None
+        if stored is not None:
+            print(f"Use the group mask in {output_dir / GROUP_MASK}.")
+            reference_masks, weird_func_mask_identifiers = stored
+        else:
+            if args.shard and len(subjects) > 1:
+                print(
+                    "No group mask for this selection in output_dir: every "
+                    "shard reads all functional masks. Build it once with "
+                    "the 'mask' analysis level first."
+                )
+            (
+                reference_masks,
+                weird_func_mask_identifiers,
+            ) = assessments.get_reference_mask(
+                "group" if analysis_level == "mask" else analysis_level,
+                subjects,
+                tasks,
+                file_index,
+                args.verbose,
+                args.n_jobs,
+                sessions,
+                mask_cache,
+                mask_store,
+            )
+            if isinstance(reference_masks["func"], Nifti1Image):
+                save_group_mask(
+                    output_dir,
+                    selection,
+                    reference_masks["func"],
+                    weird_func_mask_identifiers,
+                )
+        record["items"] = len(subjects)
+    if analysis_level == "mask":
+        profiler.write(output_dir / "qc_profile.json")
+        return
 
-    anatomical_metrics = assessments.calculate_anat_metrics(
-        subjects,
-        fmriprep_bids_layout,
-        reference_masks,
-        quality_control_parameters,
-        args.verbose,
+    with profiler.stage("anat_dice") as record:
+        anatomical_metrics = assessments.calculate_anat_metrics(
+            shard_subjects,
+            file_index,
+            reference_masks,
+            quality_control_parameters,
+            args.verbose,
+            reference_cache,
+            args.n_jobs,
+            metrics_store,
+            prefetch=args.prefetch,
+            sessions=sessions,
+            mask_store=mask_store,
+        )
+        record["items"] = len(anatomical_metrics)
+
+    if args.shard:
+        metrics_dir = output_dir / "shards"
+        prefix = f"shard-{args.shard[0]}of{args.shard[1]}_"
+    else:
+        metrics_dir = output_dir / "metrics"
+        prefix = ""
+    metrics_dir.mkdir(exist_ok=True)
+    anatomical_metrics.to_csv(
+        metrics_dir / f"{prefix}desc-anat_metrics.tsv",
+        sep="\t",
+        index_label="participant_id",
     )
 
+    task_metrics = {}
     for task in tasks:
         print(f"task-{task}")
         metrics = assessments.calculate_functional_metrics(
-            subjects,
+            shard_subjects,
             task,
-            fmriprep_bids_layout,
+            file_index,
             reference_masks,
             quality_control_parameters,
             args.verbose,
-        )
-        metrics = assessments.quality_accessments(
-            metrics, anatomical_metrics, quality_control_parameters
+            reference_cache,
+            args.n_jobs,
+            metrics_store,
+            profiler,
+            args.prefetch,
+            sessions,
+            mask_cache,
+            fd_archive,
+            mask_store,
         )
         metrics["different_func_affine"] = False
         if (
@@ -93,8 +249,544 @@ def workflow(args):
             and task in weird_func_mask_identifiers
         ):
             metrics.loc[
-                weird_func_mask_identifiers[task], "different_func_affine"
+                metrics.index.isin(weird_func_mask_identifiers[task]),
+                "different_func_affine",
             ] = True
-        # split the index into sub - ses - task - run
-        metrics = utils.parse_scan_information(metrics)
-        metrics.to_csv(output_dir / f"task-{task}_report.tsv", sep="\t")
+        metrics.to_csv(
+            metrics_dir / f"{prefix}task-{task}_desc-raw_metrics.tsv",
+            sep="\t",
+            index_label="identifier",
+        )
+        task_metrics[task] = metrics
+    if args.shard:
+        fd_archive.save(metrics_dir / f"{prefix}fd_archive.npz")
+    else:
+        fd_archive.save(fd_archive_file)
+        write_reports(
+            output_dir,
+            anatomical_metrics,
+            task_metrics,
+            parameter_sets,
+            output_format,
+            fd_archive,
+            profiler,
+        )
+        if args.scrubbing_sweep:
+            with profiler.stage("scrubbing_sweep") as record:
+                record["items"] = len(fd_archive)
+                write_report(
+                    scrubbing_sweep(fd_archive, args.scrubbing_sweep),
+                    output_dir / f"scrubbing_sweep.{output_format}",
+                )
+    profiler.write(output_dir / "qc_profile.json")
+    if args.verbose > 0:
+        print(reference_cache.report())
+        print(fd_archive.report())
+        if metrics_store is not None:
+            print(metrics_store.report())
+        if mask_cache is not None:
+            print(mask_cache.report())
+        if mask_store is not None:
+            print(mask_store.report())
+        print(profiler.report())
+
+
+def save_group_mask(
+    output_dir: Path,
+    selection: dict,
+    group_mask: Nifti1Image,
+    weird_func_mask_identifiers: Optional[dict],
+) -> None:
+    """
+    Save the group functional mask for the shards of a run.
+
+    Parameters
+    ----------
+
+    output_dir :
+        Output directory.
+
+    selection :
+        Subjects, tasks and sessions the mask is built from.
+
+    group_mask :
+        Group functional mask.
+
+    weird_func_mask_identifiers :
+        Identifiers of the scans with a different affine, by task.
+    """
+    with _atomic_write(output_dir / GROUP_MASK) as f:
+        f.write(gzip.compress(group_mask.to_bytes()))
+    sidecar = dict(
+        selection, different_func_affine=weird_func_mask_identifiers
+    )
+    # the sidecar is written last: a mask is only used once it is complete
+    with _atomic_write(output_dir / GROUP_MASK_SIDECAR) as f:
+        f.write(json.dumps(sidecar, indent=2).encode())
+
+
+def load_group_mask(
+    output_dir: Path, selection: dict
+) -> Optional[Tuple[dict, Optional[dict]]]:
+    """
+    Reference masks of a run with the group mask saved by
+    :func:`save_group_mask`.
+
+    Parameters
+    ----------
+
+    output_dir :
+        Output directory.
+
+    selection :
+        Subjects, tasks and sessions of the run.
+
+    Returns
+    -------
+    tuple or None
+        Reference masks and identifiers of the scans with a different
+        affine by task, as returned by
+        :func:`giga_auto_qc.assessments.get_reference_mask`. None if no
+        group mask was saved for this selection.
+    """
+    sidecar_file = output_dir / GROUP_MASK_SIDECAR
+    if not sidecar_file.exists():
+        return None
+    with open(sidecar_file, "r") as f:
+        sidecar = json.load(f)
+    if any(sidecar.get(key) != value for key, value in selection.items()):
+        return None
+    group_mask = nib.load(output_dir / GROUP_MASK)
+    reference_masks = {
+        "anat": templates.get_template_mask(),
+        "func": Nifti1Image(
+            np.asanyarray(group_mask.dataobj),
+            group_mask.affine,
+            group_mask.header,
+        ),
+    }
+    return reference_masks, sidecar["different_func_affine"]
+
+
+def load_quality_control_parameters(
+    paths: Optional[List[Path]] = None,
+) -> Dict[str, dict]:
+    """
+    Read quality control parameter files.
+
+    Parameters
+    ----------
+
+    paths :
+        JSON files with the fields of ``DEFAULT_QC_STANDARD``. When None,
+        the default parameters are used.
+
+    Returns
+    -------
+    dict
+        Parameters by name: the file name without extension, or "default".
+    """
+    if not paths:
+        return {"default": DEFAULT_QC_STANDARD}
+    parameter_sets = {}
+    for path in paths:
+        with open(path, "r") as f:
+            parameters = json.load(f)
+        if set(parameters.keys()) != set(DEFAULT_QC_STANDARD.keys()):
+            raise ValueError(
+                "The supplied quality control parameter file "
+                f"{path} should contain the following"
+                f"fields: {DEFAULT_QC_STANDARD.keys()}; the supplied file "
+                f"contains {parameters.keys()}."
+            )
+        name = Path(path).stem
+        if name in parameter_sets:
+            raise ValueError(
+                "Quality control parameter files should have different "
+                f"names, got {name} twice."
+            )
+        parameter_sets[name] = parameters
+    return parameter_sets
+
+
+def write_reports(
+    output_dir: Path,
+    anatomical_metrics: pd.DataFrame,
+    task_metrics: Dict[str, pd.DataFrame],
+    parameter_sets: Dict[str, dict],
+    output_format: str = "tsv",
+    fd_archive: Optional[FDArchive] = None,
+    profiler: Optional[StageProfiler] = None,
+) -> None:
+    """
+    Apply quality control parameters to the raw metrics and write the
+    reports.
+
+    Only the pass / fail flags depend on the parameters, except for the
+    scrubbing threshold: the scrubbing metrics are recomputed from the
+    framewise displacement archive.
+
+    Parameters
+    ----------
+
+    output_dir :
+        Output directory. With several parameter sets, the reports of each
+        set are written in a sub-directory named after the set.
+
+    anatomical_metrics :
+        Anatomical dice, indexed by subject or ``<subject>_ses-<session>``.
+
+    task_metrics :
+        Raw functional metrics of each task, with the identifier as index.
+
+    parameter_sets :
+        Quality control parameters by name.
+
+    output_format : {"tsv", "parquet", "feather"}
+        File format of the reports.
+
+    fd_archive :
+        Framewise displacement series of the scans. When None, the
+        scrubbing metrics of the raw metrics are used as is.
+
+    profiler :
+        Records the time spent writing the reports.
+    """
+    if profiler is None:
+        profiler = StageProfiler()
+    for name, quality_control_parameters in parameter_sets.items():
+        report_dir = output_dir
+        if len(parameter_sets) > 1:
+            report_dir = output_dir / name
+            report_dir.mkdir(exist_ok=True)
+            print(f"Quality control parameters {name}")
+        anatomical_metrics = anatomical_metrics.copy()
+        anatomical_metrics["pass_qc"] = (
+            anatomical_metrics["anatomical_dice"]
+            > quality_control_parameters["anatomical_dice"]
+        )
+        reports = {}
+        for task, metrics in task_metrics.items():
+            with profiler.stage("report", task=task) as record:
+                record["items"] = len(metrics)
+                metrics = _scrubbing_metrics(
+                    metrics,
+                    fd_archive,
+                    quality_control_parameters["scrubbing_fd"],
+                )
+                reports[task] = _report(
+                    metrics, anatomical_metrics, quality_control_parameters
+                )
+                write_report(
+                    reports[task],
+                    report_dir / f"task-{task}_report.{output_format}",
+                )
+        if reports:
+            with profiler.stage("report", task="all") as record:
+                record["items"] = sum(len(r) for r in reports.values())
+                write_report(
+                    combine_reports(reports),
+                    report_dir / f"all-tasks_report.{output_format}",
+                )
+
+
+def reports_from_metrics(
+    output_dir: Path,
+    parameter_sets: Dict[str, dict],
+    verbose: int = 1,
+    output_format: str = "tsv",
+    scrubbing_thresholds: Optional[List[float]] = None,
+    shards: bool = False,
+) -> None:
+    """
+    Write the reports from the raw metrics of previous runs, without
+    reading the dataset.
+
+    Parameters
+    ----------
+
+    output_dir :
+        Output directory of the previous runs, with the metrics under
+        ``metrics/``, or ``shards/`` for sharded runs.
+
+    parameter_sets :
+        Quality control parameters by name, applied to the metrics.
+
+    verbose :
+        Level of verbosity.
+
+    output_format : {"tsv", "parquet", "feather"}
+        File format of the reports.
+
+    scrubbing_thresholds :
+        Also write the scrubbing metrics of every scan for these
+        thresholds (mm).
+
+    shards :
+        Combine the metrics of sharded runs. By default, the metrics of a
+        single run are used when there are any, otherwise those of sharded
+        runs.
+    """
+    if not shards:
+        shards = not (output_dir / "metrics").is_dir()
+    anatomical_metrics, task_metrics, fd_archive = load_metrics(
+        output_dir, shards, verbose
+    )
+    if shards:
+        fd_archive.save(output_dir / "fd_archive.npz")
+    elif not len(fd_archive):
+        print(
+            "No framewise displacement archive, the scrubbing metrics are "
+            "used as computed by the previous run."
+        )
+        fd_archive = None
+    write_reports(
+        output_dir,
+        anatomical_metrics,
+        task_metrics,
+        parameter_sets,
+        output_format,
+        fd_archive,
+    )
+    if scrubbing_thresholds:
+        if fd_archive is None:
+            raise FileNotFoundError(
+                "The scrubbing sweep needs the framewise displacement "
+                f"archive {output_dir / 'fd_archive.npz'}."
+            )
+        write_report(
+            scrubbing_sweep(fd_archive, scrubbing_thresholds),
+            output_dir / f"scrubbing_sweep.{output_format}",
+        )
+
+
+def load_metrics(
+    output_dir: Path, shards: bool = False, verbose: int = 1
+) -> Tuple[pd.DataFrame, Dict[str, pd.DataFrame], FDArchive]:
+    """
+    Read the raw metrics written by previous runs.
+
+    Parameters
+    ----------
+
+    output_dir :
+        Output directory of the previous runs.
+
+    shards :
+        Combine the metrics of sharded runs, under ``shards/``, instead of
+        the metrics of a single run, under ``metrics/``.
+
+    verbose :
+        Level of verbosity.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Anatomical metrics.
+
+    dict of pandas.DataFrame
+        Functional metrics of each task.
+
+    FDArchive
+        Framewise displacement series of the scans; empty when the runs
+        did not save them.
+    """
+    if shards:
+        metrics_dir = output_dir / "shards"
+        anat_files = sorted(metrics_dir.glob("shard-*_desc-anat_metrics.tsv"))
+        if not anat_files:
+            raise FileNotFoundError(
+                f"No shard metrics found in {metrics_dir}."
+            )
+        n_shards = {f.name.split("_")[0].split("of")[-1] for f in anat_files}
+        if len(n_shards) != 1 or len(anat_files) != int(n_shards.pop()):
+            raise ValueError(
+                "Shard metrics are missing or come from different numbers "
+                f"of shards: {[f.name for f in anat_files]}"
+            )
+        if verbose > 0:
+            print(f"Merge the metrics of {len(anat_files)} shards.")
+        prefix = "shard-*_"
+        archive_files = sorted(metrics_dir.glob("shard-*_fd_archive.npz"))
+    else:
+        metrics_dir = output_dir / "metrics"
+        anat_files = [metrics_dir / "desc-anat_metrics.tsv"]
+        if not anat_files[0].exists():
+            raise FileNotFoundError(
+                f"No metrics found in {metrics_dir}; compute them with a "
+                "run without --from-metrics first."
+            )
+        prefix = ""
+        archive_files = [output_dir / "fd_archive.npz"]
+
+    anatomical_metrics = _concat_metrics(
+        anat_files, "participant_id", dtype={"participant_id": str}
+    )
+
+    task_files = {}
+    for f in sorted(metrics_dir.glob(f"{prefix}task-*_desc-raw_metrics.tsv")):
+        task = f.name.split("task-", 1)[1].split("_")[0]
+        task_files.setdefault(task, []).append(f)
+    task_metrics = {
+        task: _concat_metrics(files, "identifier")
+        for task, files in task_files.items()
+    }
+
+    fd_archive = FDArchive()
+    for f in archive_files:
+        if f.exists():
+            fd_archive.update(FDArchive.load(f))
+    return anatomical_metrics, task_metrics, fd_archive
+
+
+def _concat_metrics(
+    metrics_files: List[Path], index_col: str, **kwargs
+) -> pd.DataFrame:
+    """Metrics of several files in one frame, sorted by index. Files
+    without rows, e.g. of an empty shard, only give the columns."""
+    metrics = [
+        pd.read_csv(
+            f,
+            sep="\t",
+            index_col=index_col,
+            float_precision="round_trip",
+            **kwargs,
+        )
+        for f in metrics_files
+    ]
+    not_empty = [m for m in metrics if not m.empty]
+    return pd.concat(not_empty or metrics[:1]).sort_index()
+
+
+def scrubbing_sweep(
+    fd_archive: FDArchive, scrubbing_thresholds: List[float]
+) -> pd.DataFrame:
+    """
+    Scrubbing metrics of every scan for a range of thresholds.
+
+    Parameters
+    ----------
+
+    fd_archive :
+        Framewise displacement series of the scans.
+
+    scrubbing_thresholds :
+        Framewise displacement thresholds (mm) for scrubbing.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per scan and threshold, sorted by identifier and threshold,
+        with the BIDS entities of the identifier.
+    """
+    sweep = fd_archive.sweep(scrubbing_thresholds)
+    return utils.parse_scan_information(sweep.sort_index(kind="stable"))
+
+
+def _scrubbing_metrics(
+    metrics: pd.DataFrame,
+    fd_archive: Optional[FDArchive],
+    scrubbing_fd: float,
+) -> pd.DataFrame:
+    """Recompute the scrubbing metrics of the scans in the framewise
+    displacement archive for a scrubbing threshold."""
+    if fd_archive is None:
+        return metrics
+    in_archive = [i for i in metrics.index if i in fd_archive]
+    if not in_archive:
+        return metrics
+    motion = pd.DataFrame(
+        [
+            assessments._motion_metrics(fd_archive[i], scrubbing_fd)
+            for i in in_archive
+        ],
+        index=in_archive,
+    )
+    metrics = metrics.copy()
+    metrics.loc[in_archive, motion.columns] = motion
+    return metrics
+
+
+def _report(
+    metrics: pd.DataFrame,
+    anatomical_metrics: pd.DataFrame,
+    quality_control_parameters: dict,
+) -> pd.DataFrame:
+    """Apply the quality control standards to the metrics of one task."""
+    metrics = metrics.copy()
+    different_func_affine = metrics.pop("different_func_affine")
+    metrics = assessments.quality_accessments(
+        metrics, anatomical_metrics, quality_control_parameters
+    )
+    metrics["different_func_affine"] = different_func_affine
+    # split the index into sub - ses - task - run
+    return utils.parse_scan_information(metrics)
+
+
+def combine_reports(reports: Dict[str, pd.DataFrame]) -> pd.DataFrame:
+    """
+    Combine the reports of all tasks in one table.
+
+    Parameters
+    ----------
+
+    reports :
+        Report of each task, with the identifier as index.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Reports of all tasks, sorted by identifier. Entities missing from
+        the identifiers of a task are empty.
+    """
+    return pd.concat(reports.values()).sort_index()
+
+
+def write_report(report: pd.DataFrame, path: Path) -> None:
+    """
+    Write a report in the format given by the file extension.
+
+    TSV reports are written as is. Parquet and Feather reports keep the
+    quality control flags as booleans and store the BIDS entities as
+    categoricals; Feather has no index, so the identifier is a column.
+
+    Parameters
+    ----------
+
+    report :
+        Quality control report, with the identifier as index.
+
+    path :
+        Output file, with extension .tsv, .parquet or .feather.
+    """
+    output_format = Path(path).suffix.lstrip(".")
+    if output_format == "tsv":
+        report.to_csv(path, sep="\t")
+        return
+    report = _columnar_dtypes(report)
+    if output_format == "parquet":
+        report.to_parquet(path)
+    elif output_format == "feather":
+        report.reset_index().to_feather(path)
+    else:
+        raise ValueError(
+            f"Unknown report format {output_format}, expected one of "
+            f"{REPORT_FORMATS}."
+        )
+
+
+def _columnar_dtypes(report: pd.DataFrame) -> pd.DataFrame:
+    """Booleans for the quality control flags, categoricals for the BIDS
+    entities."""
+    report = report.copy()
+    report.index = report.index.astype(str)
+    entities = ["participant_id"] + list(utils.BIDS_ENTITIES)
+    for column in report.columns:
+        if column in entities:
+            report[column] = report[column].astype("category")
+        elif column.startswith("pass_") or column == "different_func_affine":
+            if report[column].notna().all():
+                report[column] = report[column].astype(bool)
+            else:
+                report[column] = report[column].astype("boolean")
+    return report